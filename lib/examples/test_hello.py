@@ -41,7 +41,12 @@ def helloA(step):
     # trying to make use of it.
     # 
     # If you need more than one worker to modify the same
-    # shared variable make sure this happens in separate steps.
+    # shared variable make sure this happens in separate steps or use
+    # the atomic operations: shared.append(key,value) and
+    # shared.compare_and_swap(key,expected,value).
+    #
+    # A worker may also block until some other worker sets a variable
+    # with shared.wait_for(key) instead of adding an extra step.
 
 
     step(1,'defining xyz')
@@ -117,6 +122,12 @@ def any_worker(step):
     # assignments to shared.k are not atomic and may happen in parallel this is not reliable.
     # just don't do this kind of thing!
 
+    # this is the reliable way: every append is atomic
+    shared.append('visits',reflection.getProcessName())
+
+    step(5,'counting visits')
+    error_check(len(shared['visits'])==N, 'problem handling shared visits=%s'%repr(shared['visits']))
+
 # this shows how one may add configuration parameters to the testcase
 N = int(config.get('n_hello_workers',5))
     
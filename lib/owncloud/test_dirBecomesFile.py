@@ -13,9 +13,9 @@ def make_subdir(d, sub):
     return make_workdir(os.path.join(d, sub))
 
 def expect_webdav_isfile(path, user_num=None):
-    exitcode,stdout,stderr = runcmd('curl -s -k %s -XPROPFIND %s | xmllint --format -'%(config.get('curl_opts',''),oc_webdav_url(remote_folder=path, user_num=user_num)))
-    error_check("NotFound" not in stdout, "Remote path %s does not exist" % path)
-    error_check("d:collection" not in stdout, "Remote path %s is not a file" % path)
+    entries = webdav_propfind(path, 0, user_num)
+    error_check(entries is not None, "Remote path %s does not exist" % path)
+    error_check(entries is None or not entries[0]['collection'], "Remote path %s is not a file" % path)
 
 @add_worker
 def dir_to_file(step):
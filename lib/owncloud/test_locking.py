@@ -3,7 +3,7 @@ import re
 from smashbox.owncloudorg.locking import *
 from smashbox.utilities import *
 import os
-import signal
+import time
 
 __doc__ = """
 
@@ -21,6 +21,8 @@ Test locking enforcement
 
 """
 
+# the testing app and the locks are global server state: do not run concurrently with other tests (smash --jobs)
+exclusive = True
 
 DIR_NAME = 'dir'
 SUBDIR_NAME = os.path.join(DIR_NAME, 'subdir')
@@ -213,11 +215,6 @@ class TimeoutError(Exception):
     pass
 
 
-def handler(signum, frame):
-    config.oc_sync_cmd = original_cmd
-    raise TimeoutError('Sync client did not terminate in time')
-
-
 def save_run_ocsync(local_folder, seconds=10, max_sync_retries=1, remote_folder="", n=None, user_num=None):
     """
     A save variation of run_ocsync, that terminates after n seconds or x retries depending on the client version
@@ -235,11 +232,17 @@ def save_run_ocsync(local_folder, seconds=10, max_sync_retries=1, remote_folder=
         config.oc_sync_cmd = pattern.sub('', config.oc_sync_cmd)
         config.oc_sync_cmd += ' --max-sync-retries %i' % max_sync_retries
 
-    signal.signal(signal.SIGALRM, handler)
-    signal.alarm(seconds)
+    if n is None:
+        n = config.oc_sync_repeat
 
-    # This run_ocsync() may hang indefinitely
-    run_ocsync(local_folder, remote_folder, n, user_num)
-
-    signal.alarm(0)
-    config.oc_sync_cmd = original_cmd
+    try:
+        deadline = time.time() + seconds
+
+        # The sync may hang indefinitely
+        for i in range(n):
+            sync = run_ocsync_async(local_folder, remote_folder, user_num)
+            if sync.wait(max(deadline - time.time(), 0)) is None:
+                sync.cancel()
+                raise TimeoutError('Sync client did not terminate in time')
+    finally:
+        config.oc_sync_cmd = original_cmd
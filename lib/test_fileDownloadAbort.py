@@ -14,6 +14,9 @@ iterations = config.get('fileDownloadAbort_iterations', 25)
 if type(filesize) is type(''):
     filesize = eval(filesize)
 
+# the test resets and checks the server log file: do not run concurrently with other tests (smash --jobs)
+exclusive = True
+
 testsets = [
         { 'fileDownloadAbort_filesize': 900000000, 
           'fileDownloadAbort_iterations': 25
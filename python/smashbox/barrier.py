@@ -0,0 +1,715 @@
+# The _open_SmashBox Project.
+#
+# License: AGPL
+#
+# Step synchronization of worker processes.
+#
+# A worker calling step(N) declares that it has completed all steps
+# 0..N-1 and blocks until every other worker has done the same. The
+# state lives in shared memory and the waiting workers sleep on
+# semaphores, so a step transition costs a handful of system calls
+# instead of a polling loop through a manager process.
+
+import multiprocessing
+import multiprocessing.sharedctypes
+import time
+
+# workers reach this step when they finish: it is larger than any step a test may use
+FINAL_STEP = 2**31-1
+
+
+class Retired(Exception):
+    """ Raised in a worker which has been retired by the supervisor (it was late or the test ran out of time).
+    """
+
+
+class _Value:
+    """ Same interface as multiprocessing.sharedctypes.RawValue for workers running as threads.
+    """
+    def __init__(self, value):
+        self.value = value
+
+
+class _Semaphore:
+    """ threading.Semaphore with a timeout for acquire() (not available in python2).
+    """
+    def __init__(self):
+        import threading
+        self._cond = threading.Condition(threading.Lock())
+        self._value = 0
+
+    def acquire(self, block=True, timeout=None):
+        self._cond.acquire()
+        try:
+            if timeout is not None:
+                end = time.time()+timeout
+            while self._value == 0:
+                if timeout is None:
+                    self._cond.wait()
+                else:
+                    remaining = end-time.time()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            self._value -= 1
+            return True
+        finally:
+            self._cond.release()
+
+    def release(self):
+        self._cond.acquire()
+        try:
+            self._value += 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+
+class StepBarrier:
+    """ Step barrier for a fixed number of workers.
+
+    Each worker owns a slot (its worker number) holding the step it
+    is waiting for or working in. The barrier advances when no worker
+    is left behind the current step: the last worker to arrive
+    advances the current step and wakes up only those workers whose
+    target step has been reached. An extra slot is reserved for the
+    supervisor which waits for the final step.
+
+    A worker may set a deadline when it arrives at a step. The barrier
+    does not enforce it: the supervisor looks for waiting workers past
+    their deadline and retires the workers which are late. A retired
+    worker no longer holds back the others and its next step() call
+    returns False.
+
+    By default the barrier synchronizes processes. With threads=True
+    it synchronizes threads of the calling process.
+    """
+
+    def __init__(self, nworkers, final_step=FINAL_STEP, threads=False):
+        self.nworkers = nworkers
+        self.final_step = final_step
+
+        if threads:
+            import threading
+            self._lock = threading.Lock()
+            self.steps = [0]*nworkers
+            self._waiting = [0]*(nworkers+1)
+            self._wakeup = [_Semaphore() for i in range(nworkers+1)]
+            self._current = _Value(0)
+            self._behind = _Value(nworkers)
+            self._deadline = [0.0]*nworkers
+            self._retired = [0]*nworkers
+            return
+
+        self._lock = multiprocessing.Lock()
+
+        # step of each worker (shared with reflection.getCurrentStep())
+        self.steps = multiprocessing.sharedctypes.RawArray('i', nworkers)
+
+        # target step of a sleeping slot (0 = not sleeping), the last slot belongs to the supervisor
+        self._waiting = multiprocessing.sharedctypes.RawArray('i', nworkers+1)
+        self._wakeup = [multiprocessing.Semaphore(0) for i in range(nworkers+1)]
+
+        self._current = multiprocessing.sharedctypes.RawValue('i', 0)
+
+        # number of workers which have not yet arrived beyond the current step
+        self._behind = multiprocessing.sharedctypes.RawValue('i', nworkers)
+
+        # time.time() by which a waiting worker expects the step to be reached by all (0 = no deadline)
+        self._deadline = multiprocessing.sharedctypes.RawArray('d', nworkers)
+
+        self._retired = multiprocessing.sharedctypes.RawArray('i', nworkers)
+
+    def current(self):
+        """ The step which all the workers are allowed to enter.
+        """
+        return self._current.value
+
+    def get_step(self, wi):
+        return self.steps[wi]
+
+    def get_steps(self):
+        return list(self.steps)
+
+    def get_deadlines(self):
+        return list(self._deadline)
+
+    def get_retired(self):
+        return [wi for wi in range(self.nworkers) if self._retired[wi]]
+
+    def step(self, wi, i, deadline=0, wait=True):
+        """ Worker wi arrives at step i and blocks until all other workers arrive there too.
+
+        Return False (immediately or when woken up) if the worker has been retired. With
+        wait=False the arrival is recorded but the worker does not wait for the others.
+        """
+        self._lock.acquire()
+        try:
+            if self._retired[wi]:
+                return False
+
+            self._deadline[wi] = deadline
+
+            cur = self._current.value
+            self._behind.value += (i <= cur) - (self.steps[wi] <= cur)
+            self.steps[wi] = i
+
+            if self._behind.value == 0:
+                self._advance()
+
+            if self._current.value >= i or not wait:
+                return True
+
+            self._waiting[wi] = i
+        finally:
+            self._lock.release()
+
+        self._wakeup[wi].acquire()
+
+        return not self._retired[wi]
+
+    def step_all(self, wi, i, deadline=0):
+        """ Same as step(): all the workers are in one group.
+        """
+        return self.step(wi, i, deadline)
+
+    def retire(self, wi):
+        """ Take worker wi out of the synchronization: the others do not wait for it anymore.
+
+        If the worker is waiting then it is woken up.
+        """
+        self._lock.acquire()
+        try:
+            if self._retired[wi]:
+                return
+
+            self._retired[wi] = 1
+
+            cur = self._current.value
+            self._behind.value -= (self.steps[wi] <= cur)
+            self.steps[wi] = self.final_step
+
+            if self._waiting[wi]:
+                self._waiting[wi] = 0
+                self._wakeup[wi].release()
+
+            if self._behind.value == 0:
+                self._advance()
+        finally:
+            self._lock.release()
+
+    def wait_finished(self, timeout=None):
+        """ Block until all workers have reached the final step.
+
+        Return False if they have not within timeout seconds.
+        """
+        slot = self.nworkers
+
+        self._lock.acquire()
+        try:
+            if self._current.value >= self.final_step:
+                return True
+            self._waiting[slot] = self.final_step
+        finally:
+            self._lock.release()
+
+        if self._wakeup[slot].acquire(True, timeout):
+            return True
+
+        self._lock.acquire()
+        try:
+            if self._waiting[slot]:
+                self._waiting[slot] = 0
+                return False
+        finally:
+            self._lock.release()
+
+        # woken up right after the timeout: consume the wakeup
+        self._wakeup[slot].acquire()
+        return True
+
+    def _advance(self):
+        # called with the lock held: jump directly to the lowest step any worker is waiting for
+        cur = min(self.steps)
+
+        self._behind.value = len([s for s in self.steps if s <= cur])
+        self._current.value = cur
+
+        for slot in range(self.nworkers+1):
+            if 0 < self._waiting[slot] <= cur:
+                self._waiting[slot] = 0
+                self._wakeup[slot].release()
+
+
+
+class TreeBarrier:
+    """ Step barrier for large numbers of workers, same interface as StepBarrier.
+
+    The workers are split in groups of fanout workers, these groups in
+    groups of fanout groups and so on up to a single root group. Each
+    group has its own lock and keeps the lowest step of its members:
+    an arriving worker updates its own group only and just the last
+    arrival in a group (the one raising the lowest step of the group)
+    goes on to the parent group. The root group sees one arrival per
+    child group and advances the current step.
+
+    Waking up is spread in the same way. In each group one waiting
+    member, the representative, waits in the parent group on behalf
+    of the others. When it is woken up it wakes up the members of its
+    own group whose target step has been reached (including the
+    representatives of the groups below) and hands over its role if
+    it is done itself. Nobody handles more than fanout slots per
+    level so the cost of a step transition grows with the depth of
+    the tree rather than with the number of workers.
+
+    For each group of workers the barrier measures the arrival spread:
+    the time between the first and the last member arriving at a step.
+    """
+
+    def __init__(self, nworkers, fanout=32, final_step=FINAL_STEP, threads=False):
+        if fanout < 2:
+            raise ValueError('barrier fanout must be at least 2: %s' % fanout)
+
+        self.nworkers = nworkers
+        self.fanout = fanout
+        self.final_step = final_step
+
+        # members are the workers and the groups: group g is member nworkers+g
+        # groups 0..ngroups-1 hold the workers, the last group is the root
+        self._children = []
+        parent = {}
+        level = range(nworkers)
+        while True:
+            ids = []
+            for k in range(0, len(level), fanout):
+                g = len(self._children)
+                self._children.append(level[k:k+fanout])
+                for m in level[k:k+fanout]:
+                    parent[m] = g
+                ids.append(nworkers+g)
+            if len(ids) <= 1:
+                break
+            level = ids
+
+        if not self._children:
+            self._children.append([])
+
+        self.ngroups = max(1, (nworkers+fanout-1)//fanout)
+        self._root = len(self._children)-1
+
+        nmembers = nworkers+len(self._children)
+        self._parent = [parent.get(m) for m in range(nmembers)]
+
+        # the supervisor waits in the root group in an extra slot
+        self._supervisor = nmembers
+        self._root_slots = self._children[self._root] + [self._supervisor]
+
+        if threads:
+            import threading
+            lock = threading.Lock
+            semaphore = _Semaphore
+            array = lambda typecode, n: [{'i': 0, 'd': 0.0}[typecode]]*n
+            value = _Value
+        else:
+            lock = multiprocessing.Lock
+            semaphore = lambda: multiprocessing.Semaphore(0)
+            array = multiprocessing.sharedctypes.RawArray
+            value = lambda v: multiprocessing.sharedctypes.RawValue('i', v)
+
+        self._locks = [lock() for g in self._children]
+
+        # step of each worker, lowest step of each group
+        self._value = array('i', nmembers)
+
+        # target step of a sleeping slot (0 = not sleeping) and the flag set when it is woken up to become representative
+        self._waiting = array('i', nmembers+1)
+        self._handover = array('i', nmembers+1)
+        self._wakeup = [semaphore() for i in range(nmembers+1)]
+
+        # current step as last seen by each group and whether a member waits in the parent group for all of them
+        self._known = array('i', len(self._children))
+        self._represented = array('i', len(self._children))
+
+        self._current = value(0)
+
+        self._deadline = array('d', nworkers)
+        self._retired = array('i', nworkers)
+
+        # time of the last arrival of each worker and the arrival spread statistics of each group of workers
+        self._arrived = array('d', nworkers)
+        self._spread_count = array('i', self.ngroups)
+        self._spread_sum = array('d', self.ngroups)
+        self._spread_max = array('d', self.ngroups)
+
+    def current(self):
+        """ The step which all the workers are allowed to enter.
+        """
+        return self._current.value
+
+    def get_step(self, wi):
+        return self._value[wi]
+
+    def get_steps(self):
+        return list(self._value[:self.nworkers])
+
+    def get_deadlines(self):
+        return list(self._deadline)
+
+    def get_retired(self):
+        return [wi for wi in range(self.nworkers) if self._retired[wi]]
+
+    def get_group_spreads(self):
+        """ Arrival spread of each group of workers: a list of (first_worker, last_worker, nsteps, mean, max) with times in seconds.
+        """
+        spreads = []
+        for g in range(self.ngroups):
+            workers = self._children[g]
+            if not workers:
+                continue
+            n = self._spread_count[g]
+            spreads.append((workers[0], workers[-1], n, self._spread_sum[g]/n if n else 0.0, self._spread_max[g]))
+        return spreads
+
+    def step(self, wi, i, deadline=0, wait=True):
+        """ Worker wi arrives at step i and blocks until all other workers arrive there too.
+
+        Return False (immediately or when woken up) if the worker has been retired. With
+        wait=False the arrival is recorded but the worker does not wait for the others.
+        """
+        g = self._parent[wi]
+
+        self._locks[g].acquire()
+        if self._retired[wi]:
+            self._locks[g].release()
+            return False
+
+        self._deadline[wi] = deadline
+        now = time.time()
+        self._arrived[wi] = now
+
+        self._update(g, wi, i, now)
+
+        if wait:
+            self._wait(g, wi, i)
+
+        return not self._retired[wi]
+
+    def step_all(self, wi, i, deadline=0):
+        """ Same as step(): all the workers are in one group.
+        """
+        return self.step(wi, i, deadline)
+
+    def retire(self, wi):
+        """ Take worker wi out of the synchronization: the others do not wait for it anymore.
+
+        If the worker is waiting then it is woken up (if it waits on behalf of its group then as soon as the step advances).
+        """
+        g = self._parent[wi]
+
+        self._locks[g].acquire()
+        if self._retired[wi]:
+            self._locks[g].release()
+            return
+
+        self._retired[wi] = 1
+
+        if self._waiting[wi]:
+            self._waiting[wi] = 0
+            self._wakeup[wi].release()
+
+        self._update(g, wi, self.final_step)
+
+    def wait_finished(self, timeout=None):
+        """ Block until all workers have reached the final step.
+
+        Return False if they have not within timeout seconds.
+        """
+        slot = self._supervisor
+        lock = self._locks[self._root]
+
+        lock.acquire()
+        try:
+            if self._current.value >= self.final_step:
+                return True
+            self._waiting[slot] = self.final_step
+        finally:
+            lock.release()
+
+        if self._wakeup[slot].acquire(True, timeout):
+            return True
+
+        lock.acquire()
+        try:
+            if self._waiting[slot]:
+                self._waiting[slot] = 0
+                return False
+        finally:
+            lock.release()
+
+        # woken up right after the timeout: consume the wakeup
+        self._wakeup[slot].acquire()
+        return True
+
+    def _lowest(self, g):
+        return min([self._value[m] for m in self._children[g]] or [self.final_step])
+
+    def _update(self, g, m, value, now=None):
+        # called with the lock of group g held, releases it: set the value of member m
+        # and carry a change of the lowest step of the group up the tree; the lock of
+        # the child group is released only once the parent is locked so that the
+        # updates of a group reach its parent in order
+        while True:
+            old = self._lowest(g)
+            self._value[m] = value
+            new = self._lowest(g)
+
+            if new == old:
+                break
+
+            if now is not None and g < self.ngroups:
+                self._add_spread(g, new, now)
+
+            if g == self._root:
+                self._current.value = new
+                for slot in self._root_slots:
+                    if 0 < self._waiting[slot] <= new:
+                        self._waiting[slot] = 0
+                        self._wakeup[slot].release()
+                break
+
+            parent = self._parent[self.nworkers+g]
+            self._locks[parent].acquire()
+            self._locks[g].release()
+            g, m, value = parent, self.nworkers+g, new
+
+        self._locks[g].release()
+
+    def _add_spread(self, g, low, now):
+        # the workers of group g have all arrived at step low or beyond: now is the last arrival
+        first = min([self._arrived[wi] for wi in self._children[g] if self._value[wi] == low] or [now])
+        spread = max(0.0, now-first)
+        self._spread_count[g] += 1
+        self._spread_sum[g] += spread
+        if spread > self._spread_max[g]:
+            self._spread_max[g] = spread
+
+    def _known_step(self, g):
+        if g == self._root:
+            return self._current.value
+        return self._known[g]
+
+    def _wait(self, g, m, t):
+        # member m of group g blocks until the current step reaches t
+        lock = self._locks[g]
+
+        lock.acquire()
+        if self._known_step(g) >= t:
+            lock.release()
+            return
+
+        if g == self._root or self._represented[g]:
+            self._waiting[m] = t
+            lock.release()
+
+            self._wakeup[m].acquire()
+
+            if not self._handover[m]:
+                return
+
+            # the representative of the group is done and handed over the role
+            self._handover[m] = 0
+            lock.acquire()
+        else:
+            self._represented[g] = 1
+
+        # representative: wait in the parent group until the step advances
+        # and wake up the members of this group which are done
+        parent = self._parent[self.nworkers+g]
+        while True:
+            known = self._known[g]
+            lock.release()
+
+            self._wait(parent, self.nworkers+g, known+1)
+
+            lock.acquire()
+            known = self._known_step(parent)
+            self._known[g] = known
+
+            for c in self._children[g]:
+                if 0 < self._waiting[c] <= known:
+                    self._waiting[c] = 0
+                    self._wakeup[c].release()
+
+            if known >= t:
+                break
+
+        for c in self._children[g]:
+            if self._waiting[c]:
+                self._waiting[c] = 0
+                self._handover[c] = 1
+                self._wakeup[c].release()
+                break
+        else:
+            self._represented[g] = 0
+
+        lock.release()
+
+
+
+class GroupBarrier:
+    """ Step barriers for named groups of workers.
+
+    Each group has its own barrier so step(N) waits only for the
+    workers of the same group and independent groups do not hold each
+    other back. step_all(N) waits for all the workers of all the
+    groups, using a barrier which sees every arrival of every worker.
+    The steps are numbered the same way in both cases: step_all(N)
+    returns once every worker has arrived at step N or beyond, be it
+    with step() or step_all(). A finishing worker waits for all the
+    others as with a single barrier.
+
+    groups holds the group name of each worker and make_barrier(n)
+    creates a barrier (StepBarrier or TreeBarrier) for n workers.
+    """
+
+    def __init__(self, groups, make_barrier):
+        self.nworkers = len(groups)
+
+        # workers of each group in order of appearance, (group name, index in group) of each worker
+        self.names = []
+        self.members = {}
+        self._index = []
+        for wi, name in enumerate(groups):
+            if name not in self.members:
+                self.names.append(name)
+                self.members[name] = []
+            self._index.append((name, len(self.members[name])))
+            self.members[name].append(wi)
+
+        self.barriers = dict([(name, make_barrier(len(self.members[name]))) for name in self.names])
+        self.all = make_barrier(self.nworkers)
+        self.final_step = self.all.final_step
+
+    def parts(self):
+        """ The barriers with the workers they synchronize: a list of (group name, barrier, worker numbers).
+
+        The barrier across all the groups comes first with group name None.
+        """
+        return [(None, self.all, range(self.nworkers))] + [(name, self.barriers[name], self.members[name]) for name in self.names]
+
+    def current(self):
+        """ The step which all the workers of all the groups are allowed to enter.
+        """
+        return self.all.current()
+
+    def get_step(self, wi):
+        return self.all.get_step(wi)
+
+    def get_steps(self):
+        return self.all.get_steps()
+
+    def get_deadlines(self):
+        # a deadline is set only in the barrier the worker waits in
+        deadlines = self.all.get_deadlines()
+        for name in self.names:
+            for k, d in enumerate(self.barriers[name].get_deadlines()):
+                wi = self.members[name][k]
+                deadlines[wi] = max(deadlines[wi], d)
+        return deadlines
+
+    def get_retired(self):
+        return self.all.get_retired()
+
+    def step(self, wi, i, deadline=0):
+        """ Worker wi arrives at step i and blocks until the other workers of its group arrive there too.
+
+        Return False if the worker has been retired.
+        """
+        if i == self.final_step:
+            return self.step_all(wi, i, deadline)
+
+        name, k = self._index[wi]
+        if not self.all.step(wi, i, 0, False):
+            return False
+        return self.barriers[name].step(k, i, deadline)
+
+    def step_all(self, wi, i, deadline=0):
+        """ Worker wi arrives at step i and blocks until all the workers of all the groups arrive there too.
+
+        Return False if the worker has been retired.
+        """
+        name, k = self._index[wi]
+        if not self.barriers[name].step(k, i, 0, False):
+            return False
+        return self.all.step(wi, i, deadline)
+
+    def retire(self, wi):
+        name, k = self._index[wi]
+        self.barriers[name].retire(k)
+        self.all.retire(wi)
+
+    def wait_finished(self, timeout=None):
+        return self.all.wait_finished(timeout)
+
+
+if __name__ == "__main__":
+
+    # Benchmark of the step transition latency: run "python barrier.py [--fanout F] [nworkers ...]".
+    #
+    # Each worker passes NSTEPS steps with no work in between. The
+    # transition latency of a step is the time between the arrival
+    # of the last worker and the moment when the last worker is
+    # released. Both the flat and the tree barrier are measured.
+
+    import sys
+    import time
+
+    NSTEPS = 20
+
+    def bench(make_barrier, nworkers):
+        barrier = make_barrier(nworkers)
+
+        arrived = multiprocessing.sharedctypes.RawArray('d', nworkers*NSTEPS)
+        released = multiprocessing.sharedctypes.RawArray('d', nworkers*NSTEPS)
+
+        def worker(wi):
+            for i in range(NSTEPS):
+                arrived[wi*NSTEPS+i] = time.time()
+                barrier.step(wi, i+1)
+                released[wi*NSTEPS+i] = time.time()
+            barrier.step(wi, NSTEPS+1)
+
+        procs = [multiprocessing.Process(target=worker, args=(wi,)) for wi in range(nworkers)]
+        for p in procs:
+            p.start()
+
+        barrier.wait_finished()
+
+        for p in procs:
+            p.join()
+
+        latency = []
+        for i in range(NSTEPS):
+            last_arrival = max([arrived[wi*NSTEPS+i] for wi in range(nworkers)])
+            last_release = max([released[wi*NSTEPS+i] for wi in range(nworkers)])
+            latency.append(last_release-last_arrival)
+
+        latency.sort()
+        return latency[len(latency)/2], latency[-1]
+
+    args = sys.argv[1:]
+    fanout = 32
+    if args[:1] == ['--fanout']:
+        fanout = int(args[1])
+        args = args[2:]
+
+    nworkers_list = [int(n) for n in args] or [10, 100, 1000]
+
+    barriers = [('flat', lambda n: StepBarrier(n, NSTEPS+1)),
+                ('tree/%d' % fanout, lambda n: TreeBarrier(n, fanout, NSTEPS+1))]
+
+    print "%10s %10s %15s %15s %20s" % ('barrier', 'nworkers', 'median [ms]', 'max [ms]', 'per worker [us]')
+    for n in nworkers_list:
+        for name, make_barrier in barriers:
+            median, worst = bench(make_barrier, n)
+            print "%10s %10d %15.3f %15.3f %20.2f" % (name, n, median*1000, worst*1000, median*1e6/n)
@@ -0,0 +1,175 @@
+# The _open_SmashBox Project.
+#
+# License: AGPL
+#
+# Distributed execution of a test: the supervisor (coordinator) serves
+# the step barrier and the shared object over TCP and agents running on
+# other hosts execute subsets of the workers.
+#
+# The coordinator is started by setting engine_listen and engine_agents
+# in the config. Agents are started with "smash --agent HOST:PORT". Both
+# sides must use the same engine_authkey.
+
+import multiprocessing.managers
+import socket
+import threading
+import time
+
+BARRIER_METHODS = ('step', 'step_all', 'get_step', 'get_steps', 'get_deadlines', 'get_retired', 'retire', 'current', 'wait_finished')
+
+STORE_METHODS = ('__getitem__', '__setitem__', '__delitem__', '__contains__', '__str__',
+                 'get', 'append', 'compare_and_swap', 'wait_for', 'keys', 'dict')
+
+COORDINATOR_METHODS = ('register', 'report')
+
+
+class CoordinatorManager(multiprocessing.managers.BaseManager):
+    """ Serves the objects of a test run to the agents.
+    """
+
+
+class AgentManager(multiprocessing.managers.BaseManager):
+    """ Connects an agent to the coordinator.
+    """
+
+for typeid in ['get_barrier', 'get_store', 'get_coordinator']:
+    AgentManager.register(typeid)
+
+
+MISSING_AGENT_EXITCODE = 1 # exit code of the workers of an agent which did not register or report in time
+
+
+class Coordinator:
+    """ Hands out the test job to the agents and collects the exit codes of their workers.
+
+    Worker number wi is executed by the agent with rank wi % nagents.
+    """
+
+    def __init__(self, job, nagents):
+        self.job = dict(job, nagents=nagents)
+        self.nagents = nagents
+        self.agents = []
+        self.exitcodes = {}
+        self._reported = set()
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def register(self, hostname):
+        """ Return (rank, job) for a new agent or None if all agents are already registered.
+        """
+        self._cond.acquire()
+        try:
+            if self._closed or len(self.agents) >= self.nagents:
+                return None
+            rank = len(self.agents)
+            self.agents.append(hostname)
+            self._cond.notify_all()
+            return rank, self.job
+        finally:
+            self._cond.release()
+
+    def report(self, rank, exitcodes):
+        """ Agent rank reports the exit codes of its workers: {worker_number: exitcode}.
+        """
+        self._cond.acquire()
+        try:
+            if rank in self._reported or rank >= len(self.agents):
+                return
+            self.exitcodes.update(exitcodes)
+            self._reported.add(rank)
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+    def workers(self, ranks):
+        """ The worker numbers executed by the agents with these ranks.
+        """
+        return [wi for wi in range(self.job['nworkers']) if wi % self.nagents in ranks]
+
+    def _wait(self, done, timeout):
+        deadline = None
+        if timeout:
+            deadline = time.time() + timeout
+        while not done():
+            if deadline is None:
+                self._cond.wait()
+            elif time.time() >= deadline:
+                return False
+            else:
+                self._cond.wait(deadline - time.time())
+        return True
+
+    def wait_agents(self, timeout=None):
+        """ Block until all agents registered or timeout seconds passed (None = forever). On timeout no more agents are
+        accepted. Return the ranks of the missing agents.
+        """
+        self._cond.acquire()
+        try:
+            if not self._wait(lambda: len(self.agents) >= self.nagents, timeout):
+                self._closed = True
+            return range(len(self.agents), self.nagents)
+        finally:
+            self._cond.release()
+
+    def wait_exitcodes(self, timeout=None):
+        """ Block until all registered agents reported or timeout seconds passed (None = forever) and return the list of
+        exit codes of all workers. The workers of the agents which did not register or report get MISSING_AGENT_EXITCODE.
+        """
+        self._cond.acquire()
+        try:
+            self._wait(lambda: len(self._reported) >= len(self.agents), timeout)
+            self._closed = True
+            missing = self.workers([rank for rank in range(self.nagents) if rank not in self._reported])
+            return [MISSING_AGENT_EXITCODE if wi in missing else self.exitcodes.get(wi) for wi in range(self.job['nworkers'])]
+        finally:
+            self._cond.release()
+
+    def missing_reports(self):
+        self._cond.acquire()
+        try:
+            return [rank for rank in range(len(self.agents)) if rank not in self._reported]
+        finally:
+            self._cond.release()
+
+
+def parse_address(address):
+    """ "host:port" -> (host,port)
+    """
+    host, port = address.rsplit(':', 1)
+    return (host, int(port))
+
+
+def serve(address, authkey, barrier, store, coordinator):
+    """ Serve the objects in a background thread of the calling process. Each connection is handled by a separate thread.
+    """
+    CoordinatorManager.register('get_barrier', callable=lambda: barrier, exposed=BARRIER_METHODS)
+    CoordinatorManager.register('get_store', callable=lambda: store, exposed=STORE_METHODS)
+    CoordinatorManager.register('get_coordinator', callable=lambda: coordinator, exposed=COORDINATOR_METHODS)
+
+    server = CoordinatorManager(parse_address(address), authkey).get_server()
+
+    t = threading.Thread(target=server.serve_forever, name='coordinator')
+    t.daemon = True
+    t.start()
+
+    return server
+
+
+def connect(address, authkey, retry_delay=1):
+    """ Connect to the coordinator and register as an agent. Wait until the coordinator is available and has a free slot.
+
+    Return (manager, coordinator, rank, job).
+    """
+    while True:
+        manager = AgentManager(parse_address(address), authkey)
+        try:
+            manager.connect()
+            coordinator = manager.get_coordinator()
+            registration = coordinator.register(socket.gethostname())
+            if registration is not None:
+                rank, job = registration
+                return manager, coordinator, rank, job
+        except socket.error:
+            pass
+
+        time.sleep(retry_delay)
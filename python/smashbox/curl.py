@@ -1,4 +1,5 @@
 from smashbox.utilities import *
+from smashbox import tracing
 
 import smashbox.utilities.structures
 
@@ -143,7 +144,12 @@ class Client:
         ret_headers=[]
         c.setopt(pycurl.HEADERFUNCTION, ret_headers.append)
 
-        c.perform()
+        with tracing.span('curl',cat='http') as span:
+            c.perform()
+            if tracing.enabled:
+                # the path only: the url may contain credentials
+                import urlparse
+                span.args = {'path':urlparse.urlsplit(url).path,'rc':c.getinfo(c.HTTP_CODE)}
 
         if response_obj is None:
             response_obj = Response()
@@ -27,10 +27,10 @@ del standardSetup
 # obsolete to be removed
 def log(*args,**kwds):
     import time
-    print time.ctime(),_smash_.process_name,(" ".join([str(s) for s in args]))%kwds
+    print time.ctime(),_smash_.worker.process_name,(" ".join([str(s) for s in args]))%kwds
 
-
-#import shelve
+import os
+import threading
 
 class _smash_:
     """ Internals of the stepper synchronization framework. This class
@@ -40,221 +40,621 @@ class _smash_:
 
     # all the rest of attributes are internal -- accessors for process_name and common_dict are defined in utilities
 
-    process_name = None
-    process_number = 0
-    
+    class WorkerIdentity(threading.local):
+        """ Name and number of the worker running in the current thread (workers may be threads of one process).
+        """
+        process_name = None
+        process_number = 0
+        step_number = 0 # the step the worker is working in
+        step_started = None # when it entered this step
+        step_message = None
+        step_times = None # (step, time entered) of all the steps so far
+
+    worker = WorkerIdentity()
+
     DEBUG = False
 
-    # this is a hardcoded maximum number of steps
-    N_STEPS = 100
-    
     workers = []
+    groups = [] # group name of each worker (None = no group)
 
-    class SmashSharedObject:
-        """ A bunch of shared attributes stored in a directory as separate files.
-        """
-        
-        def __init__(self,d):
-           self._dir = d
-           self._makedir()
-
-        def _makedir(self):
-           try:
-              os.makedirs(self._dir)
-           except OSError,x:
-              import errno
-              if x.errno != errno.EEXIST:
-                 raise
-                       
-        def __getitem__(self,key):
-           self._makedir()
-           import pickle
-           try:
-              return pickle.load(file(os.path.join(self._dir,'_attr_'+key)))
-           except Exception,x:
-              logger.debug(x)
-              raise AttributeError(x)
-        
-        def __setitem__(self,key,val):
-           self._makedir()
-           import pickle
-           import time
-           tmp_name = os.path.join(self._dir,'tmp.%s.%s._attr_%s'%(os.getpid(),time.time(),key))
-           dest_name = os.path.join(self._dir,'_attr_'+key)
-           pickle.dump(val,file(tmp_name,'w'))
-
-           import shutil
-           shutil.move(tmp_name,dest_name)
-
-        def keys(self):
-           import glob
-           self._makedir()
-           attrs = [os.path.basename(a)[len('_attr_'):] for a in glob.glob(os.path.join(self._dir,'_attr_*'))]
-           return attrs
-
-        def dict(self):
-           keys = {}
-           for a in self.keys():
-              keys[a] = self[a]
-           return keys
-
-        def __str__(self):
-           return repr(self.dict())
-                
     all_procs = []
 
-    @staticmethod
-    def supervisor(steps):
+    shared_object = None # opened after setup_test()
+
+    # time budgets (seconds, None = unlimited) and what happens to the late workers: 'abort' or 'skip'
+    step_timeout = None
+    test_timeout = None
+    timeout_action = 'abort'
 
+    WATCH_INTERVAL = 1.0 # how often the supervisor looks for dead and late workers
+    RETIRED_GRACE = 10.0 # how long retired workers may take to stop by themselves
+
+    overruns = 0 # number of step (or test) time budget overruns
+    test_overrun = False
+    dead = [] # workers which died without reaching the final step
+    late = [] # workers retired because they were late
+
+    @staticmethod
+    def supervisor():
+        """ Wait until all workers reach the final step. Meanwhile retire the workers which died or are late.
+        """
         import time
-        #print "SU",steps
-        #print 'SU',[s for s in steps]
 
         if _smash_.DEBUG:
-            log('start',_smash_.supervisor_step.value,_smash_.steps)
+            log('start',_smash_.barrier.current(),_smash_.barrier.get_steps())
 
-        while _smash_.supervisor_step.value < _smash_.N_STEPS-1:
-            while 1:
-                time.sleep(0.01)
-                #print [s for s in steps]
-                passed = all([_smash_.steps[i]>_smash_.supervisor_step.value for i in range(len(_smash_.steps))])
-                #print 'passed',supervisor_step.value,passed
-                if passed:
-                    break
+        t0 = time.time()
 
-            #print "supervisor step completed:",supervisor_step.value,steps
+        while not _smash_.barrier.wait_finished(_smash_.WATCH_INTERVAL):
+            _smash_.retire_dead_workers()
+            _smash_.check_deadlines(t0)
 
-            _smash_.supervisor_step.value += 1
+        if _smash_.DEBUG:
+            log('stop',_smash_.barrier.current(),_smash_.barrier.get_steps())
 
-        
+    @staticmethod
+    def worker_name(wi):
+        f,fname = _smash_.workers[wi]
+        return '%s(#%d)'%(fname or f.__name__,wi)
 
-        if _smash_.DEBUG:
-            log('stop',_smash_.supervisor_step.value,_smash_.steps)
+    @staticmethod
+    def retire_dead_workers():
+        """ Retire the local worker processes which exited without reaching the final step (killed, crashed...).
+        """
+        import smashbox.barrier
+
+        if _smash_.worker_mode == 'thread':
+            return # a thread always reaches the final step
+
+        for wi,p in _smash_.all_procs:
+            if wi in _smash_.dead or p.is_alive():
+                continue
+            step = _smash_.barrier.get_step(wi)
+            if step != smashbox.barrier.FINAL_STEP:
+                logger.error('worker %s died in step %d (exit code %s)',_smash_.worker_name(wi),step,p.exitcode)
+                _smash_.dead.append(wi)
+                _smash_.barrier.retire(wi)
 
     @staticmethod
-    def _step(i,wi,message):
+    def check_deadlines(t0):
+        """ Retire the late workers if a waiting worker is past its deadline or the test is over its time budget.
+        """
         import time
-        _smash_.steps[wi] = i
+        import smashbox.barrier
+
+        now = time.time()
+        steps = _smash_.barrier.get_steps()
+        retired = _smash_.barrier.get_retired()
+        active = [wi for wi in range(len(steps)) if wi not in retired]
+
+        if _smash_.test_timeout and now > t0+_smash_.test_timeout:
+            late = [wi for wi in active if steps[wi] != smashbox.barrier.FINAL_STEP]
+            reason = 'test time budget of %ss exceeded'%_smash_.test_timeout
+            _smash_.test_overrun = True
+        else:
+            # each group of workers has its own barrier (and there is one across the groups)
+            late = []
+            reasons = []
+            for group,barrier,members in _smash_.barrier_parts():
+                cur = barrier.current()
+                deadlines = barrier.get_deadlines()
+                overdue = [wi for k,wi in enumerate(members) if wi in active and steps[wi] > cur and deadlines[k] and now > deadlines[k]]
+                if not overdue:
+                    continue
+                target = min([steps[wi] for wi in overdue])
+                if target == smashbox.barrier.FINAL_STEP:
+                    reasons.append('time budget for finishing exceeded')
+                else:
+                    reasons.append('time budget for reaching step %d exceeded'%target)
+                if group is not None:
+                    reasons[-1] += ' in group %s'%group
+                late += [wi for wi in members if wi in active and steps[wi] <= cur and wi not in late]
+            reason = ', '.join(reasons)
+
+        if not late:
+            return
+
+        _smash_.overruns += 1
+
+        logger.error('%s, late worker(s): %s -- %s',reason,', '.join(['%s in step %d'%(_smash_.worker_name(wi),steps[wi]) for wi in late]),_smash_.timeout_action)
+
+        _smash_.dump_stacks(late)
+
+        for wi in late:
+            _smash_.barrier.retire(wi)
+            _smash_.late.append(wi)
+
+        if _smash_.timeout_action == 'abort' and _smash_.worker_mode == 'process':
+            time.sleep(1) # let them log their stacks
+            for wi,p in _smash_.all_procs:
+                if wi in late and p.is_alive():
+                    p.terminate()
+
+    @staticmethod
+    def barrier_parts():
+        """ The barriers of the groups of workers: a list of (group name, barrier, worker numbers).
+        """
+        if hasattr(_smash_.barrier,'parts'):
+            return _smash_.barrier.parts()
+        return [(None,_smash_.barrier,range(len(_smash_.workers)))]
 
+    @staticmethod
+    def dump_stacks(workers):
+        """ Log the current stack of the local workers: worker processes log their own stack on SIGUSR1.
+        """
+        import sys
+        import traceback
+
+        procs = dict(_smash_.all_procs)
+
+        for wi in workers:
+            if wi not in procs:
+                logger.error('stack of %s not available (remote worker)',_smash_.worker_name(wi))
+            elif _smash_.worker_mode == 'thread':
+                frame = sys._current_frames().get(procs[wi].ident)
+                if frame is not None:
+                    logger.error('stack of %s:\n%s',_smash_.worker_name(wi),''.join(traceback.format_stack(frame)))
+            elif procs[wi].is_alive():
+                import signal
+                os.kill(procs[wi].pid,signal.SIGUSR1)
+
+    @staticmethod
+    def log_stack(signum,frame):
+        import traceback
+        logger.error('stack of the worker requested by the supervisor:\n%s',''.join(traceback.format_stack(frame)))
+
+    @staticmethod
+    def _step(i,wi,message,timeout=None,everyone=False):
         def supervisor_status():
-            return "(supervisor_step="+str(_smash_.supervisor_step.value)+" worker_steps="+str(_smash_.steps)+")"
+            return "(supervisor_step="+str(_smash_.barrier.current())+" worker_steps="+str(_smash_.barrier.get_steps())+")"
+
+        import time
+        import smashbox.tracing
 
         if _smash_.DEBUG:
             logger.debug('step %d waiting (wi=%d) %s'%(i,wi,supervisor_status()))
-        while _smash_.supervisor_step.value<i:
-            time.sleep(0.01)
+
+        t_arrived = time.time()
+
+        if timeout is None:
+            timeout = _smash_.step_timeout
+
+        deadline = 0
+        if timeout:
+            deadline = t_arrived+timeout
+
+        if everyone:
+            entered = _smash_.barrier.step_all(wi,i,deadline)
+        else:
+            entered = _smash_.barrier.step(wi,i,deadline)
+
+        if not entered:
+            import smashbox.barrier
+            raise smashbox.barrier.Retired('worker retired by the supervisor when arriving at step %d'%i)
+
+        t_entered = time.time()
+
+        _smash_.worker.step_times.append((i,t_entered))
 
         if _smash_.DEBUG:
             logger.debug('step %d entered (wi=%d) %s'%(i,wi,supervisor_status()))
 
+        if smashbox.tracing.enabled:
+            import smashbox.barrier
+            w = _smash_.worker
+            smashbox.tracing.record('step %d'%w.step_number,w.step_started,t_arrived,'step',{'message':w.step_message})
+            if i == smashbox.barrier.FINAL_STEP:
+                smashbox.tracing.record('wait finish',t_arrived,t_entered,'barrier')
+            elif everyone:
+                smashbox.tracing.record('wait step %d (all groups)'%i,t_arrived,t_entered,'barrier')
+            else:
+                smashbox.tracing.record('wait step %d'%i,t_arrived,t_entered,'barrier')
+            w.step_number,w.step_started,w.step_message = i,t_entered,message
+
         if message is not None:
             sep='*'*80
-            logger.info( 'entering new step \n'+sep+'\n'+'(%d) %s:  %s\n'%(i,_smash_.process_name,message.upper())+sep)
+            logger.info( 'entering new step \n'+sep+'\n'+'(%d) %s:  %s\n'%(i,_smash_.worker.process_name,message.upper())+sep)
 
     @staticmethod
     def worker_wrap(wi,f,fname):
+        """ Run the worker function and return its exit code.
+        """
         if fname is None:
             fname = f.__name__
-        _smash_.process_name=fname
-        _smash_.process_number = wi
-        def step(i,message=""):
-            _smash_._step(i,wi,message)
+        import time
+        _smash_.worker.process_name=fname
+        _smash_.worker.process_number = wi
+        _smash_.worker.step_started = time.time()
+        _smash_.worker.step_message = None
+        _smash_.worker.step_times = []
+
+        import smashbox.tracing
+        smashbox.tracing.reset()
+        def step(i,message="",timeout=None):
+            """ Wait until all the workers (of the group of this worker, see add_worker()) reach step i. If timeout (seconds)
+            is given (otherwise engine_step_timeout applies) and they do not within timeout then the supervisor retires the late workers.
+            """
+            _smash_._step(i,wi,message,timeout)
+
+        import smashbox.barrier
+
+        exitcode = 0
         try:
             try:
                 f(step)
+            except smashbox.barrier.Retired,x:
+                logger.error('%s',x)
+                exitcode = 1
+            except SystemExit,x:
+                exitcode = x.code
             except Exception,x:
                 import traceback
                 logger.fatal("Exception occured: %s \n %s", x,traceback.format_exc())
-                import sys
-                sys.exit(1)
+                exitcode = 1
         finally:
             # worker finish
-            step(_smash_.N_STEPS-1,None) # don't print any message
+            try:
+                step(smashbox.barrier.FINAL_STEP,None) # don't print any message
+            except smashbox.barrier.Retired:
+                pass
+
+            # the supervisor merges the traces only after all the workers are joined
+            import smashbox.tracing
+            if smashbox.tracing.enabled:
+                _smash_.shared_object.append('_trace',smashbox.tracing.collect(wi,'%s (#%d)'%(fname,wi)))
+
+            # the requests in the server diagnostic log are attributed to the steps by time
+            if config.get('oc_check_diagnostic_log',False):
+                _smash_.shared_object.append('_step_times',_smash_.worker.step_times)
+
+        import smashbox.utilities
+        smashbox.utilities.webdav.close_pool()
+
+        hs = smashbox.utilities.hashing.stats()
+        if hs['hits']+hs['misses']:
+            logger.info('hash cache: %d lookups, %d hits (%.0f%%), %.1f MB hashed',hs['hits']+hs['misses'],hs['hits'],100.0*hs['hits']/(hs['hits']+hs['misses']),hs['bytes']/1e6)
+
+        ss = smashbox.utilities.oc_sessions.stats()
+        if ss['logins']:
+            logger.info('api sessions: %d logins (%d after 401), %d calls reused a session',ss['logins'],ss['relogins'],ss['hits'])
+
+        if smashbox.utilities.reported_errors:
+           logger.error('%s error(s) reported',len(smashbox.utilities.reported_errors))
+           exitcode = 2
+
+        return exitcode
+
+    @staticmethod
+    def process_main(wi,f,fname):
+        import signal
+        import sys
+        signal.signal(signal.SIGUSR1,_smash_.log_stack)
+        sys.exit(_smash_.worker_wrap(wi,f,fname))
+
+    @staticmethod
+    def thread_main(wi,f,fname):
+        _smash_.exitcodes[wi] = _smash_.worker_wrap(wi,f,fname)
+
+    @staticmethod
+    def open_shared_object():
+        """ The shared object of a test lives next to its run directory (like the log file) so that
+        resetting the run directory in the middle of the test does not pull it away from under the workers.
+        """
+        import smashbox.shared_store
+
+        logdir,logfn = os.path.split(config.rundir)
+        path = os.path.join(logdir,'shared-'+logfn+'.db')
+
+        if config.rundir_reset_procedure == 'delete':
+            for fn in [path,path+'-wal',path+'-shm']:
+                if os.path.exists(fn):
+                    os.remove(fn)
+
+        return smashbox.shared_store.SharedStore(path)
+
+    @staticmethod
+    def write_trace():
+        """ Merge the traces of the supervisor and of all the workers into trace-<rundir>.json.
+        """
+        import smashbox.tracing
+
+        events = smashbox.tracing.collect(len(_smash_.workers),'supervisor')
+        for worker_events in _smash_.shared_object.get('_trace',[]):
+            events.extend(worker_events)
+
+        logdir,logfn = os.path.split(config.rundir)
+        path = os.path.join(logdir,'trace-'+logfn+'.json')
+        smashbox.tracing.write(path,events,logfn)
+        logger.info('trace written to %s',path)
+
+    @staticmethod
+    def start_workers(indices,worker_mode):
+        """ Start the workers with the given numbers as processes or threads.
+        """
+        from multiprocessing import Process
+
+        _smash_.exitcodes = {}
+
+        for i in indices:
+            f,fname = _smash_.workers[i]
+            if worker_mode == 'thread':
+                p = threading.Thread(target=_smash_.thread_main,args=(i,f,fname),name=fname or f.__name__)
+                p.daemon = True # a hung worker thread cannot be killed: do not wait for it at exit
+            else:
+                p = Process(target=_smash_.process_main,args=(i,f,fname))
+            p.start()
+            _smash_.all_procs.append((i,p))
+
+    @staticmethod
+    def join_workers(worker_mode):
+        """ Wait for the started workers and return their exit codes: {worker_number: exitcode}.
+
+        Dead workers are retired meanwhile. Retired workers which do not stop by themselves within
+        RETIRED_GRACE seconds after all the others are terminated (processes) or abandoned (threads).
+        """
+        import time
+
+        grace_end = None
+
+        while True:
+            _smash_.retire_dead_workers()
+
+            alive = [(i,p) for i,p in _smash_.all_procs if p.is_alive()]
+            if not alive:
+                break
+
+            retired = _smash_.barrier.get_retired()
+            if [i for i,p in alive if i not in retired]:
+                grace_end = None
+            elif grace_end is None:
+                # with 'abort' the late workers are not waited for (processes are already terminated)
+                grace_end = time.time()
+                if _smash_.timeout_action == 'skip':
+                    grace_end += _smash_.RETIRED_GRACE
+            elif time.time() > grace_end:
+                for i,p in alive:
+                    if worker_mode == 'thread':
+                        logger.error('abandoning retired worker %s',_smash_.worker_name(i))
+                    else:
+                        logger.error('terminating retired worker %s',_smash_.worker_name(i))
+                        p.terminate()
+                        p.join()
+                break
+
+            alive[0][1].join(_smash_.WATCH_INTERVAL)
+
+        if worker_mode == 'process':
+            for i,p in _smash_.all_procs:
+                _smash_.exitcodes[i] = p.exitcode
+
+        return _smash_.exitcodes
+
+    @staticmethod
+    def get_worker_mode():
+        worker_mode = config.get('engine_worker_mode','process')
+        if worker_mode not in ['process','thread']:
+            raise ValueError('unknown engine_worker_mode: %s'%repr(worker_mode))
+        _smash_.worker_mode = worker_mode
+        return worker_mode
+
+    @staticmethod
+    def configure_timeouts():
+        def seconds(opt):
+            # set on the command line the value is a string
+            val = config.get(opt,None)
+            if val in [None,'']:
+                return None
+            return float(val)
+
+        _smash_.step_timeout = seconds('engine_step_timeout')
+        _smash_.test_timeout = seconds('engine_test_timeout')
+
+        _smash_.timeout_action = config.get('engine_timeout_action','abort')
+        if _smash_.timeout_action not in ['abort','skip']:
+            raise ValueError('unknown engine_timeout_action: %s'%repr(_smash_.timeout_action))
+
+    @staticmethod
+    def make_barrier(groups,threads):
+        """ The step barrier of the workers: a single one or, if the test puts the workers in groups, one for each group and one across the groups.
+        """
+        import smashbox.barrier
+
+        kind = config.get('engine_barrier','flat')
+        if kind not in ['flat','tree']:
+            raise ValueError('unknown engine_barrier: %s'%repr(kind))
+
+        def make(nworkers):
+            if kind == 'tree':
+                return smashbox.barrier.TreeBarrier(nworkers,int(config.get('engine_barrier_fanout',32)),threads=threads)
+            return smashbox.barrier.StepBarrier(nworkers,threads=threads)
+
+        if [g for g in groups if g is not None]:
+            return smashbox.barrier.GroupBarrier([g or 'default' for g in groups],make)
+
+        return make(len(groups))
+
+    @staticmethod
+    def report_arrival_spreads():
+        """ Log how far apart the workers of each group of the tree barrier arrived at the steps.
+        """
+        parts = _smash_.barrier_parts()
+        if len(parts) > 1:
+            parts = parts[1:] # the workers arrive at the barrier across the groups without waiting there in most steps
 
-            import smashbox.utilities
-            if smashbox.utilities.reported_errors:
-               logger.error('%s error(s) reported',len(smashbox.utilities.reported_errors))
-               import sys
-               sys.exit(2)
-                  
+        spreads = []
+        for group,barrier,members in parts:
+            spreads += [(members[first],members[last],n,mean,worst) for first,last,n,mean,worst in barrier.get_group_spreads()]
+        if not spreads:
+            return
+
+        for first,last,n,mean,worst in spreads:
+            logger.debug('arrival spread of workers #%d-#%d: %d steps, mean %.1fms, max %.1fms',first,last,n,mean*1000,worst*1000)
+
+        first,last,n,mean,worst = max(spreads,key=lambda s: s[4])
+        logger.info('arrival spread: %d group(s), worst workers #%d-#%d: mean %.1fms, max %.1fms',len(spreads),first,last,mean*1000,worst*1000)
+
+        from smashbox.utilities.monitoring import commit_to_monitoring
+        commit_to_monitoring('barrier_arrival_spread',worst)
+
+    @staticmethod
+    def coordinate(listen,barrier):
+        """ Serve the test to the agents and supervise the workers they run. Return the exit codes of all workers: {worker_number: exitcode}.
+        """
+        import smashbox.coordinator
+
+        authkey = config.get('engine_authkey',None)
+        if not authkey:
+            raise ValueError('engine_authkey must be set when engine_listen is used')
+
+        nagents = int(config.get('engine_agents',1))
+
+        job = { 'test_target' : _smash_.args.test_target,
+                'source' : open(_smash_.args.test_target).read(),
+                'config' : smashbox.script.dump_config_to_blob(),
+                'nworkers' : len(_smash_.workers) }
+
+        coordinator = smashbox.coordinator.Coordinator(job,nagents)
+
+        smashbox.coordinator.serve(listen,authkey,barrier,_smash_.shared_object,coordinator)
+
+        timeout = config.get('engine_agent_timeout',None)
+        if timeout:
+            timeout = float(timeout)
+
+        logger.info('waiting for %d agent(s) at %s',nagents,listen)
+        missing = coordinator.wait_agents(timeout)
+        logger.info('agents registered: %s',coordinator.agents)
+
+        if missing:
+            # the others must not wait for the workers which will never run
+            logger.error('agent(s) %s did not register within %ds: their %d worker(s) fail',missing,timeout,len(coordinator.workers(missing)))
+            for wi in coordinator.workers(missing):
+                barrier.retire(wi)
+
+        _smash_.supervisor()
+
+        exitcodes = coordinator.wait_exitcodes(timeout)
+
+        missing = coordinator.missing_reports()
+        if missing:
+            logger.error('agent(s) %s did not report within %ds: their %d worker(s) fail',missing,timeout,len(coordinator.workers(missing)))
+
+        return dict(enumerate(exitcodes))
 
     @staticmethod
     def run():
-        """ Lunch worker processes and the supervisor loop. Block until all is finished.
+        """ Lunch worker processes (or threads) and the supervisor loop. Block until all is finished.
         """
-        from multiprocessing import Process, Manager
+        import smashbox.barrier
+
+        worker_mode = _smash_.get_worker_mode()
+
+        # in the distributed mode the workers run on the agents and reach the barrier through the coordinator threads
+        listen = config.get('engine_listen',None)
 
         import smashbox.utilities
-        smashbox.utilities.setup_test()
+        import smashbox.tracing
+        import time
+        t0 = time.time()
+        with smashbox.tracing.span('setup_test'):
+            smashbox.utilities.setup_test()
 
-        manager = Manager()
+        _smash_.shared_object = _smash_.open_shared_object()
 
-        _smash_.shared_object = _smash_.SmashSharedObject(os.path.join(config.rundir,'_shared_objects'))
-        
-        #_smash_.shared_object = shelve.open(os.path.join(config.rundir,'_shared_objects.shelve'))
+        if smashbox.tracing.enabled:
+            del _smash_.shared_object['_trace'] # left over by a previous run in a kept rundir
 
-        #print "SUPERVISOR NAMESPACE",_smash_.shared_object.__dict__
-        
-        _smash_.supervisor_step = manager.Value('i',0)
+        # the workers add the time of the users and groups they set up themselves
+        _smash_.shared_object['setup_times'] = [time.time()-t0]
 
-        _smash_.process_name = "supervisor"
+        _smash_.barrier = _smash_.make_barrier(_smash_.groups,threads=(worker_mode=='thread' or bool(listen)))
 
-        _smash_.steps = manager.list([0 for x in range(len(_smash_.workers))])
+        _smash_.worker.process_name = "supervisor"
 
-        import time
         t1 = time.time()
-        # first worker => process number == 0
-        for i,f_n in enumerate(_smash_.workers):
-            f = f_n[0]
-            fname = f_n[1]
-            p = Process(target=_smash_.worker_wrap,args=(i,f,fname))
-            p.start()
-            _smash_.all_procs.append(p)
 
-        _smash_.supervisor(_smash_.steps)
+        if listen:
+            exitcodes = _smash_.coordinate(listen,_smash_.barrier)
+        else:
+            # connections to the shared object must not be inherited by the workers
+            _smash_.shared_object.close()
+
+            # first worker => process number == 0
+            _smash_.start_workers(range(len(_smash_.workers)),worker_mode)
 
-        for p in _smash_.all_procs:
-            p.join()
+            _smash_.supervisor()
+
+            exitcodes = _smash_.join_workers(worker_mode)
 
         total_duration = time.time() - t1
+
+        if config.get('engine_barrier','flat') == 'tree':
+            _smash_.report_arrival_spreads()
+
         returncode = 0
-        for p in _smash_.all_procs:
-           if p.exitcode != 0:
-              returncode = p.exitcode
+        for wi in sorted(exitcodes):
+           if _smash_.timeout_action == 'skip' and wi in _smash_.late:
+              continue # the late workers were dropped from the test on purpose
+           if exitcodes[wi]:
+              returncode = exitcodes[wi]
               break
 
-        smashbox.utilities.finalize_test(returncode, total_duration)
+        if returncode == 0 and (_smash_.dead or _smash_.test_overrun or (_smash_.late and _smash_.timeout_action == 'abort')):
+           returncode = 1
+
+        if _smash_.overruns or _smash_.dead or _smash_.step_timeout or _smash_.test_timeout:
+           from smashbox.utilities.monitoring import commit_to_monitoring
+           commit_to_monitoring('step_overruns',_smash_.overruns)
+           commit_to_monitoring('dead_workers',len(_smash_.dead))
+
+        with smashbox.tracing.span('finalize_test'):
+            smashbox.utilities.finalize_test(returncode, total_duration)
+
+        if smashbox.tracing.enabled:
+            _smash_.write_trace()
 
         if returncode != 0:
             import sys
             sys.exit(returncode)
 
-def add_worker(f,name=None):
-    """ Decorator for worker functions in the user-defined test
-    scripts: workers execute in parallel and may use 'step(N)' syntax
-    to define synchronization points.
-    """
-    _smash_.workers.append((f,name))
+    @staticmethod
+    def run_agent():
+        """ Run this agent's share of the workers of the test served by the coordinator.
+        """
+        manager,coordinator,rank,job = _smash_.agent
 
-    
-if __name__ == "__main__":
+        worker_mode = _smash_.get_worker_mode()
 
-    import smashbox.compatibility.argparse
-    import smashbox.script
+        if len(_smash_.workers) != job['nworkers']:
+            raise ValueError('agent has %d workers but coordinator expects %d'%(len(_smash_.workers),job['nworkers']))
 
-    # let's use _smash_ namespace to avoid name pollution...
-    _smash_.parser = smashbox.compatibility.argparse.ArgumentParser()
-    _smash_.parser.add_argument('test_target')
-    _smash_.parser.add_argument('config_blob')
+        _smash_.barrier = manager.get_barrier()
+        _smash_.shared_object = manager.get_store()
 
-    _smash_.args = _smash_.parser.parse_args()
+        _smash_.worker.process_name = "agent%d"%rank
+
+        indices = [i for i in range(job['nworkers']) if i % job['nagents'] == rank]
+
+        logger.info('agent %d running workers %s',rank,indices)
+
+        # proxies must not be shared with the workers: each worker process or thread opens its own connection
+        _smash_.start_workers(indices,worker_mode)
+
+        exitcodes = _smash_.join_workers(worker_mode)
 
-    # this is OK: config and logger will be visible symbols in the user's test code
-    config = smashbox.script.configure_from_blob(_smash_.args.config_blob)
+        # release the proxies while the coordinator is still waiting for the report (it may exit right after)
+        _smash_.barrier = _smash_.shared_object = _smash_.agent = None
+        del manager
 
-    import smashbox.utilities.reflection
-    smashbox.utilities.reflection._smash_ = _smash_
+        coordinator.report(rank,exitcodes)
+        del coordinator
 
+        for exitcode in exitcodes.values():
+           if exitcode:
+              import sys
+              sys.exit(exitcode)
+
+    @staticmethod
     def getLogger():
        import logging
        import os.path
@@ -273,6 +673,8 @@ if __name__ == "__main__":
        logger.addFilter(SmashFilter())
 
        logdir,logfn = os.path.split(config.rundir)
+       if _smash_.agent:
+          logfn += '-agent%d'%_smash_.agent[2]
        try:
           fh = logging.FileHandler(os.path.join(logdir,'log-'+logfn+'.log'),mode='w')
        except IOError:
@@ -292,30 +694,169 @@ if __name__ == "__main__":
        logger.addHandler(fh)
        logger.propagate=False
        return logger
-    
-    try:
-       import os
-       os.makedirs(config.rundir)
-    except OSError,x:
-       import errno
-       if x.errno != errno.EEXIST:
-          raise
-
-    logger = getLogger()
-
-    import logging
-    smashbox.script.config_log(logging.DEBUG)
-    
-    logger.info('BEGIN SMASH RUN - rundir: %s',config.rundir)
 
-    smashbox.utilities.logger = logger
-    
-    # load test case file directly into the global namespace of this script
-    execfile(_smash_.args.test_target)
+    @staticmethod
+    def main():
+        """ Run the test defined by _smash_.args (or fetched from the coordinator by an agent).
+        """
+        # this is OK: config and logger will be visible symbols in the user's test code
+        global config, logger
 
-    # start the framework and dispatch workers
-    _smash_.run()
+        import smashbox.script
 
+        if _smash_.args.agent:
+           import smashbox.coordinator
+           _smash_.agent = smashbox.coordinator.connect(_smash_.args.agent,os.environ['SMASHBOX_ENGINE_AUTHKEY'])
+           _smash_.args.test_target = _smash_.agent[3]['test_target']
+           _smash_.args.config_blob = _smash_.agent[3]['config']
+        else:
+           _smash_.agent = None
+
+        config = smashbox.script.configure_from_blob(_smash_.args.config_blob)
+
+        import smashbox.tracing
+        smashbox.tracing.enabled = bool(config.get('engine_trace',False))
+
+        _smash_.configure_timeouts()
+
+        import smashbox.utilities.reflection
+        smashbox.utilities.reflection._smash_ = _smash_
+
+        try:
+           os.makedirs(config.rundir)
+        except OSError,x:
+           import errno
+           if x.errno != errno.EEXIST:
+              raise
+
+        logger = _smash_.getLogger()
+
+        import logging
+        smashbox.script.config_log(logging.DEBUG)
+
+        logger.info('BEGIN SMASH RUN - rundir: %s',config.rundir)
+
+        smashbox.utilities.logger = logger
+
+        # load test case file directly into the global namespace of this script
+        if _smash_.agent:
+           # the agent runs the exact test source of the coordinator: the file may not exist on this host
+           exec compile(_smash_.agent[3]['source'],_smash_.args.test_target,'exec') in globals()
+
+           _smash_.run_agent()
+        else:
+           execfile(_smash_.args.test_target,globals())
+
+           # start the framework and dispatch workers
+           _smash_.run()
+
+    @staticmethod
+    def serve(rfd,wfd):
+        """ Warm engine: run the tests received as pickled (test_target,config_blob,agent) tuples on file descriptor rfd,
+        one after another, and write back their pickled exit codes to file descriptor wfd. Each test runs in a child
+        forked from this process so the heavy modules are imported only once. Return when rfd is closed.
+        """
+        import pickle
+        import sys
+
+        # modules which keep a reference to the logger at import time (hash_files, curl) must not be imported here
+        import smashbox.script
+        import smashbox.utilities
+        import smashbox.utilities.reflection
+        import smashbox.barrier
+        import smashbox.shared_store
+        import smashbox.coordinator
+        import multiprocessing
+        import sqlite3
+        import logging
+
+        for m in ['owncloud','pycurl']:
+            try:
+                __import__(m)
+            except ImportError:
+                pass
+
+        jobs = os.fdopen(rfd,'rb')
+        results = os.fdopen(wfd,'wb')
+
+        while True:
+            try:
+                job = pickle.load(jobs)
+            except EOFError:
+                break
+
+            pid = os.fork()
+
+            if pid == 0:
+                jobs.close()
+                results.close()
+
+                _smash_.args.test_target,_smash_.args.config_blob,_smash_.args.agent = job
+
+                exitcode = 0
+                try:
+                    try:
+                        _smash_.main()
+                    except SystemExit,x:
+                        exitcode = x.code
+                        if exitcode is None:
+                            exitcode = 0
+                        elif not isinstance(exitcode,int):
+                            print >> sys.stderr, exitcode
+                            exitcode = 1
+                    except:
+                        import traceback
+                        traceback.print_exc()
+                        exitcode = 1
+                finally:
+                    logging.shutdown()
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    os._exit(exitcode & 0xff)
+
+            pid,status = os.waitpid(pid,0)
+
+            if os.WIFSIGNALED(status):
+                returncode = -os.WTERMSIG(status)
+            else:
+                returncode = os.WEXITSTATUS(status)
+
+            pickle.dump(returncode,results)
+            results.flush()
+
+def add_worker(f,name=None,group=None):
+    """ Decorator for worker functions in the user-defined test
+    scripts: workers execute in parallel and may use 'step(N)' syntax
+    to define synchronization points.
+
+    Workers may be put in named groups: then step(N) waits only for
+    the workers of the same group (workers without a group form the
+    group 'default') and step_all(N) waits for all the workers. If no
+    group is used, step(N) waits for all the workers.
+    """
+    _smash_.workers.append((f,name))
+    _smash_.groups.append(group)
+
+def step_all(i,message="",timeout=None):
+    """ Like step(i) in a worker function but wait for the workers of all the groups (see add_worker()).
+    """
+    _smash_._step(i,_smash_.worker.process_number,message,timeout,everyone=True)
 
     
-    
+if __name__ == "__main__":
+
+    import smashbox.compatibility.argparse
+
+    # let's use _smash_ namespace to avoid name pollution...
+    _smash_.parser = smashbox.compatibility.argparse.ArgumentParser()
+    _smash_.parser.add_argument('test_target',nargs='?')
+    _smash_.parser.add_argument('config_blob',nargs='?')
+    _smash_.parser.add_argument('--agent',metavar='HOST:PORT',default=None,help='fetch the test from the coordinator at HOST:PORT and run a share of its workers (the authkey is passed in SMASHBOX_ENGINE_AUTHKEY environment variable)')
+    _smash_.parser.add_argument('--serve',metavar=('RFD','WFD'),nargs=2,type=int,default=None,help='keep running as a warm engine: read tests from file descriptor RFD and write their exit codes to WFD')
+
+    _smash_.args = _smash_.parser.parse_args()
+
+    if _smash_.args.serve:
+       _smash_.serve(*_smash_.args.serve)
+    else:
+       _smash_.main()
@@ -1,5 +1,5 @@
 
-def add_worker(f,name=None):
+def add_worker(f,name=None,group=None):
    return f
 
 import logging
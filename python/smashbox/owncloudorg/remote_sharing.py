@@ -17,8 +17,7 @@ def remote_share_file_with_user(filename, sharer, sharee, **kwargs):
 
     logger.info('%s is sharing file %s with user %s', sharer, filename, sharee)
 
-    oc_api = get_oc_api()
-    oc_api.login(sharer, config.oc_account_password)
+    oc_api = get_oc_api(user=sharer)
 
     kwargs.setdefault('remote_user', True)
     sharee = "%s@%s" % (sharee, oc_api.url)
@@ -42,8 +41,7 @@ def list_open_remote_share(sharee):
     """
     logger.info('Listing remote shares for user %s', sharee)
 
-    oc_api = get_oc_api()
-    oc_api.login(sharee, config.oc_account_password)
+    oc_api = get_oc_api(user=sharee)
     try:
         open_remote_shares = oc_api.list_open_remote_share()
     except HTTPResponseError as err:
@@ -65,8 +63,7 @@ def accept_remote_share(sharee, share_id):
     """
     logger.info('Accepting share %i for user %s', share_id, sharee)
 
-    oc_api = get_oc_api()
-    oc_api.login(sharee, config.oc_account_password)
+    oc_api = get_oc_api(user=sharee)
     error_check(oc_api.accept_remote_share(share_id), 'Accepting remote share failed')
 
 
@@ -79,6 +76,5 @@ def decline_remote_share(sharee, share_id):
     """
     logger.info('Declining share %i from user %s', share_id, sharee)
 
-    oc_api = get_oc_api()
-    oc_api.login(sharee, config.oc_account_password)
+    oc_api = get_oc_api(user=sharee)
     error_check(oc_api.decline_remote_share(share_id), 'Accepting remote share failed')
\ No newline at end of file
@@ -0,0 +1,144 @@
+# The _open_SmashBox Project.
+#
+# License: AGPL
+#
+# Concurrent execution of independent test runs (smash --jobs N).
+
+import threading
+import time
+
+
+class TestRun:
+    """ One execution of a test: a test file in a given loop iteration and testset with its own config.
+
+    An exclusive run touches global server state (server log, apps,
+    locks...) and never runs concurrently with other runs.
+    """
+
+    def __init__(self, name, test, loop, testset, config, exclusive=False):
+        self.name = name
+        self.test = test
+        self.loop = loop
+        self.testset = testset
+        self.config = config
+        self.exclusive = exclusive
+
+        self.slot = None
+        self.returncode = None
+        self.t0 = None
+        self.t1 = None
+
+    def duration(self):
+        if self.t0 is None or self.t1 is None:
+            return None
+        return self.t1 - self.t0
+
+
+class Scheduler:
+    """ Run test runs on njobs slots, in order.
+
+    execute(run,slot) is called in the thread of the slot and returns
+    the exit code of the run. A slot runs one test at a time so the
+    caller may keep per-slot resources (e.g. a warm engine). An
+    exclusive run waits until all the running ones are finished and
+    holds back the following ones until it is finished itself.
+
+    If stop_on_failure is set then no new run is started after a run
+    failed; the runs already started are completed.
+    """
+
+    def __init__(self, njobs, execute, stop_on_failure=False):
+        self.njobs = njobs
+        self.execute = execute
+        self.stop_on_failure = stop_on_failure
+
+    def run(self, runs):
+        """ Execute the runs and return them with returncode, t0, t1 and slot set (runs never started keep returncode None).
+        """
+        self._runs = runs
+        self._next = 0
+        self._running = 0
+        self._exclusive = False
+        self._stopped = False
+        self._cond = threading.Condition()
+
+        slots = [threading.Thread(target=self._slot, args=(i,), name='slot%d' % i) for i in range(min(self.njobs, len(runs)))]
+        for t in slots:
+            t.daemon = True
+            t.start()
+
+        # join with a timeout so that KeyboardInterrupt is delivered to the main thread
+        for t in slots:
+            while t.is_alive():
+                t.join(1)
+
+        return runs
+
+    def _take(self):
+        self._cond.acquire()
+        try:
+            while True:
+                if self._stopped or self._next >= len(self._runs):
+                    return None
+                r = self._runs[self._next]
+                if (r.exclusive and self._running == 0) or (not r.exclusive and not self._exclusive):
+                    break
+                self._cond.wait()
+
+            self._next += 1
+            self._running += 1
+            self._exclusive = r.exclusive
+            return r
+        finally:
+            self._cond.release()
+
+    def _done(self, r):
+        self._cond.acquire()
+        try:
+            self._running -= 1
+            if r.exclusive:
+                self._exclusive = False
+            if r.returncode and self.stop_on_failure:
+                self._stopped = True
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+    def _slot(self, slot):
+        while True:
+            r = self._take()
+            if r is None:
+                return
+
+            r.slot = slot
+            r.t0 = time.time()
+            try:
+                r.returncode = self.execute(r, slot)
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                r.returncode = 1
+            r.t1 = time.time()
+
+            self._done(r)
+
+
+def summary(runs, wall_time):
+    """ Lines of text with the exit code and duration of each run and the totals.
+    """
+    lines = ['%-60s %6s %10s %5s' % ('run', 'exit', 'time [s]', 'slot')]
+
+    for r in runs:
+        if r.returncode is None:
+            lines.append('%-60s %6s %10s %5s' % (r.name, '-', '-', '-'))
+        else:
+            lines.append('%-60s %6d %10.1f %5d' % (r.name, r.returncode, r.duration(), r.slot))
+
+    finished = [r for r in runs if r.returncode is not None]
+    failed = [r for r in finished if r.returncode != 0]
+    busy = sum([r.duration() for r in finished])
+
+    lines.append('%d run(s): %d passed, %d failed, %d not started; wall time %.1fs, sum of run times %.1fs (x%.1f)' %
+                 (len(runs), len(finished)-len(failed), len(failed), len(runs)-len(finished), wall_time, busy, busy/wall_time if wall_time else 0))
+
+    return lines
@@ -44,8 +44,8 @@ config = Configuration()
 
 def configure_from_blob(config_blob):
     import pickle
-    global config
-    config = pickle.loads(config_blob)
+    # update in place: modules imported before (e.g. by the warm engine) hold a reference to this object
+    config.__dict__.update(pickle.loads(config_blob).__dict__)
     config_log(level=logging.DEBUG)
     return config
 
@@ -0,0 +1,202 @@
+# The _open_SmashBox Project.
+#
+# License: AGPL
+#
+# Shared state of the worker processes of a test run.
+#
+# The values are pickled into a local sqlite database. Every process
+# (and thread) opens its own connection, the database runs in WAL mode
+# so readers do not block writers and every update is a single
+# transaction: there are no read-modify-write races between workers.
+
+import os
+import pickle
+import threading
+import time
+
+
+class SharedStore:
+    """ Dictionary-like store shared between workers.
+
+    A value assigned with store[key]=value is visible to all workers as
+    soon as the assignment returns. Concurrent updates of the same key
+    should use append() or compare_and_swap() which are atomic.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connect()
+
+    def _connect(self):
+        import sqlite3
+
+        local = self._local
+        if getattr(local, 'pid', None) == os.getpid():
+            return local.db
+
+        # a connection must never be used (or closed) across fork: keep the inherited one as-is
+        d = os.path.dirname(self.path)
+        if d and not os.path.isdir(d):
+            try:
+                os.makedirs(d)
+            except OSError:
+                if not os.path.isdir(d):
+                    raise
+
+        db = sqlite3.connect(self.path, timeout=600, isolation_level=None, check_same_thread=False)
+        db.text_factory = str
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=OFF')
+        db.execute('CREATE TABLE IF NOT EXISTS objects (key TEXT PRIMARY KEY, value BLOB)')
+        db.execute('CREATE TABLE IF NOT EXISTS items (seq INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT, value BLOB)')
+        db.execute('CREATE INDEX IF NOT EXISTS items_key ON items (key, seq)')
+
+        local.db = db
+        local.pid = os.getpid()
+        return db
+
+    def close(self):
+        """ Close the connection of the calling thread. It is reopened on next access.
+        """
+        local = self._local
+        if getattr(local, 'pid', None) == os.getpid():
+            local.db.close()
+        local.pid = None
+        local.db = None
+
+    def _transaction(self, mode=''):
+        db = self._connect()
+        db.execute('BEGIN %s' % mode)
+        return db
+
+    @staticmethod
+    def _dumps(val):
+        import sqlite3
+        return sqlite3.Binary(pickle.dumps(val, pickle.HIGHEST_PROTOCOL))
+
+    @staticmethod
+    def _loads(blob):
+        return pickle.loads(str(blob))
+
+    def _get(self, db, key):
+        row = db.execute('SELECT value FROM objects WHERE key=?', (key,)).fetchone()
+        if row is not None:
+            return self._loads(row[0])
+
+        rows = db.execute('SELECT value FROM items WHERE key=? ORDER BY seq', (key,)).fetchall()
+        if rows:
+            return [self._loads(r[0]) for r in rows]
+
+        raise AttributeError(key)
+
+    def _set(self, db, key, val):
+        db.execute('DELETE FROM items WHERE key=?', (key,))
+        db.execute('INSERT OR REPLACE INTO objects (key, value) VALUES (?, ?)', (key, self._dumps(val)))
+
+    def __getitem__(self, key):
+        db = self._transaction()
+        try:
+            return self._get(db, key)
+        finally:
+            db.execute('COMMIT')
+
+    def __setitem__(self, key, val):
+        db = self._transaction('IMMEDIATE')
+        try:
+            self._set(db, key, val)
+        except:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def __delitem__(self, key):
+        db = self._transaction('IMMEDIATE')
+        try:
+            db.execute('DELETE FROM objects WHERE key=?', (key,))
+            db.execute('DELETE FROM items WHERE key=?', (key,))
+        except:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def __contains__(self, key):
+        db = self._connect()
+        return db.execute('SELECT 1 FROM objects WHERE key=? UNION ALL SELECT 1 FROM items WHERE key=? LIMIT 1', (key, key)).fetchone() is not None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except AttributeError:
+            return default
+
+    def append(self, key, val):
+        """ Atomically append val to the list stored under key (an empty list is assumed if key is not set).
+
+        The cost does not depend on the length of the list.
+        """
+        db = self._transaction('IMMEDIATE')
+        try:
+            row = db.execute('SELECT value FROM objects WHERE key=?', (key,)).fetchone()
+            if row is not None:
+                # the list was assigned as a whole: convert it into items first
+                items = self._loads(row[0])
+                if not isinstance(items, list):
+                    raise TypeError('cannot append to %s: %s is not a list' % (repr(key), type(items).__name__))
+                db.execute('DELETE FROM objects WHERE key=?', (key,))
+                db.executemany('INSERT INTO items (key, value) VALUES (?, ?)', [(key, self._dumps(x)) for x in items])
+            db.execute('INSERT INTO items (key, value) VALUES (?, ?)', (key, self._dumps(val)))
+        except:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def compare_and_swap(self, key, expected, val):
+        """ Atomically set key to val if its current value equals expected (None matches a key which is not set).
+
+        Return True if the value was set.
+        """
+        db = self._transaction('IMMEDIATE')
+        try:
+            try:
+                current = self._get(db, key)
+            except AttributeError:
+                current = None
+
+            swapped = current == expected
+            if swapped:
+                self._set(db, key, val)
+        except:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+        return swapped
+
+    def wait_for(self, key, timeout=None):
+        """ Block until key is set by some worker and return its value.
+
+        Raise AttributeError if key is still not set after timeout seconds.
+        """
+        t0 = time.time()
+        delay = 0.001
+        while True:
+            try:
+                return self[key]
+            except AttributeError:
+                if timeout is not None and time.time()-t0 > timeout:
+                    raise AttributeError('%s not set within %s seconds' % (key, timeout))
+            time.sleep(delay)
+            delay = min(delay*2, 0.1)
+
+    def keys(self):
+        db = self._connect()
+        return [r[0] for r in db.execute('SELECT key FROM objects UNION SELECT DISTINCT key FROM items')]
+
+    def dict(self):
+        keys = {}
+        for a in self.keys():
+            keys[a] = self.get(a)
+        return keys
+
+    def __str__(self):
+        return repr(self.dict())
@@ -0,0 +1,118 @@
+# The _open_SmashBox Project.
+#
+# License: AGPL
+#
+# Timing trace of a test run in Chrome trace event format (load the
+# trace-<test>.json file in chrome://tracing or https://ui.perfetto.dev).
+#
+# Each worker (and the supervisor) is a separate track. Spans are
+# recorded with the span() context manager or decorator; spans which
+# are nested in time show up nested in the viewer:
+#
+#   @tracing.span('create_files')
+#   def create_files(...):
+#       ...
+#
+#   with tracing.span('PUT', url=url):
+#       ...
+#
+# Tracing is off unless the engine sets enabled (engine_trace option),
+# then a disabled span costs one attribute lookup.
+
+import functools
+import json
+import threading
+import time
+
+enabled = False
+
+_local = threading.local()
+
+
+def _events():
+    try:
+        return _local.events
+    except AttributeError:
+        _local.events = []
+        return _local.events
+
+
+def record(name, t0, t1, cat='smashbox', args=None):
+    """ Record a complete span of the current worker (times as returned by time.time()).
+    """
+    if not enabled:
+        return
+
+    e = {'name': name, 'cat': cat, 'ph': 'X', 'ts': int(t0*1e6), 'dur': int((t1-t0)*1e6)}
+    if args:
+        e['args'] = args
+    _events().append(e)
+
+
+class span(object):
+    """ Record the execution time of a block (context manager) or of each call of a function (decorator).
+
+    Keyword arguments are shown as arguments of the span in the viewer.
+    """
+
+    def __init__(self, name, cat='smashbox', **args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.t0 = None
+
+    def __enter__(self):
+        if enabled:
+            self.t0 = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.t0 is not None:
+            args = self.args
+            if exc_type is not None:
+                args = dict(args, exception=repr(exc_value))
+            record(self.name, self.t0, time.time(), self.cat, args)
+            self.t0 = None
+
+    def __call__(self, f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwds):
+            if not enabled:
+                return f(*args, **kwds)
+            with span(self.name, self.cat, **self.args):
+                return f(*args, **kwds)
+        return wrapper
+
+
+def reset():
+    """ Forget the events recorded in the current thread (a forked worker inherits those of the supervisor).
+    """
+    _local.events = []
+
+
+def collect(tid, thread_name):
+    """ Return the events recorded so far in the current thread as trace events of track tid and forget them.
+    """
+    events = _events()
+    _local.events = []
+
+    for e in events:
+        e['pid'] = 0
+        e['tid'] = tid
+
+    events.append({'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': tid, 'args': {'name': thread_name}})
+    events.append({'name': 'thread_sort_index', 'ph': 'M', 'pid': 0, 'tid': tid, 'args': {'sort_index': tid}})
+    return events
+
+
+def write(path, events, process_name):
+    """ Write the trace file.
+    """
+    events = list(events)
+    events.append({'name': 'process_name', 'ph': 'M', 'pid': 0, 'args': {'name': process_name}})
+
+    f = open(path, 'w')
+    try:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    finally:
+        f.close()
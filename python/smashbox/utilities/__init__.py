@@ -6,8 +6,20 @@ import subprocess
 import time
 import requests
 import glob
+import shlex
 
 # Utilities to be used in the test-cases.
+from smashbox.utilities import reflection
+from smashbox.utilities import webdav
+from smashbox.utilities import hashing
+from smashbox.utilities import ocsync
+from smashbox.utilities import capabilities
+from smashbox.utilities import account_pool
+from smashbox.utilities import oc_sessions
+from smashbox.utilities import server_logs
+from smashbox.utilities import diagnostics
+from smashbox.utilities import propagation
+from smashbox import tracing
 from smashbox.utilities.version import version_compare
 from smashbox.utilities.monitoring import push_to_monitoring
 
@@ -19,12 +31,9 @@ def compare_oc_version(compare_to, operator):
     :param operator: One of '<', '=', '>', '<=', '>='
     :return:
     """
-    oc_api = get_oc_api()
-    url = oc_api.url + 'status.php'
-    rtn_code, std_out, std_err = runcmd('curl %s' % url, log_warning=False)
-
-    import json
-    version = (json.loads(std_out))['version']
+    version = get_capabilities()['version']
+    if version is None:
+        raise ValueError('version of the server unknown: status.php of %s failed' % config.oc_server)
 
     return version_compare(version, operator, compare_to)
 
@@ -36,17 +45,54 @@ def compare_client_version(compare_to, operator):
     :param operator: One of '<', '=', '>', '<=', '>='
     :return:
     """
+    version = get_capabilities()['client_version']
+    if version is None:
+        raise ValueError('version of the client unknown: %s --version failed' % config.oc_sync_cmd)
 
-    cmd = config.oc_sync_cmd
-    cmd = cmd[:cmd.find(' --')]
-    cmd += ' --version'
-    rtn_code, std_out, std_err = runcmd(cmd)
+    return version_compare(version, operator, compare_to)
 
-    version = std_out[std_out.find(' version ') + 9:]
-    if version[-4:-1] == 'git':
-        version = version[:-4]
 
-    return version_compare(version, operator, compare_to)
+def get_capabilities():
+    """ The capabilities of the server and the client (see capabilities.probe_server()) with the version of the client
+    (client_version). Taken by setup_test() for all the workers: no request is sent again.
+    """
+    snapshot = getattr(config, '_capabilities', None)
+    if snapshot is None:
+        snapshot = take_capabilities_snapshot()
+    return snapshot
+
+
+def take_capabilities_snapshot():
+    """ Probe the server and the client, or reuse the snapshot saved in smashdir by a previous test if it is not older
+    than oc_capabilities_cache_ttl seconds, and make it the snapshot of the test (config._capabilities).
+    """
+    url = get_oc_api().url
+    args = shlex.split(config.oc_sync_cmd)
+    key = [url, config.oc_admin_user, args[0]]
+    path = os.path.join(config.smashdir, capabilities.CACHE_FILE)
+    ttl = config.get('oc_capabilities_cache_ttl', 3600)
+
+    snapshot = None
+    if ttl:
+        snapshot = capabilities.load(path, key, ttl)
+
+    if snapshot is None:
+        t0 = time.time()
+
+        snapshot = capabilities.probe_server(url, config.oc_admin_user, config.oc_admin_password)
+
+        snapshot['client_version'] = None
+        if os.path.isfile(args[0]) or any(os.path.isfile(os.path.join(d, args[0])) for d in os.environ.get('PATH', '').split(os.pathsep)):
+            rtn_code, std_out, std_err = runcmd([args[0], '--version'], shell=False, ignore_exitcode=True, echo=False, log_warning=False, timeout=60)
+            snapshot['client_version'] = capabilities.parse_client_version(std_out)
+
+        logger.info('capabilities: server %s, dav endpoints %s, checksums %s, client %s (probed in %.2fs)', snapshot['versionstring'], snapshot['dav_endpoints'], snapshot['checksums'], snapshot['client_version'], time.time() - t0)
+
+        if ttl and snapshot['version'] is not None: # not an unreachable server
+            capabilities.save(path, key, snapshot)
+
+    config._capabilities = snapshot
+    return snapshot
 
 
 def OWNCLOUD_CHUNK_SIZE(factor=1):
@@ -68,6 +114,7 @@ def setup_test():
     If exception is raised then the testcase execution is aborted and smashbox terminates with non-zero exit code,
 
     """
+    take_capabilities_snapshot()
     reset_owncloud_account(num_test_users=config.oc_number_test_users)
     reset_rundir()
     reset_server_log_file()
@@ -85,7 +132,14 @@ def finalize_test(returncode, total_duration):
     """
     d = make_workdir()
     scrape_log_file(d)
+    report_sync_metrics()
+    report_diagnostic_log()
+    report_propagation()
+    report_setup_time()
+    report_account_lease()
+    release_owncloud_account()
     push_to_monitoring(returncode, total_duration)
+    wait_background_removals()
 
 ######### HELPERS
 
@@ -114,17 +168,20 @@ def reset_owncloud_account(reset_procedure=None, num_test_users=None):
         logger.info('reset_owncloud_account (%s) for %d users', reset_procedure, num_test_users)
 
     if reset_procedure == 'delete':
-        delete_owncloud_account(config.oc_account_name)
-        create_owncloud_account(config.oc_account_name, config.oc_account_password)
-        login_owncloud_account(config.oc_account_name, config.oc_account_password)
-
+        usernames = [config.oc_account_name]
         if num_test_users is not None:
-            for i in range(1, num_test_users + 1):
-                username = "%s%i" % (config.oc_account_name, i)
-                delete_owncloud_account(username)
-                create_owncloud_account(username, config.oc_account_password)
-                login_owncloud_account(username, config.oc_account_password)
+            usernames += ["%s%i" % (config.oc_account_name, i) for i in range(1, num_test_users + 1)]
 
+        def reset_user(username):
+            delete_owncloud_account(username)
+            create_owncloud_account(username, config.oc_account_password)
+            login_owncloud_account(username, config.oc_account_password)
+
+        _provision('reset_owncloud_account', reset_user, usernames)
+        return
+
+    if reset_procedure == 'pool':
+        lease_owncloud_account(num_test_users)
         return
 
     if reset_procedure == 'webdav_delete':
@@ -135,6 +192,173 @@ def reset_owncloud_account(reset_procedure=None, num_test_users=None):
     webdav_mkcol('/')
 
 
+_account_lease = None # the account of the pool leased by setup_test()
+
+def _account_pool():
+    return account_pool.AccountPool(os.path.join(config.smashdir, 'account-pool.db'), int(config.get('oc_account_pool_size', 4)))
+
+
+def lease_owncloud_account(num_test_users=None):
+    """ Lease an account of the account pool for the test (oc_account_reset_procedure = "pool") and make it the account of
+    the test (config.oc_account_name). The account and its test users are empty. Missing test users are created.
+
+    The account is released by release_owncloud_account() at the end of the test. A worker calling this again
+    (reset_owncloud_account()) keeps the account leased by setup_test() and only adds the missing test users. The lease
+    is passed to the workers in config._account_lease: the workers run by the agents (engine_listen) use the account
+    leased by the coordinator too.
+    """
+    global _account_lease
+
+    naccounts = 1 + (num_test_users or 0)
+
+    pool = _account_pool()
+
+    if _account_lease is not None and _account_lease['rundir'] != config.rundir:
+        # leased by a test of this engine process which did not finish
+        release_owncloud_account()
+
+    sent = config.get('_account_lease', None)
+    if _account_lease is None and sent is not None and sent['rundir'] == config.rundir:
+        # a worker of an agent: the pool of this host does not know the slot, the coordinator releases it
+        lease = sent
+    elif _account_lease is None:
+        prefix = config.get('oc_account_pool_prefix', 'smashbox-pool')
+
+        lease = pool.lease(naccounts, config.get('oc_account_lease_timeout', 3600))
+        lease['name'] = account_pool.account_name(prefix, lease['slot'])
+        lease['rundir'] = config.rundir
+
+        logger.info('account pool: leased %s after waiting %.2fs (%d accounts in the pool, %d were free)', lease['name'], lease['wait'], lease['size'], lease['free'])
+        if lease['wipe_error']:
+            logger.warning('account pool: wiping %s after its previous test failed: %s', lease['name'], lease['wipe_error'])
+
+        config.oc_account_name = lease['name']
+        config._account_lease = _account_lease = lease
+
+        if lease['stale']:
+            # left over by a test which was killed
+            _wipe_owncloud_accounts(lease['accounts'])
+    else:
+        lease = _account_lease
+
+    if lease['accounts'] < naccounts:
+        def reset_user(i):
+            username = webdav.account(i or None)[0]
+            delete_owncloud_account(username)
+            create_owncloud_account(username, config.oc_account_password)
+            login_owncloud_account(username, config.oc_account_password)
+
+        _provision('lease_owncloud_account', reset_user, range(lease['accounts'], naccounts))
+        lease['accounts'] = naccounts
+        if lease is _account_lease:
+            pool.set_accounts(lease['slot'], naccounts)
+        else:
+            reflection.getSharedObject().append('account_pool_accounts', naccounts) # recorded by the coordinator
+
+
+def _wipe_owncloud_accounts(naccounts):
+    """ Empty the first naccounts accounts of the test (the main account and its test users) for the next test: delete
+    the shares they created, remove them from their groups, delete their files and purge their trashbin (with the
+    versions of the deleted files).
+    """
+    import owncloud
+
+    user_nums = [i or None for i in range(naccounts)]
+
+    def unshare(user_num):
+        try:
+            shares = get_oc_api(user=webdav.account(user_num)[0]).get_shares()
+        except owncloud.HTTPResponseError, x:
+            if x.status_code == 404:
+                return [] # no sharing app
+            raise
+        return [(user_num, share.get_id()) for share in shares or []]
+
+    shares = sum(webdav.map_concurrently(unshare, user_nums), [])
+    webdav.map_concurrently(lambda (user_num, share_id): get_oc_api(user=webdav.account(user_num)[0]).delete_share(share_id), shares)
+
+    def groups(user_num):
+        username = webdav.account(user_num)[0]
+        return [(username, group) for group in get_oc_admin_api().get_user_groups(username)]
+
+    memberships = sum(webdav.map_concurrently(groups, user_nums), [])
+    webdav.map_concurrently(lambda (username, group): get_oc_admin_api().remove_user_from_group(username, group), memberships)
+
+    def ls(user_num):
+        entries = webdav_propfind('/', 1, user_num) or [] # None if not created yet
+        return [(user_num, e['path']) for e in entries[1:]]
+
+    paths = sum(webdav.map_concurrently(ls, user_nums), [])
+    webdav.map_concurrently(lambda (user_num, path): webdav_delete(path, user_num), paths)
+
+    webdav.map_concurrently(webdav.purge_trashbin, user_nums)
+
+
+def report_account_lease():
+    """ Commit to monitoring how the account of the test was leased from the account pool (if it was).
+    This is run under the name of the "supervisor" worker.
+    """
+    lease = _account_lease
+    if lease is None:
+        return
+
+    from smashbox.utilities.monitoring import commit_to_monitoring
+    commit_to_monitoring('account_lease_wait', lease['wait'])
+    commit_to_monitoring('account_pool_size', lease['size'])
+    commit_to_monitoring('account_pool_free', lease['free'])
+    if lease['wipe_duration'] is not None:
+        commit_to_monitoring('account_wipe_duration', lease['wipe_duration']) # of the previous test of this account
+
+
+def release_owncloud_account():
+    """ Return the account leased by lease_owncloud_account() to the account pool: it is emptied (see
+    _wipe_owncloud_accounts()) by a background process which does not delay the end of the test.
+    This is run under the name of the "supervisor" worker.
+    """
+    global _account_lease
+
+    lease = _account_lease
+    if lease is None:
+        return
+    _account_lease = config._account_lease = None
+
+    pool = _account_pool()
+
+    shared = reflection.getSharedObject()
+    added = shared is not None and shared.get('account_pool_accounts')
+    if added:
+        # test users added by the workers of the agents
+        pool.set_accounts(lease['slot'], max(added))
+
+    # the wiper is the child of a child which exits at once: it is never a zombie and outlives this process
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(r)
+            os.setsid()
+            if os.fork() == 0:
+                naccounts = pool.wiping(lease['slot']) # workers may have added test users
+                os.close(w)
+
+                t0 = time.time()
+                error = None
+                try:
+                    _wipe_owncloud_accounts(naccounts)
+                except Exception, x:
+                    error = str(x) or repr(x)
+                pool.wiped(lease['slot'], time.time() - t0, error)
+        finally:
+            os._exit(0)
+
+    os.close(w)
+    os.waitpid(pid, 0)
+    os.read(r, 1) # until the wiper owns the slot
+    os.close(r)
+
+    logger.info('account pool: released %s, it is emptied in background', lease['name'])
+
+
 def reset_rundir(reset_procedure=None):
     """ Prepare the run directory for the current test (local state). Run this once at the beginning of the test.
 
@@ -154,7 +378,14 @@ def reset_rundir(reset_procedure=None):
 
     if reset_procedure == 'delete':
         assert(os.path.realpath(config.rundir).startswith(os.path.realpath(config.smashdir)))
-        remove_tree(config.rundir)
+        background = config.get('rundir_delete_in_background',True)
+
+        if background:
+            # left over by runs which were killed while deleting in background
+            for trash in glob.glob(_trash_name(config.rundir,'*')):
+                _remove_in_background(trash)
+
+        remove_tree(config.rundir,background=background)
         mkdir(config.rundir)
 
 
@@ -187,8 +418,7 @@ def create_owncloud_account(username=None, password=None):
 
     logger.info('Creating user %s with password %s', username, password)
 
-    oc_api = get_oc_api()
-    oc_api.login(config.oc_admin_user, config.oc_admin_password)
+    oc_api = get_oc_admin_api()
     oc_api.create_user(username, password)
 
 
@@ -217,9 +447,9 @@ def delete_owncloud_account(username):
     """
     logger.info('Deleting user %s', username)
 
-    oc_api = get_oc_api()
-    oc_api.login(config.oc_admin_user, config.oc_admin_password)
+    oc_api = get_oc_admin_api()
     oc_api.delete_user(username)
+    oc_sessions.discard(username)
 
 
 def check_owncloud_account(username):
@@ -230,8 +460,7 @@ def check_owncloud_account(username):
     """
     logger.info('Checking if user %s exists', username)
 
-    oc_api = get_oc_api()
-    oc_api.login(config.oc_admin_user, config.oc_admin_password)
+    oc_api = get_oc_admin_api()
     exists = oc_api.user_exists(username)
     return exists
 
@@ -249,11 +478,45 @@ def reset_owncloud_group(num_groups=None):
     if num_groups is None:
         num_groups = config.oc_number_test_groups
 
-    for i in range(1, num_groups + 1):
-        group_name = "%s%i" % (config.oc_group_name, i)
+    def reset_group(group_name):
         delete_owncloud_group(group_name)
         create_owncloud_group(group_name)
 
+    _provision('reset_owncloud_group', reset_group, ["%s%i" % (config.oc_group_name, i) for i in range(1, num_groups + 1)])
+
+
+def _provision(name, function, items):
+    """ Run function(item) for all items, oc_provisioning_concurrency at a time, and record the time it took as setup time
+    (reported by report_setup_time()). The calls share the admin session of their thread (get_oc_admin_api()).
+    """
+    concurrency = int(config.get('oc_provisioning_concurrency', 8))
+
+    t0 = time.time()
+    with tracing.span(name, items=len(items), concurrency=concurrency):
+        result = webdav.map_concurrently(function, items, concurrency)
+    elapsed = time.time() - t0
+
+    logger.info('%s: %d done in %.2fs (concurrency %d)', name, len(items), elapsed, concurrency)
+
+    shared = reflection.getSharedObject()
+    if shared is not None: # else in setup_test(), which is timed as a whole
+        shared.append('setup_times', elapsed)
+    return result
+
+
+def report_setup_time():
+    """ Commit to monitoring the time spent setting up the test: setup_test() and the users and groups set up by the workers.
+    This is run under the name of the "supervisor" worker.
+    """
+    times = reflection.getSharedObject().get('setup_times', [])
+    if not times:
+        return
+
+    logger.info('setup time: %.2fs', sum(times))
+
+    from smashbox.utilities.monitoring import commit_to_monitoring
+    commit_to_monitoring('setup_duration', sum(times))
+
 
 def check_owncloud_group(group_name):
     """ Checks if a group exists on the server
@@ -263,8 +526,7 @@ def check_owncloud_group(group_name):
     """
     logger.info('Checking if group %s exists', group_name)
 
-    oc_api = get_oc_api()
-    oc_api.login(config.oc_admin_user, config.oc_admin_password)
+    oc_api = get_oc_admin_api()
     exists = oc_api.group_exists(group_name)
     return exists
 
@@ -277,8 +539,7 @@ def delete_owncloud_group(group_name):
     """
     logger.info('Deleting group %s', group_name)
 
-    oc_api = get_oc_api()
-    oc_api.login(config.oc_admin_user, config.oc_admin_password)
+    oc_api = get_oc_admin_api()
     oc_api.delete_group(group_name)
 
 
@@ -290,8 +551,7 @@ def create_owncloud_group(group_name):
     """
     logger.info('Creating group %s', group_name)
 
-    oc_api = get_oc_api()
-    oc_api.login(config.oc_admin_user, config.oc_admin_password)
+    oc_api = get_oc_admin_api()
     oc_api.create_group(group_name)
 
 def get_conflict_files(d):
@@ -354,87 +614,480 @@ def oc_public_webdav_url(protocol='http',remote_folder="",token='',password=''):
     return protocol + '://' + creds + config.oc_server + '/' + remote_path
 
 # this is a local variable for each worker that keeps track of the repeat count for the current step
-ocsync_cnt = {}
+ocsync_cnt = reflection.WorkerLocal(dict)
 
 
 def run_ocsync(local_folder, remote_folder="", n=None, user_num=None, use_new_dav_endpoint=False):
     """ Run the ocsync for local_folder against remote_folder (or the main folder on the owncloud account if remote_folder is None).
     Repeat the sync n times. If n given then n -> config.oc_sync_repeat (default 1).
     """
-    global ocsync_cnt
-    from smashbox.utilities import reflection
-
     if n is None:
         n = config.oc_sync_repeat
 
+    for i in range(n):
+        run_ocsync_async(local_folder, remote_folder, user_num, use_new_dav_endpoint).wait()
+
+
+def run_ocsync_async(local_folder, remote_folder="", user_num=None, use_new_dav_endpoint=False):
+    """ Start the ocsync for local_folder against remote_folder in the background and return its handle (see ocsync.Sync):
+
+      wait(timeout=None): wait for the end of the sync and return the exit code of the client (None on timeout)
+      poll(): the exit code of the client or None if it is still running
+      cancel(): stop the sync
+      started, finished, duration: timing of the sync
+
+    The worker may run other syncs (e.g. of other accounts) meanwhile. The sync is logged and its metrics recorded
+    when wait() or poll() first sees it finished.
+    """
     current_step = reflection.getCurrentStep()
+    worker = reflection.getProcessName()
 
     ocsync_cnt.setdefault(current_step,0)
+    cnt = ocsync_cnt[current_step]
+    ocsync_cnt[current_step]+=1
 
     local_folder += '/' # FIXME: HACK - is a trailing slash really needed by 1.6 owncloudcmd client?
 
     # Force using old endpointif required, for owncloud client it is done by disabling chunking ng
+    # (the environment is passed to the client explicitly as workers may be threads of one process)
+    env = dict(os.environ)
     if not use_new_dav_endpoint:
-        os.environ["OWNCLOUD_CHUNKING_NG"] = "0"
-    elif "OWNCLOUD_CHUNKING_NG" in os.environ:
-        del os.environ['OWNCLOUD_CHUNKING_NG']
+        env["OWNCLOUD_CHUNKING_NG"] = "0"
+    elif "OWNCLOUD_CHUNKING_NG" in env:
+        del env['OWNCLOUD_CHUNKING_NG']
 
-    for i in range(n):
-        t0 = datetime.datetime.now()
-        cmd = config.oc_sync_cmd+' '+local_folder+' '+oc_webdav_url('owncloud',remote_folder,user_num) + " >> "+config.rundir+"/%s-ocsync.step%02d.cnt%03d.log 2>&1"%(reflection.getProcessName(),current_step,ocsync_cnt[current_step])
-        runcmd(cmd, ignore_exitcode=True)  # exitcode of ocsync is not reliable
-        logger.info('sync cmd is: %s',cmd)
-        logger.info('sync finished: %s',datetime.datetime.now()-t0)
-        ocsync_cnt[current_step]+=1
+    args = shlex.split(config.oc_sync_cmd)+[local_folder]
+    log_path = os.path.join(config.rundir,"%s-ocsync.step%02d.cnt%03d.log"%(worker,current_step,cnt))
+
+    logger.info('sync cmd is: %s',' '.join(args+[oc_webdav_url('owncloud',remote_folder,user_num,hide_password=True)]))
+
+    def finished(sync):
+        metrics = sync.metrics(local_folder)
+
+        tracing.record('run_ocsync',sync.started,sync.finished,args=dict(metrics,local_folder=local_folder,remote_folder=remote_folder,user_num=user_num))
+
+        if sync.cancelled:
+            logger.warning('sync cancelled (see %s)',log_path)
+        elif sync.returncode != 0:
+            logger.warning('Non-zero exit code %d from sync client (ignored, see %s)',sync.returncode,log_path) # exitcode of ocsync is not reliable
+        for line in sync.output.errors[:5]:
+            logger.warning('sync error: %s',line)
+
+        logger.info('sync finished: %.2fs, %d files propagated (%d up, %d down), %.1f MB, %.1f MB/s, %d retries, %d error lines',
+                    metrics['duration'],metrics['files'],metrics['uploads'],metrics['downloads'],metrics['bytes']/1e6,metrics['throughput']/1e6,metrics['retries'],metrics['errors'])
+
+        reflection.getSharedObject().append('ocsync_metrics',dict(metrics,worker=worker,step=current_step,cnt=cnt,returncode=sync.returncode))
+
+    return ocsync.Sync(args+[oc_webdav_url('owncloud',remote_folder,user_num)],log_path,env,on_finish=finished)
+
+
+def run_ocsync_concurrently(syncs, concurrency=None):
+    """ Run several syncs at the same time, at most concurrency of them (default: all). Each sync is given as a dict of
+    keyword arguments of run_ocsync_async(), e.g. dict(local_folder=d,user_num=2). Return the finished handles in the same order.
+    """
+    syncs = [dict(s) for s in syncs]
+    if concurrency is None:
+        concurrency = len(syncs)
+    concurrency = max(concurrency,1)
+
+    handles = [None]*len(syncs)
+    pending = range(len(syncs))
+    running = []
+
+    t0 = time.time()
 
+    while pending or running:
+        while pending and len(running) < concurrency:
+            i = pending.pop(0)
+            handles[i] = run_ocsync_async(**syncs[i])
+            running.append(handles[i])
+
+        for h in ocsync.wait_any(running):
+            h.poll()
+            running.remove(h)
+
+    logger.info('%d syncs finished in %.2fs (concurrency %d, %.2fs when run one after another)',len(handles),time.time()-t0,concurrency,sum([h.duration for h in handles]))
+
+    return handles
+
+
+def report_sync_metrics():
+    """ Log the sync runs of all workers per worker and step and commit the totals to monitoring.
+    This is run under the name of the "supervisor" worker.
+    """
+    runs = reflection.getSharedObject().get('ocsync_metrics',[])
+    if not runs:
+        return
+
+    totals = {}
+    for r in runs:
+        t = totals.setdefault((r['worker'],r['step']),[0,0,0,0.0,0])
+        t[0] += 1
+        t[1] += r['files']
+        t[2] += r['bytes']
+        t[3] += r['duration']
+        t[4] += r['errors']
+
+    for (worker,step),(nruns,nfiles,nbytes,duration,nerrors) in sorted(totals.items()):
+        logger.info('syncs of %s in step %d: %d runs, %d files, %.1f MB in %.2fs, %d error lines',worker,step,nruns,nfiles,nbytes/1e6,duration,nerrors)
+
+    nbytes = sum(r['bytes'] for r in runs)
+    duration = sum(r['duration'] for r in runs)
+
+    from smashbox.utilities.monitoring import commit_to_monitoring
+    commit_to_monitoring('sync_runs',len(runs))
+    commit_to_monitoring('sync_files',sum(r['files'] for r in runs))
+    commit_to_monitoring('sync_bytes',nbytes)
+    commit_to_monitoring('sync_throughput',nbytes/duration if duration > 0 else 0.0)
+    commit_to_monitoring('sync_errors',sum(r['errors'] for r in runs))
+
+
+def webdav_propfind(path, depth=1, user_num=None):
+    """ PROPFIND on the remote path of the account: return a list of entries (dicts with path, collection, etag, size,
+    modified, fileid and permissions, the path itself first) or None if the path does not exist.
+    """
+    status,entries = webdav.propfind(path, depth, user_num)
+    if status == 404:
+        return None
+    if status != 207:
+        raise requests.HTTPError('PROPFIND %s returned status %d' % (path, status))
+    return entries
 
 def webdav_propfind_ls(path, user_num=None):
-    runcmd('curl -s -k %s -XPROPFIND %s | xmllint --format -'%(config.get('curl_opts',''),oc_webdav_url(remote_folder=path, user_num=user_num)))
+    """ Log the listing of the remote path and return its entries (see webdav_propfind()).
+    """
+    entries = webdav_propfind(path, 1, user_num)
+    if entries is None:
+        logger.info('webdav ls %s: not found', path)
+    else:
+        logger.info('webdav ls %s:\n%s', path, '\n'.join(['%s %12s %s %s' % ('d' if e['collection'] else '-', e['size'] if e['size'] is not None else '', e['etag'], e['path']) for e in entries]))
+    return entries
+
+def webdav_exists(path, user_num=None):
+    """ True if the remote path exists. For a list of paths return a dict {path: exists}, the paths are checked concurrently.
+    """
+    def exists(p):
+        status = webdav.propfind(p, 0, user_num)[0]
+        if status not in [207, 404]:
+            raise requests.HTTPError('PROPFIND %s returned status %d' % (p, status))
+        return status == 207
+
+    if isinstance(path, basestring):
+        return exists(path)
+
+    paths = list(path)
+    return dict(zip(paths, webdav.map_concurrently(exists, paths)))
 
 def expect_webdav_does_not_exist(path, user_num=None):
-    exitcode,stdout,stderr = runcmd('curl -s -k %s -XPROPFIND %s | xmllint --format - | grep NotFound | wc -l'%(config.get('curl_opts',''),oc_webdav_url(remote_folder=path, user_num=user_num)))
-    not_exists = stdout.rstrip() == "1"
-    error_check(not_exists, "Remote path does not %s exist but should" % path)
+    """ Check that the remote path (or all paths in a list) does not exist.
+    """
+    paths = [path] if isinstance(path, basestring) else path
+    for p, exists in webdav_exists(list(paths), user_num).items():
+        error_check(not exists, "Remote path %s exists but should not" % p)
 
 def expect_webdav_exist(path, user_num=None):
-    exitcode,stdout,stderr = runcmd('curl -s -k %s -XPROPFIND %s | xmllint --format - | grep NotFound | wc -l'%(config.get('curl_opts',''),oc_webdav_url(remote_folder=path, user_num=user_num)))
-    exists = stdout.rstrip() == "0"
-    error_check(exists, "Remote path %s exists but should not" % path)
+    """ Check that the remote path (or all paths in a list) exists.
+    """
+    paths = [path] if isinstance(path, basestring) else path
+    for p, exists in webdav_exists(list(paths), user_num).items():
+        error_check(exists, "Remote path %s does not exist but should" % p)
 
 def webdav_delete(path, user_num=None):
-    runcmd('curl -k %s -X DELETE %s '%(config.get('curl_opts',''),oc_webdav_url(remote_folder=path, user_num=user_num)))
+    """ Delete the remote path (a missing path is fine). Return the HTTP status.
+    """
+    status = webdav.request('DELETE', path, user_num).status_code
+    if status not in [200, 204, 404]:
+        logger.warning('DELETE %s returned status %d', path, status)
+    return status
 
 def webdav_mkcol(path, silent=False, user_num=None):
-    out=""
-    if silent: # a workaround for super-verbose errors in case directory on the server already exists
-        out = "> /dev/null 2>&1"
-    runcmd('curl -k %s -X MKCOL %s %s'%(config.get('curl_opts',''),oc_webdav_url(remote_folder=path, user_num=user_num),out))
+    """ Create the remote directory (an existing one is fine). Return the HTTP status.
+    """
+    status = webdav.request('MKCOL', path, user_num).status_code
+    if status == 405:
+        if not silent:
+            logger.info('MKCOL %s: already exists', path)
+    elif status != 201:
+        logger.warning('MKCOL %s returned status %d', path, status)
+    return status
+
+######### ETAG PROPAGATION
+
+def watch_etags(paths, user_nums=None, label='propagation'):
+    """ Take the etags of the remote paths (a path or a list) of the accounts user_nums (a list, None for the main
+    account) and return a watcher. Call its wait(timeout) after a change: it polls the paths until all the etags changed
+    and returns the propagation latency of each (user_num, path) in seconds (None if it timed out).
+
+    The latencies are reported to monitoring per label by report_propagation(). For example:
+
+      watcher = watch_etags('/', [2, 3], label='share')
+      run_ocsync(d, user_num=1)
+      expect_propagated(watcher.wait(timeout=10), within=5)
+    """
+    if isinstance(paths, basestring):
+        paths = [paths]
+    if user_nums is None:
+        user_nums = [None]
+
+    def probe((user_num, path)):
+        status, entries = webdav.propfind(path, 0, user_num)
+        if status == 404:
+            return None
+        if status != 207:
+            raise requests.HTTPError('PROPFIND %s returned status %d' % (path, status))
+        return entries[0]['etag']
+
+    def record(latencies):
+        values = [v for v in latencies.values() if v is not None]
+        if values:
+            logger.info('%s: %d etags changed in %.3fs (max), %d did not change', label, len(values), max(values), len(latencies) - len(values))
+        else:
+            logger.info('%s: %d etags did not change', label, len(latencies))
+
+        reflection.getSharedObject().append('propagation', {'label': label, 'worker': reflection.getProcessName(), 'step': reflection.getCurrentStep(), 'latencies': latencies.values()})
+
+    return propagation.EtagWatcher([(u, p) for u in user_nums for p in paths], probe, webdav.map_concurrently, record)
+
+
+def expect_propagated(latencies, within=None, comment=''):
+    """ Check that all the etags of watcher.wait() changed (within seconds if given).
+    """
+    for (user_num, path), latency in sorted(latencies.items()):
+        account = webdav.account(user_num)[0]
+        error_check(latency is not None, "etag of %s of %s did not change%s" % (path, account, comment))
+        if latency is not None and within is not None:
+            error_check(latency <= within, "etag of %s of %s changed after %.3fs, more than %.3fs%s" % (path, account, latency, within, comment))
+
+
+def report_propagation():
+    """ Log the distribution of the etag propagation latencies measured by the watchers of all workers, per label, and
+    commit the distribution of all of them to monitoring (in ms).
+    This is run under the name of the "supervisor" worker.
+    """
+    waits = reflection.getSharedObject().get('propagation', [])
+    if not waits:
+        return
+
+    def distribution(latencies):
+        h = diagnostics.Histogram()
+        for v in latencies:
+            if v is not None:
+                h.add(v*1000)
+        return h, len(latencies) - h.count
+
+    def describe(h):
+        return ', '.join(['p%d %.1f ms' % (p, h.percentile(p)) for p in diagnostics.PERCENTILES] + ['max %.1f ms' % h.max])
+
+    labels = {}
+    for w in waits:
+        labels.setdefault(w['label'], []).extend(w['latencies'])
+
+    for label, latencies in sorted(labels.items()):
+        h, timeouts = distribution(latencies)
+        logger.info('%s: %d etags changed%s, %d did not change', label, h.count, ' (%s)' % describe(h) if h.count else '', timeouts)
+
+    h, timeouts = distribution(sum(labels.values(), []))
+
+    from smashbox.utilities.monitoring import commit_to_monitoring
+    commit_to_monitoring('propagation_count', h.count)
+    commit_to_monitoring('propagation_timeouts', timeouts)
+    if h.count:
+        for p in diagnostics.PERCENTILES:
+            commit_to_monitoring('propagation_p%d_ms' % p, h.percentile(p))
+        commit_to_monitoring('propagation_max_ms', h.max)
+
 
 # #### SHELL COMMANDS AND TIME FUNCTIONS
 
-def runcmd(cmd,ignore_exitcode=False,echo=True,allow_stderr=True,shell=True,log_warning=True):
+import select
+import signal
+
+try:
+    import subprocess32 # optional: starts the process group of runcmd() without running python code in the forked child
+except ImportError:
+    subprocess32 = None
+
+class CommandResult(tuple):
+    """ The (returncode, stdout, stderr) of runcmd() with the cost of the command as attributes:
+
+      rusage: dict with the user and system CPU time (utime, stime in seconds) and the maximum resident set size (maxrss in KB) of the command
+      elapsed: wall clock time in seconds
+      timed_out: True if the command was killed because of the timeout
+    """
+
+    def __new__(cls, returncode, stdout, stderr, rusage=None, elapsed=None, timed_out=False):
+        self = tuple.__new__(cls, (returncode, stdout, stderr))
+        self.rusage = rusage
+        self.elapsed = elapsed
+        self.timed_out = timed_out
+        return self
+
+
+def _killpg(pid, sig):
+    try:
+        os.killpg(pid, sig)
+    except OSError:
+        pass # already gone
+
+
+def _expire(process, cmd, timeout, timed_out):
+    """ The timeout of the command expired: terminate its process group the first time and kill it after the grace period.
+    Return the next deadline.
+    """
+    if not timed_out:
+        logger.warning('Timeout of %ss expired, terminating command %s',timeout,repr(cmd))
+        _killpg(process.pid,signal.SIGTERM)
+        return time.time()+5
+
+    logger.warning('Killing command %s',repr(cmd))
+    _killpg(process.pid,signal.SIGKILL)
+    return None
+
+
+def runcmd(cmd,ignore_exitcode=False,echo=True,allow_stderr=True,shell=True,log_warning=True,env=None,timeout=None,max_output=None):
+    """ Run cmd and return CommandResult (returncode,stdout,stderr).
+
+    The output is logged line by line while the command runs (if echo). At most max_output bytes (default config.runcmd_max_output)
+    of stdout and of stderr are logged and returned, the rest is counted and dropped.
+
+    If timeout (seconds) expires the command and all the processes it started (its process group) are terminated,
+    and killed if still running 5 seconds later.
+
+    The command gets its own process group. Without the subprocess32 module this is done by os.setpgrp() in the forked
+    child (preexec_fn), which is not safe if other threads of the worker may hold locks at the same time (workers as
+    threads, map_concurrently): install subprocess32 for these setups.
+    """
     logger.info('running %s', repr(cmd))
 
-    process = subprocess.Popen(cmd, shell=shell,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-    stdout,stderr = process.communicate()
+    if max_output is None:
+        max_output = config.get('runcmd_max_output',1000000)
+
+    t0 = time.time()
+
+    # only the program name goes to the trace: command lines may contain passwords
+    args = cmd.split() if isinstance(cmd,basestring) else list(cmd)
+    with tracing.span('runcmd',program=os.path.basename(args[0]) if args else '') as span:
+        if subprocess32:
+            process = subprocess32.Popen(cmd, shell=shell,stdout=subprocess.PIPE,stderr=subprocess.PIPE,env=env,start_new_session=True,close_fds=True)
+        else:
+            process = subprocess.Popen(cmd, shell=shell,stdout=subprocess.PIPE,stderr=subprocess.PIPE,env=env,preexec_fn=os.setpgrp,close_fds=True)
+
+        streams = {process.stdout.fileno(): ('stdout',[],[0,0]), process.stderr.fileno(): ('stderr',[],[0,0])} # name, kept chunks, [kept bytes, dropped bytes]
+        partial = dict((fd,[[],0]) for fd in streams) # chunks of the incomplete last line, their size
+
+        def output(fd,line):
+            name,kept,counts = streams[fd]
+            if counts[1] or counts[0]+len(line) > max_output:
+                # the start of the line which fits is kept, the rest of the output is dropped
+                n = 0 if counts[1] else max_output-counts[0]
+                line,counts[1] = line[:n],counts[1]+len(line)-n
+                if not line:
+                    return
+            counts[0] += len(line)
+            kept.append(line)
+            if echo and line.strip():
+                if name == 'stderr' and not allow_stderr:
+                    logger.error("stderr: %s",line.rstrip('\n'))
+                else:
+                    logger.info("%s: %s",name,line.rstrip('\n'))
+
+        def feed(fd,data):
+            chunks = partial[fd]
+            if streams[fd][2][1]:
+                streams[fd][2][1] += len(data) # dropping: nothing is buffered any more
+                return
+            end = data.rfind('\n')+1
+            if not end:
+                chunks[0].append(data)
+                chunks[1] += len(data)
+                if chunks[1] > max_output:
+                    # no newline in sight: do not buffer more than can be kept
+                    output(fd,''.join(chunks[0]))
+                    chunks[:] = [[],0]
+                return
+            for line in (''.join(chunks[0])+data[:end]).splitlines(True):
+                output(fd,line)
+            chunks[:] = [[data[end:]],len(data)-end]
+
+        deadline = None
+        if timeout is not None:
+            deadline = t0+timeout
+        timed_out = False
+
+        poller = select.poll()
+        for fd in streams:
+            poller.register(fd,select.POLLIN)
+
+        nopen = len(streams)
+        while nopen:
+            wait = 1000
+            if deadline is not None:
+                wait = max(0,min(wait,int((deadline-time.time())*1000)))
+            try:
+                events = poller.poll(wait)
+            except select.error, x:
+                if x[0] != errno.EINTR:
+                    raise
+                events = []
+
+            for fd,event in events:
+                data = os.read(fd,65536)
+                if not data:
+                    poller.unregister(fd)
+                    nopen -= 1
+                    if partial[fd][1]:
+                        output(fd,''.join(partial[fd][0]))
+                    continue
+                feed(fd,data)
+
+            if deadline is not None and time.time() >= deadline:
+                deadline = _expire(process,cmd,timeout,timed_out)
+                timed_out = True
+
+        process.stdout.close()
+        process.stderr.close()
+
+        # reap the command with wait4() to get its resource usage (it may have closed its output and still run)
+        while True:
+            try:
+                pid,status,ru = os.wait4(process.pid,0 if deadline is None else os.WNOHANG)
+            except OSError, x:
+                if x.errno != errno.EINTR:
+                    raise
+                continue
+            if pid:
+                break
+            if time.time() >= deadline:
+                deadline = _expire(process,cmd,timeout,timed_out)
+                timed_out = True
+            time.sleep(0.05)
+
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+
+        rusage = {'utime': ru.ru_utime, 'stime': ru.ru_stime, 'maxrss': ru.ru_maxrss}
+        span.args = dict(span.args,**rusage)
+
+    elapsed = time.time()-t0
 
-    if echo:
-        if stdout.strip():
-            logger.info("stdout: %s",stdout)
-        if stderr.strip():
-            if allow_stderr:
-                logger.info("stderr: %s",stderr)
-            else:
-                logger.error("stderr: %s",stderr)
+    results = {}
+    for name,kept,(nkept,ndropped) in streams.values():
+        results[name] = ''.join(kept)
+        if ndropped:
+            logger.warning('%s: %d bytes not shown (runcmd_max_output=%d)',name,ndropped,max_output)
+
+    logger.debug('command finished in %.2fs: user %.2fs, system %.2fs, max rss %d KB',elapsed,rusage['utime'],rusage['stime'],rusage['maxrss'])
 
     if process.returncode != 0:
-        msg = "Non-zero exit code %d from command %s" % (ignore_exitcode,repr(cmd))
+        msg = "Non-zero exit code %d from command %s" % (process.returncode,repr(cmd))
         if log_warning:
             logger.warning(msg)
         if not ignore_exitcode:
             raise subprocess.CalledProcessError(process.returncode,cmd)
 
-    return (process.returncode, stdout, stderr)
+    return CommandResult(process.returncode,results['stdout'],results['stderr'],rusage,elapsed,timed_out)
 
 
 def sleep(n):
@@ -444,13 +1097,80 @@ def sleep(n):
 
 ######## BASIC FILE AND DIRECTORY OPERATIONS
 
+# these are native implementations of the shell commands of the same name: no fork/exec per call and no quoting
+# problems with special characters in the paths
+
+import errno
+import itertools
+import shutil
+import stat
+import threading
+
 def mkdir(d):
-    runcmd('mkdir -p '+d)
+    """ Create directory d and its parents if needed (mkdir -p).
+    """
+    try:
+        os.makedirs(d)
+    except OSError,x:
+        if x.errno != errno.EEXIST or not os.path.isdir(d):
+            raise
     return d
 
 
-def remove_tree(path):
-    runcmd('rm -rf '+path)
+_background_removals = []
+_trash_count = itertools.count()
+
+def remove_tree(path,background=False):
+    """ Remove path and everything below it if it exists (rm -rf).
+
+    With background=True the tree is first renamed (which is immediate) and then removed by a background thread:
+    path may be reused right away. See wait_background_removals().
+    """
+    logger.info('remove_tree %s%s',path,' (background)' if background else '')
+
+    if not os.path.lexists(path):
+        return
+
+    if not os.path.isdir(path) or os.path.islink(path):
+        os.remove(path)
+        return
+
+    if background:
+        trash = _trash_name(path,'%d-%d'%(os.getpid(),_trash_count.next()))
+        os.rename(path,trash)
+        _remove_in_background(trash)
+    else:
+        _remove_tree(path)
+
+
+def _trash_name(path,suffix):
+    # a hidden sibling of path: renaming within the same directory is atomic and never crosses filesystems
+    path = os.path.abspath(path)
+    return os.path.join(os.path.dirname(path),'.%s.deleted-%s'%(os.path.basename(path),suffix))
+
+
+def _remove_in_background(path):
+    t = threading.Thread(target=_remove_tree,args=(path,),name='remove_tree')
+    t.daemon = True
+    t.start()
+    _background_removals.append((os.getpid(),t))
+
+
+def _remove_tree(path):
+    def onerror(function,p,exc_info):
+        # files removed concurrently (e.g. by a sync client) are fine
+        if not (isinstance(exc_info[1],OSError) and exc_info[1].errno == errno.ENOENT):
+            raise exc_info[1]
+    shutil.rmtree(path,onerror=onerror)
+
+
+def wait_background_removals():
+    """ Wait until the trees removed in background by this process are gone.
+    """
+    while _background_removals:
+        pid,t = _background_removals.pop()
+        if pid == os.getpid(): # forked workers inherit the list but not the threads
+            t.join()
 
 
 def remove_file(path):
@@ -466,7 +1186,30 @@ def remove_file(path):
             raise
 
 def mv(a,b):
-    runcmd('mv %s %s'%(a,b))
+    """ Move a to b (mv): if b is a directory then a is moved into it. Shell wildcards in a are expanded.
+    """
+    logger.info('mv %s %s',a,b)
+
+    if glob.has_magic(a):
+        sources = sorted(glob.glob(a))
+        if not sources:
+            raise OSError(errno.ENOENT,'no match',a)
+    else:
+        sources = [a]
+
+    if len(sources) > 1 and not os.path.isdir(b):
+        raise OSError(errno.ENOTDIR,'target is not a directory',b)
+
+    for src in sources:
+        dst = b
+        if os.path.isdir(b):
+            dst = os.path.join(b,os.path.basename(os.path.normpath(src)))
+        try:
+            os.rename(src,dst)
+        except OSError,x:
+            if x.errno != errno.EXDEV:
+                raise
+            shutil.move(src,dst) # across filesystems
 
 
 import fnmatch
@@ -475,16 +1218,46 @@ def remove_db_in_folder(path):
         if fnmatch.fnmatch(file, '*.db'):
             remove_file(os.path.join(path, file))
 
-def list_files(path,recursive=False):
-    if platform.system() == 'Darwin':
-        opts = ""
+def _filemode(mode):
+    if stat.S_ISDIR(mode):
+        kind = 'd'
+    elif stat.S_ISLNK(mode):
+        kind = 'l'
     else:
-        opts = "--full-time"
+        kind = '-'
+    return kind+''.join([(mode & (0400 >> i)) and 'rwx'[i%3] or '-' for i in range(9)])
 
-    if recursive:
-        runcmd('ls -lR %s %s'%(opts,path))
+def list_files(path,recursive=False,max_entries=1000):
+    """ Log the listing of directory path (ls -l or ls -lR): mode, size, modification time and name of each entry.
+
+    At most max_entries entries are listed. Return the lines of the listing.
+    """
+    def entry(p,name):
+        st = os.lstat(p)
+        mtime = datetime.datetime.fromtimestamp(st.st_mtime).strftime('%Y-%m-%d %H:%M:%S.%f')
+        return '%s %12d %s %s'%(_filemode(st.st_mode),st.st_size,mtime,name), stat.S_ISDIR(st.st_mode)
+
+    lines = []
+
+    if not os.path.isdir(path) or os.path.islink(path):
+        lines.append(entry(path,path)[0])
     else:
-        runcmd('ls -lh %s %s'%(opts,path))
+        todo = [''] # directories to list, relative to path
+        while todo and len(lines) <= max_entries:
+            rel = todo.pop(0)
+            for name in sorted(os.listdir(os.path.join(path,rel))):
+                line,isdir = entry(os.path.join(path,rel,name),os.path.join(rel,name))
+                lines.append(line)
+                if recursive and isdir:
+                    todo.append(os.path.join(rel,name))
+                if len(lines) > max_entries:
+                    break
+
+    if len(lines) > max_entries:
+        lines[max_entries:] = ['... (listing truncated after %d entries)'%max_entries]
+
+    logger.info('list_files %s:\n%s',path,'\n'.join(lines))
+    return lines
 
 
 # ## DATA FILES AND VERSIONS
@@ -533,27 +1306,15 @@ def createfile_zero(fn,count,bs):
     createfile(fn,'\0',count,bs)
 
 
-import platform
-
-if platform.system() == 'Darwin':
-
-    def md5sum(fn):
-        process = subprocess.Popen('md5 %s'%fn,shell=True,stdout=subprocess.PIPE)
-        out = process.communicate()[0]
-        try:
-            return out.split()[-1]
-        except IndexError:
-            return "NO_CHECKSUM_ERROR"
-
-else:  # linux
-
-    def md5sum(fn):
-        process=subprocess.Popen('md5sum %s'%fn,shell=True,stdout=subprocess.PIPE)
-        out = process.communicate()[0]
-        try:
-            return out.split()[0]
-        except IndexError:
-            return "NO_CHECKSUM_ERROR"
+def md5sum(fn):
+    """ md5 checksum of the content of file fn or "NO_CHECKSUM_ERROR" if it cannot be read.
+    A file which did not change since it was last hashed is not read again (see hashing.py).
+    """
+    try:
+        return hashing.digest(fn, 'md5')
+    except EnvironmentError, x:
+        logger.warning('md5sum: cannot read %s: %s', fn, x)
+        return "NO_CHECKSUM_ERROR"
 
 
 def hexdump(fn):
@@ -597,7 +1358,8 @@ def implies(p,q):
 
 # ###### ERROR REPORTING ############
 
-reported_errors = []
+# errors are counted separately for each worker
+reported_errors = reflection.WorkerLocal(list)
 
 def error_check(expr,message=""):
     """ Assert expr is True. If not, then mark the test as failed but carry on the execution.
@@ -624,6 +1386,17 @@ def fatal_check(expr,message=""):
 
 # ###### Server Log File Scraping ############
 
+# the default of config.oc_server_log_patterns
+SERVER_LOG_PATTERNS = ["integrity constraint violation", "Exception", "Error", "could not obtain lock", "db error", "stat failed"]
+
+def server_log_url():
+    log_url = 'http'
+    if config.oc_ssl_enabled:
+        log_url += 's'
+    log_url += '://' + config.oc_admin_user + ':' + config.oc_admin_password + '@' + config.oc_server
+    log_url += '/' + os.path.join(config.oc_root, 'index.php/settings/admin/log/download')
+    return log_url
+
 def reset_server_log_file(force = False):
     """ Deletes the existing server log file so that there is a clean
         log file for the test run
@@ -639,6 +1412,7 @@ def reset_server_log_file(force = False):
     logger.info('Removing existing server log file')
     cmd = '%s rm -rf %s/owncloud.log' % (config.oc_server_shell_cmd, config.oc_server_datadirectory)
     runcmd(cmd)
+    server_logs.set_offset(server_log_url(),0)
 
 def reset_diagnostics(force = False):
     """ Deletes the existing server log file so that there is a clean
@@ -664,6 +1438,8 @@ def reset_diagnostics(force = False):
     fatal_check(res.status_code == 200, 'Could not clean the diagnostic log file from the server, status code %i' % res.status_code)
     fatal_check(res.text == "null", 'Diagnostic app seems disabled, returned body %s' % res.text)
 
+    del _diagnostic_summary[:]
+
 def parse_log_file_lines(res):
     data = []
     if res is not None:
@@ -672,17 +1448,17 @@ def parse_log_file_lines(res):
             data.append(json.loads(line))
     return data
 
-def get_diagnostic_log(force = False):
+def iter_diagnostic_log(force = False):
     """
-    Obtains server diagnostic log in JSON format and parses it
+    Obtains server diagnostic log in JSON format and yields its records (dicts) as they are downloaded
     """
 
     if not force:
         try:
             if not config.oc_check_diagnostic_log:
-                return []
+                return
         except AttributeError: # allow this option not to be defined at all
-            return []
+            return
 
     logger.info('Obtaining diagnostic log file')
     log_url = 'http'
@@ -691,13 +1467,67 @@ def get_diagnostic_log(force = False):
     log_url += '://' + config.oc_admin_user + ':' + config.oc_admin_password + '@' + config.oc_server
 
     dwn_log_url = log_url + '/' + os.path.join(config.oc_root, 'index.php/apps/diagnostics/log/download')
-    res = requests.get(dwn_log_url)
+    res = requests.get(dwn_log_url, stream=True)
 
     fatal_check(res.status_code == 200, 'Could not download the diagnostic log file from the server, status code %i' % res.status_code)
-    return parse_log_file_lines(res)
+
+    import json
+    for line in res.iter_lines(chunk_size=64*1024):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            logger.warning('diagnostic log: cannot parse %s',line[:200])
+
+def get_diagnostic_log(force = False):
+    """
+    Obtains server diagnostic log in JSON format and parses it (all records in memory: see also analyse_diagnostic_log())
+    """
+    return list(iter_diagnostic_log(force))
+
+_diagnostic_summary = []
+
+def analyse_diagnostic_log(force = False):
+    """ Aggregate the server diagnostic log per step and request type while it is downloaded (see diagnostics.py).
+    Return the diagnostics.Aggregator or None if the diagnostic log is not checked. The log is downloaded once per test.
+    This is run under the name of the "supervisor" worker.
+    """
+    if not force and not config.get('oc_check_diagnostic_log',False):
+        return None
+
+    if not _diagnostic_summary:
+        entries = []
+        for step_times in reflection.getSharedObject().get('_step_times',[]):
+            entries += step_times
+        aggregator = diagnostics.Aggregator(diagnostics.StepTimeline(entries),config.oc_root)
+        for record in iter_diagnostic_log(force):
+            aggregator.add(record)
+        _diagnostic_summary.append(aggregator)
+
+    return _diagnostic_summary[0]
+
+def report_diagnostic_log():
+    """ Log the server-side profile of the test: percentiles of the SQL queries and durations of the requests of each type in each step.
+    """
+    aggregator = analyse_diagnostic_log()
+    if aggregator is None:
+        return
+
+    def fmt(values):
+        return '/'.join(['%.0f'%v if v >= 10 else '%.1f'%v for v in values])
+
+    logger.info('diagnostic log: %d requests (step, request, count, p50/p95/p99/max of %s)',aggregator.nrecords,', '.join([name for name,key in diagnostics.METRICS]))
+    for step,rtype,count,values in aggregator.report():
+        logger.info('  step %s  %-40s %6d  %s',step if step is not None else '-',rtype,count,'  '.join(['%s %s'%(name,fmt(values[name])) for name,key in diagnostics.METRICS if name in values]))
+
+    from smashbox.utilities.monitoring import commit_to_monitoring
+    commit_to_monitoring('diagnostics_requests',aggregator.nrecords)
+    commit_to_monitoring('diagnostics_sql_queries',aggregator.totals['sql_queries'])
 
 def scrape_log_file(d, force = False):
-    """ Copies over the server log file and searches it for specific strings
+    """ Copies over the part of the server log file written since the last scan (see server_logs.py) and searches it
+    for the config.oc_server_log_patterns
 
     :param d: The directory where the server log file is to be copied to
 
@@ -709,53 +1539,45 @@ def scrape_log_file(d, force = False):
         except AttributeError: # allow this option not to be defined at all
             return
 
-    # download server log
-    log_url = 'http'
-    if config.oc_ssl_enabled:
-        log_url += 's'
-    log_url += '://' + config.oc_admin_user + ':' + config.oc_admin_password + '@' + config.oc_server
-    log_url += '/' + os.path.join(config.oc_root, 'index.php/settings/admin/log/download')
+    # download the part of the server log written since the last scan
+    log_url = server_log_url()
+
+    offset = server_logs.get_offset(log_url)
+
+    scanner = server_logs.LogScanner(config.get('oc_server_log_patterns',SERVER_LOG_PATTERNS),config.get('oc_server_log_max_records',10))
 
-    res = requests.get(log_url)
+    t0 = time.time()
+    status,offset,chunks = server_logs.fetch(log_url,offset)
 
-    fatal_check(res.status_code == 200, 'Could not download the log file from the server, status code %i' % res.status_code)
+    fatal_check(status in [200,206], 'Could not download the log file from the server, status code %i' % status)
 
     file_handle = open(os.path.join(d, 'owncloud.log'), 'wb', 8192)
-    for chunk in res.iter_content(8192):
+    for chunk in chunks:
         file_handle.write(chunk)
+        scanner.feed(chunk)
     file_handle.close()
 
-    # search logfile for string (1 == not found; 0 == found):
-    cmd = "grep -i \"integrity constraint violation\" %s/owncloud.log" % d
-    rtn_code,stdout,stderr = runcmd(cmd, ignore_exitcode=True, log_warning=False)
-    error_check(rtn_code > 0, "\"Integrity Constraint Violation\" message found in server log file")
-
-    cmd = "grep -i \"Exception\" %s/owncloud.log" % d
-    rtn_code,stdout,stderr = runcmd(cmd, ignore_exitcode=True, log_warning=False)
-    error_check(rtn_code > 0, "\"Exception\" message found in server log file")
-
-    cmd = "grep -i \"Error\" %s/owncloud.log" % d
-    rtn_code,stdout,stderr = runcmd(cmd, ignore_exitcode=True, log_warning=False)
-    error_check(rtn_code > 0, "\"Error\" message found in server log file")
+    server_logs.set_offset(log_url,offset+scanner.consumed)
 
-    cmd = "grep -i \"could not obtain lock\" %s/owncloud.log" % d
-    rtn_code,stdout,stderr = runcmd(cmd, ignore_exitcode=True, log_warning=False)
-    error_check(rtn_code > 0, "\"Could Not Obtain Lock\" message found in server log file")
+    logger.info('server log: scanned %d new lines (%.1f MB from offset %d) in %.2fs',scanner.nlines,scanner.nbytes/1e6,offset,time.time()-t0)
 
-    cmd = "grep -i \"db error\" %s/owncloud.log" % d
-    rtn_code,stdout,stderr = runcmd(cmd, ignore_exitcode=True, log_warning=False)
-    error_check(rtn_code > 0, "\"DB Error\" message found in server log file")
-
-    cmd = "grep -i \"stat failed\" %s/owncloud.log" % d
-    rtn_code,stdout,stderr = runcmd(cmd, ignore_exitcode=True, log_warning=False)
-    error_check(rtn_code > 0, "\"Stat Failed\" message found in server log file")
+    import json
+    for pattern,regexp in scanner.patterns:
+        count = scanner.counts[pattern]
+        for record in scanner.records[pattern]:
+            logger.info('server log (%s): %s',pattern,json.dumps(record))
+        error_check(count == 0, "\"%s\" message found in server log file (%d lines)" % (pattern,count))
 
 
 # ###### API Calls ############
 
-def get_oc_api(use_new_dav_endpoint=True):
+def get_oc_api(use_new_dav_endpoint=True, user=None, password=None):
     """ Returns an instance of the Client class
 
+    If user is given the client is logged in as this user (with password, by default oc_account_password) and it is
+    pooled: the following calls for the same user in the same worker get it again, with its connection kept alive,
+    instead of logging in again (see oc_sessions).
+
     :returns: Client instance
     """
     import owncloud
@@ -766,8 +1588,24 @@ def get_oc_api(use_new_dav_endpoint=True):
         protocol += 's'
 
     url = protocol + '://' + config.oc_server + '/' + config.oc_root
-    oc_api = owncloud.Client(url, verify_certs=False, dav_endpoint_version=use_new_dav_endpoint, debug=use_debug)
-    return oc_api
+
+    def make_client():
+        return owncloud.Client(url, verify_certs=False, dav_endpoint_version=use_new_dav_endpoint, debug=use_debug)
+
+    if user is None:
+        return make_client()
+
+    if password is None:
+        password = config.oc_account_password
+    return oc_sessions.get(make_client, url, user, password, use_new_dav_endpoint)
+
+
+def get_oc_admin_api():
+    """ Returns a pooled Client logged in as the admin user
+
+    :returns: Client instance
+    """
+    return get_oc_api(user=config.oc_admin_user, password=config.oc_admin_password)
 
 
 def share_file_with_user(filename, sharer, sharee, **kwargs):
@@ -784,8 +1622,7 @@ def share_file_with_user(filename, sharer, sharee, **kwargs):
 
     logger.info('%s is sharing file %s with user %s', sharer, filename, sharee)
 
-    oc_api = get_oc_api()
-    oc_api.login(sharer, config.oc_account_password)
+    oc_api = get_oc_api(user=sharer)
 
     try:
         share_info = oc_api.share_file_with_user(filename, sharee, **kwargs)
@@ -808,8 +1645,7 @@ def delete_share(sharer, share_id):
     """
     logger.info('Deleting share %i from user %s', share_id, sharer)
 
-    oc_api = get_oc_api()
-    oc_api.login(sharer, config.oc_account_password)
+    oc_api = get_oc_api(user=sharer)
     oc_api.delete_share(share_id)
 
 
@@ -825,8 +1661,7 @@ def share_file_with_group(filename, sharer, group, **kwargs):
     """
     logger.info('%s is sharing file %s with group %s', sharer, filename, group)
 
-    oc_api = get_oc_api()
-    oc_api.login(sharer, config.oc_account_password)
+    oc_api = get_oc_api(user=sharer)
     groupshare_info = oc_api.share_file_with_group(filename, group, **kwargs)
 
     logger.info('share id for file group share is %i', groupshare_info.share_id)
@@ -841,8 +1676,7 @@ def add_user_to_group(username, group_name):
     """
     logger.info('Adding user %s to group %s', username, group_name)
 
-    oc_api = get_oc_api()
-    oc_api.login(config.oc_admin_user, config.oc_admin_password)
+    oc_api = get_oc_admin_api()
     oc_api.add_user_to_group(username, group_name)
 
 
@@ -854,22 +1688,21 @@ def remove_user_from_group(username, group_name):
     """
     logger.info('Removing user %s from group %s', username, group_name)
 
-    oc_api = get_oc_api()
-    oc_api.login(config.oc_admin_user, config.oc_admin_password)
+    oc_api = get_oc_admin_api()
     oc_api.remove_user_from_group(username, group_name)
 
 
 def check_users(num_test_users=None):
     """ Checks if a user(s) exists or not
     """
-    result = check_owncloud_account(config.oc_account_name)
-    fatal_check(result, 'User %s not found' % config.oc_account_name)
-
+    usernames = [config.oc_account_name]
     if num_test_users is not None:
-        for i in range(1, num_test_users + 1):
-            username = "%s%i" % (config.oc_account_name, i)
-            result = check_owncloud_account(username)
-            fatal_check(result, 'User %s not found' % username)
+        usernames += ["%s%i" % (config.oc_account_name, i) for i in range(1, num_test_users + 1)]
+
+    results = _provision('check_users', check_owncloud_account, usernames)
+
+    for username, result in zip(usernames, results):
+        fatal_check(result, 'User %s not found' % username)
 
 
 def check_groups(num_groups=None):
@@ -879,9 +1712,10 @@ def check_groups(num_groups=None):
         result = check_owncloud_group(config.oc_group_name)
         fatal_check(result, 'Group %s not found' % config.oc_group_name)
     else:
-        for i in range(1, num_groups + 1):
-            group_name = "%s%i" % (config.oc_group_name, i)
-            result = check_owncloud_group(group_name)
+        group_names = ["%s%i" % (config.oc_group_name, i) for i in range(1, num_groups + 1)]
+        results = _provision('check_groups', check_owncloud_group, group_names)
+
+        for group_name, result in zip(group_names, results):
             fatal_check(result, 'Group %s not found' % group_name)
 
 
@@ -912,3 +1746,49 @@ def expect_does_not_exist(fn):
     """
     error_check(not os.path.exists(fn), "File %s exists but should not" % fn)
 
+
+
+if __name__ == "__main__":
+
+    # Micro-benchmark of the file and directory operations: run "python __init__.py [nops]" with python/ in PYTHONPATH.
+    #
+    # Compares the native helpers with the shell commands they replace, run with runcmd() (fork/exec per call).
+
+    import logging
+    import sys
+    import tempfile
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger()
+
+    nops = int(sys.argv[1]) if sys.argv[1:] else 200
+
+    shell = { 'mkdir' : lambda d: runcmd('mkdir -p '+d),
+              'mv' : lambda a,b: runcmd('mv %s %s'%(a,b)),
+              'list_files' : lambda d: runcmd('ls -lh --full-time '+d),
+              'remove_tree' : lambda d: runcmd('rm -rf '+d) }
+
+    native = { 'mkdir' : mkdir, 'mv' : mv, 'list_files' : list_files, 'remove_tree' : remove_tree }
+
+    def bench(ops):
+        base = tempfile.mkdtemp()
+        times = {}
+        try:
+            for op,args in [('mkdir',lambda i: (os.path.join(base,'d%d'%i,'sub'),)),
+                            ('mv',lambda i: (os.path.join(base,'d%d'%i),os.path.join(base,'m%d'%i))),
+                            ('list_files',lambda i: (os.path.join(base,'m%d'%i),)),
+                            ('remove_tree',lambda i: (os.path.join(base,'m%d'%i),))]:
+                t0 = time.time()
+                for i in range(nops):
+                    ops[op](*args(i))
+                times[op] = time.time()-t0
+        finally:
+            shutil.rmtree(base)
+        return times
+
+    t_shell = bench(shell)
+    t_native = bench(native)
+
+    print "%12s %15s %15s %10s" % ('operation', 'shell [us]', 'native [us]', 'speedup')
+    for op in ['mkdir', 'mv', 'list_files', 'remove_tree']:
+        print "%12s %15.1f %15.1f %10.1f" % (op, t_shell[op]*1e6/nops, t_native[op]*1e6/nops, t_shell[op]/t_native[op])
@@ -0,0 +1,148 @@
+# The _open_SmashBox Project.
+#
+# License: AGPL
+#
+# Pool of test accounts on the server (oc_account_reset_procedure =
+# "pool"): instead of deleting and recreating the account of the test,
+# which is slow on the server for accounts with many files, each test
+# leases an account of the pool which was emptied after its previous
+# test: its shares, group memberships, files and trashbin are deleted by
+# a background process (see release_owncloud_account()) while the next
+# test already runs on another account of the pool.
+#
+# The state of the pool is kept in smashdir/account-pool.db (sqlite), so
+# it is shared by the tests run one after another or at the same time
+# (smash --jobs) on this host. Each slot of the pool is a main account
+# with its numbered test users (the accounts of the slot):
+#
+#   free     emptied, ready to be leased
+#   leased   used by the test run by process pid
+#   wiping   being emptied by process pid
+#
+# A slot leased or being wiped by a process which no longer exists (a
+# killed run) is stale: it is emptied by the next test which leases it.
+
+import errno
+import os
+import time
+
+ACCOUNT_NAME = '%s%d-user' # prefix, slot: the main account of a slot (its test users get a number appended)
+
+POLL_INTERVAL = 1.0 # seconds between two lookups for a free slot when all are in use
+
+
+def account_name(prefix, slot):
+    return ACCOUNT_NAME % (prefix, slot)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, x:
+        return x.errno == errno.EPERM
+    return True
+
+
+class AccountPool:
+    """ The slots of the pool in the sqlite database at path: at most size of them.
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._conn = None
+        self._pid = None
+
+    def _db(self):
+        import sqlite3
+
+        if self._pid != os.getpid():
+            # a connection must never be used across fork
+            db = sqlite3.connect(self.path, timeout=600, isolation_level=None)
+            db.execute('CREATE TABLE IF NOT EXISTS slots (slot INTEGER PRIMARY KEY, state TEXT, pid INTEGER, changed REAL, '
+                       'accounts INTEGER, leases INTEGER, wipe_duration REAL, wipe_error TEXT)')
+            self._conn = db
+            self._pid = os.getpid()
+        return self._conn
+
+    def _transaction(self, function):
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            result = function(db)
+        except:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+        return result
+
+    def lease(self, accounts, timeout=None):
+        """ Lease a slot for the current process, waiting at most timeout seconds (None = forever) until one is free.
+
+        accounts is the number of accounts the test needs (the main account and its test users). Return a dict with the
+        slot, the number of its accounts which exist on the server (accounts: 0 if none, 1 if only the main account...),
+        stale (True if the slot must be emptied first), the time spent waiting (wait), the number of slots (size) and of
+        free slots (free) when leased, the duration of the previous wipe of the slot and its error (wipe_duration,
+        wipe_error). Raise RuntimeError on timeout.
+        """
+        t0 = time.time()
+
+        def choose(db):
+            rows = db.execute('SELECT slot, state, pid, accounts, wipe_duration, wipe_error FROM slots ORDER BY slot').fetchall()
+
+            free = [r for r in rows if r[1] == 'free']
+            stale = [r for r in rows if r[1] != 'free' and not _alive(r[2])]
+
+            # prefer a slot which has all the accounts already
+            candidates = [r for r in free if r[3] >= accounts] or free or stale
+            if candidates:
+                slot, state, pid, naccounts, wipe_duration, wipe_error = candidates[0]
+            elif len(rows) < self.size:
+                used = set([r[0] for r in rows])
+                slot = min([i for i in range(len(rows)+1) if i not in used])
+                state, naccounts, wipe_duration, wipe_error = 'free', 0, None, None
+                db.execute('INSERT INTO slots VALUES (?, NULL, NULL, NULL, 0, 0, NULL, NULL)', (slot,))
+                rows.append((slot,))
+            else:
+                return None
+
+            db.execute("UPDATE slots SET state='leased', pid=?, changed=?, leases=leases+1 WHERE slot=?", (os.getpid(), time.time(), slot))
+
+            return {'slot': slot,
+                    'accounts': naccounts,
+                    'stale': state != 'free',
+                    'size': len(rows),
+                    'free': len(free),
+                    'wipe_duration': wipe_duration,
+                    'wipe_error': wipe_error}
+
+        while True:
+            lease = self._transaction(choose)
+            if lease is not None:
+                lease['wait'] = time.time() - t0
+                return lease
+            if timeout is not None and time.time() - t0 > timeout:
+                raise RuntimeError('no account of the pool %s became free within %s seconds' % (self.path, timeout))
+            time.sleep(POLL_INTERVAL)
+
+    def set_accounts(self, slot, accounts):
+        """ Record that the first accounts accounts of the slot exist on the server.
+        """
+        self._transaction(lambda db: db.execute('UPDATE slots SET accounts=? WHERE slot=? AND accounts<?', (accounts, slot, accounts)))
+
+    def wiping(self, slot):
+        """ The current process starts emptying the slot. Return the number of accounts of the slot.
+        """
+        def start(db):
+            db.execute("UPDATE slots SET state='wiping', pid=?, changed=? WHERE slot=?", (os.getpid(), time.time(), slot))
+            return db.execute('SELECT accounts FROM slots WHERE slot=?', (slot,)).fetchone()[0]
+        return self._transaction(start)
+
+    def wiped(self, slot, duration, error=None):
+        """ The slot was emptied (or the accounts must be recreated if error is set) and can be leased again.
+        """
+        if error:
+            sql = "UPDATE slots SET state='free', pid=NULL, changed=?, accounts=0, wipe_duration=?, wipe_error=? WHERE slot=?"
+        else:
+            sql = "UPDATE slots SET state='free', pid=NULL, changed=?, wipe_duration=?, wipe_error=? WHERE slot=?"
+        self._transaction(lambda db: db.execute(sql, (time.time(), duration, error, slot)))
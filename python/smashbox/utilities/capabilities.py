@@ -0,0 +1,98 @@
+# The _open_SmashBox Project.
+#
+# License: AGPL
+#
+# Snapshot of what the server and the sync client can do (see
+# get_capabilities()): the server version, its OCS capabilities, the
+# WebDAV endpoints it serves, the checksum types it supports and the
+# version of the client.
+#
+# The supervisor takes the snapshot once per test, before the workers
+# start, and the workers read it from the config (config._capabilities)
+# instead of asking the server or running the client again. The snapshot
+# is also saved in smashdir for oc_capabilities_cache_ttl seconds, so the
+# tests run one after another (smash --loop) do not probe again.
+
+import json
+import os
+import re
+import time
+
+import requests
+
+CACHE_FILE = 'capabilities.json'
+
+TIMEOUT = 10 # seconds per probe request
+
+DAV_ENDPOINTS = [('remote.php/webdav', 'remote.php/webdav/'),
+                 ('remote.php/dav', 'remote.php/dav/files/%(user)s/')]
+
+_CLIENT_VERSION = re.compile(r' version (\d+(?:\.\d+)*)')
+
+
+def probe_server(url, user, password):
+    """ Ask the server at url (ending with /) for its status, capabilities and WebDAV endpoints, as user. Return a dict:
+
+      version, versionstring, edition: from status.php (None if the server could not be reached)
+      capabilities: the OCS capabilities (a dict, empty if unknown)
+      checksums: the checksum types the server supports (e.g. ['SHA1', 'MD5', 'ADLER32'])
+      dav_endpoints: the WebDAV endpoints which answer a PROPFIND (remote.php/webdav, remote.php/dav)
+    """
+    session = requests.Session()
+    session.auth = (user, password)
+    session.verify = False
+
+    snapshot = {'version': None, 'versionstring': None, 'edition': None, 'capabilities': {}, 'checksums': [], 'dav_endpoints': []}
+
+    try:
+        status = session.get(url + 'status.php', timeout=TIMEOUT).json()
+        for k in ['version', 'versionstring', 'edition']:
+            snapshot[k] = status.get(k)
+    except (requests.RequestException, ValueError, AttributeError):
+        return snapshot
+
+    try:
+        ocs = session.get(url + 'ocs/v1.php/cloud/capabilities', params={'format': 'json'}, headers={'OCS-APIREQUEST': 'true'}, timeout=TIMEOUT).json()
+        snapshot['capabilities'] = ocs['ocs']['data']['capabilities']
+        snapshot['checksums'] = snapshot['capabilities'].get('checksums', {}).get('supportedTypes', [])
+    except (requests.RequestException, ValueError, KeyError, TypeError, AttributeError):
+        pass
+
+    for name, path in DAV_ENDPOINTS:
+        try:
+            res = session.request('PROPFIND', url + path % {'user': user}, headers={'Depth': '0'}, timeout=TIMEOUT)
+        except requests.RequestException:
+            continue
+        if res.status_code == 207:
+            snapshot['dav_endpoints'].append(name)
+
+    return snapshot
+
+
+def parse_client_version(output):
+    """ The version of the client (e.g. '2.4.1') from the output of "owncloudcmd --version", None if not found.
+    """
+    m = _CLIENT_VERSION.search(output)
+    if m is None:
+        return None
+    return m.group(1)
+
+
+def load(path, key, ttl):
+    """ The snapshot saved at path for key if it is not older than ttl seconds, else None.
+    """
+    try:
+        cached = json.load(open(path))
+    except (IOError, ValueError):
+        return None
+    if cached.get('key') != key or not 0 <= time.time() - cached.get('time', 0) <= ttl:
+        return None
+    return cached['snapshot']
+
+
+def save(path, key, snapshot):
+    tmp = '%s.%d.tmp' % (path, os.getpid()) # tests run at the same time may save it too
+    f = open(tmp, 'w')
+    json.dump({'key': key, 'time': time.time(), 'snapshot': snapshot}, f)
+    f.close()
+    os.rename(tmp, path)
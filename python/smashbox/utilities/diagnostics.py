@@ -0,0 +1,189 @@
+# The _open_SmashBox Project.
+#
+# License: AGPL
+#
+# Aggregation of the log of the diagnostics app of the owncloud server
+# (oc_check_diagnostic_log): a server-side profile of the test.
+#
+# The records are aggregated while the log is downloaded, per step of
+# the test and per request type (method and endpoint), into histograms
+# of the SQL query counts and durations. The memory used depends on the
+# number of steps and request types, not on the size of the log.
+#
+# The step of a request is found from its time and the times the
+# workers entered the steps: the clocks of the server and of the test
+# host must agree to better than the duration of the steps.
+
+import bisect
+import calendar
+import math
+import re
+
+# the diagnostics of a request which are aggregated: (name, key in the "diagnostics" dict of the record)
+METRICS = [('sql_queries', 'totalSQLQueries'),
+           ('sql_ms', 'totalSQLDurationmsec'),
+           ('events_ms', 'totalEventsDurationmsec')]
+
+PERCENTILES = [50, 95, 99]
+
+
+class Histogram:
+    """ Counts of values in bounded memory: small integers (e.g. query counts) are counted exactly, other values in
+    logarithmic buckets, so percentiles are within 1% of the exact value.
+    """
+
+    BASE = 1.02
+    EXACT = 1000
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = None
+
+    def add(self, value):
+        # the key of a bucket is the value it stands for
+        if value <= 0:
+            key = 0.0
+        elif value < self.EXACT and value == int(value):
+            key = value
+        else:
+            key = self.BASE**(math.floor(math.log(value, self.BASE))+0.5)
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+        self.count += 1
+        self.sum += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """ The p-th percentile or None if there are no values.
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(self.count*p/100.0)))
+        n = 0
+        for key in sorted(self.buckets):
+            n += self.buckets[key]
+            if n >= rank:
+                return min(key, self.max)
+        return self.max
+
+
+class StepTimeline:
+    """ Maps times to steps. entries is a list of (step, time a worker entered the step): the earliest time counts for each step.
+    """
+
+    def __init__(self, entries):
+        first = {}
+        for step, t in entries:
+            if step not in first or t < first[step]:
+                first[step] = t
+        self.times = []
+        self.steps = []
+        for step, t in sorted(first.items(), key=lambda x: x[1]):
+            self.times.append(t)
+            self.steps.append(step)
+
+    def step(self, t):
+        """ The step at time t (None if t is unknown or before the first step).
+        """
+        if t is None:
+            return None
+        i = bisect.bisect_right(self.times, t)
+        if i == 0:
+            return None
+        return self.steps[i-1]
+
+
+_TIME = re.compile(r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(\.\d+)?\s*(Z|[+-]\d\d:?\d\d)?$')
+
+def parse_time(value):
+    """ Seconds since the epoch of a log record time: a number or an ISO 8601 string (UTC if no offset is given). None if unknown.
+    """
+    if isinstance(value, (int, long, float)):
+        return float(value)
+    if not isinstance(value, basestring):
+        return None
+
+    m = _TIME.match(value.strip())
+    if not m:
+        return None
+
+    t = calendar.timegm([int(x) for x in m.groups()[:6]]+[0, 0, 0])
+    if m.group(7):
+        t += float(m.group(7))
+    tz = m.group(8)
+    if tz and tz != 'Z':
+        sign = -1 if tz[0] == '-' else 1
+        tz = tz[1:].replace(':', '')
+        t -= sign*(int(tz[:2])*3600+int(tz[2:])*60)
+    return t
+
+
+def request_type(record, root=''):
+    """ The request type of a record: the method and the endpoint of the url, e.g. "PROPFIND remote.php/webdav",
+    "GET ocs/v1.php/apps/files_sharing" or "PUT remote.php/dav/files".
+    """
+    url = (record.get('url') or '').split('?')[0].strip('/')
+    root = root.strip('/')
+    if root and url.startswith(root+'/'):
+        url = url[len(root)+1:]
+
+    parts = url.split('/')
+    for i, part in enumerate(parts):
+        if part.endswith('.php'):
+            n = 2
+            if parts[i+1:i+2] in (['apps'], ['dav']):
+                n = 3
+            url = '/'.join(parts[:i+n])
+            break
+
+    return '%s %s' % (record.get('method') or '?', url)
+
+
+class Aggregator:
+    """ Aggregates the records of the diagnostics log per (step, request type).
+    """
+
+    def __init__(self, timeline=None, root=''):
+        self.timeline = timeline or StepTimeline([])
+        self.root = root
+        self.groups = {} # (step, type) -> [number of requests, {metric: Histogram}]
+        self.nrecords = 0
+        self.totals = dict((name, 0.0) for name, key in METRICS)
+
+    def add(self, record):
+        """ Aggregate one record (a dict). Records without diagnostics are ignored.
+        """
+        diagnostics = record.get('diagnostics')
+        if not isinstance(diagnostics, dict):
+            return
+
+        self.nrecords += 1
+
+        key = (self.timeline.step(parse_time(record.get('time'))), request_type(record, self.root))
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = [0, dict((name, Histogram()) for name, k in METRICS)]
+        group[0] += 1
+        histograms = group[1]
+
+        for name, k in METRICS:
+            try:
+                value = float(diagnostics[k])
+            except (KeyError, TypeError, ValueError):
+                continue
+            histograms[name].add(value)
+            self.totals[name] += value
+
+    def report(self):
+        """ Rows (step, request type, number of requests, {metric: [p50, p95, p99, max]}) sorted by step and request type.
+        """
+        rows = []
+        for (step, rtype), (count, histograms) in sorted(self.groups.items()):
+            values = {}
+            for name, h in histograms.items():
+                if h.count:
+                    values[name] = [h.percentile(p) for p in PERCENTILES]+[h.max]
+            rows.append((step, rtype, count, values))
+        return rows
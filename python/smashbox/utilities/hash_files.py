@@ -1,5 +1,6 @@
 
 from smashbox.utilities import *
+from smashbox import tracing
 
 # utilities to create and process self-describing hashfiles
 # a hashfile encodes its content checksum in its name
@@ -26,6 +27,12 @@ BLOCK_SIZE = 1024*1024
 
 import os
 import fnmatch
+import time
+
+try:
+    from scandir import scandir # optional: faster directory walk on python2
+except ImportError:
+    scandir = None
 
 
 def get_files(wdir, filemask=None):
@@ -65,6 +72,7 @@ def size2nbytes(size):
     except ValueError:
         return make_distrib(size)        
 
+@tracing.span('create_hashfile')
 def create_hashfile(wdir,filemask=None,size=None,bs=None,slow_write=None):
     """ Create a random file in wdir.The md5 checksum is placed in the filname name according to filemask: {md5} string in the filemask is replaced by the file checksum.
     By default the filemask == {md5} so the filename consists of only the checksum.
@@ -142,97 +150,128 @@ def create_hashfile2(wdir,filemask=None,size=None,bs=None,slow_write=None):
     
     return fn,md5.hexdigest()
 
-def analyse_hashfiles(wdir,filemask=None):
+def _scan(d):
+    """ Yield (name, is_file, is_dir) for the entries of directory d. Symbolic links to directories are not followed.
+    """
+    if scandir:
+        for e in scandir(d):
+            yield e.name, e.is_file(), e.is_dir(follow_symlinks=False)
+    else:
+        for name in os.listdir(d):
+            p = os.path.join(d,name)
+            yield name, os.path.isfile(p), os.path.isdir(p) and not os.path.islink(p)
 
-    """ Analyse files in wdir for md5 correctness.
 
-    If filemask is not provided, analyze all possible files found in wdir.
+def walk_files(wdir,pattern='*',recursive=False):
+    """ Lazily yield the paths of the files in wdir with names matching the glob pattern (in subdirectories too if recursive).
 
-    If filemask is provided, analyze only the files which match the filemask pattern ('{md5}' gets replaced by '*')
-    
+    As for glob, hidden names are matched only if the pattern starts with a dot and unreadable directories are skipped.
     """
-    
-    import glob
-    import hashlib
-
-    ncorrupt = 0
-    nfiles = 0
-    nanalysed = 0
-
+    dirs = [wdir]
+    while dirs:
+        d = dirs.pop()
+        try:
+            for name,is_file,is_dir in _scan(d):
+                if name.startswith('.') and not pattern.startswith('.'):
+                    continue
+                if is_file:
+                    if fnmatch.fnmatch(name,pattern):
+                        yield os.path.join(d,name)
+                elif is_dir and recursive:
+                    dirs.append(os.path.join(d,name))
+        except OSError:
+            pass
+
+
+def verify_hashfiles(wdir,filemask=None,recursive=False,nthreads=None):
+    """ Verify the content of the hashfiles in wdir. Yield (fn,md5_name,md5_data,nbytes) for each file as soon as it is verified.
+
+    The file is corrupted if md5_name (extracted from the name) differs from md5_data (computed from the content). For files
+    which are not hashfiles md5_name, md5_data and nbytes are None. The files are hashed by nthreads threads, which defaults
+    to config.hashfile_verify_threads.
+    """
+    import collections
     import re
 
     if filemask is None:
         #match any names containing a block of 32 characters from hex character set
         md5_regexp = '\S*([a-fA-F0-9]{32,32})\S*'
+        glob_pattern = "*"
     else:
         # re.escape in order to allow *? in the filemask
         # a block of 32 characters from hex character set comes in place of {md5} token
         md5_regexp = re.escape(filemask).replace('\{md5\}','([a-fA-F0-9]{32,32})')
+        glob_pattern = filemask.replace('{md5}','*')
 
     md5_pattern = re.compile(md5_regexp)
 
-    if filemask is None:
-        glob_pattern = "*"
-    else:
-        glob_pattern = filemask.replace('{md5}','*')
+    if nthreads is None:
+        nthreads = config.get('hashfile_verify_threads',4)
 
-    
-    for fn in glob.glob(os.path.normpath(os.path.join(wdir,glob_pattern))): 
+    md5_names = {}
+    others = collections.deque() # the walk runs in a thread of the pool
 
-        if not os.path.isfile(fn): 
-            continue # Go for files!
+    def hashfiles():
+        for fn in walk_files(os.path.normpath(wdir),glob_pattern,recursive):
+            m = md5_pattern.match(os.path.basename(fn))
+            if m:
+                md5_names[fn] = m.group(1)
+                yield fn
+            else:
+                others.append(fn) # cannot extract md5 from filename
+
+    for fn,md5_data,nbytes in hashing.digest_many(hashfiles(),'md5',nthreads):
+        while others:
+            yield others.popleft(),None,None,None
+        yield fn,md5_names.pop(fn),md5_data,nbytes
+
+    while others:
+        yield others.popleft(),None,None,None
 
-        nfiles += 1
 
-        m = md5_pattern.match(os.path.basename(fn))
+@tracing.span('analyse_hashfiles')
+def analyse_hashfiles(wdir,filemask=None,recursive=False,nthreads=None):
 
-        if m:
-            md5_name = m.group(1)
-        else:
-            continue # cannot extract md5 from filename
+    """ Analyse files in wdir for md5 correctness.
+
+    If filemask is not provided, analyze all possible files found in wdir.
+
+    If filemask is provided, analyze only the files which match the filemask pattern ('{md5}' gets replaced by '*')
+
+    If recursive is set, analyse the files in the subdirectories too. The files are hashed in parallel (see verify_hashfiles()).
+    """
+
+    ncorrupt = 0
+    nfiles = 0
+    nanalysed = 0
+    nbytes_total = 0
+
+    t0 = time.time()
+
+    for fn,md5_name,md5_data,nbytes in verify_hashfiles(wdir,filemask,recursive,nthreads):
+
+        nfiles += 1
+
+        if md5_name is None:
+            continue
 
         nanalysed += 1
+        nbytes_total += nbytes
 
-        md5_data = md5sum(fn)
-        
         if md5_data!=md5_name:
-            osize = os.path.getsize(fn)
-            error_check(False, 'Corrupted file? %s:  md5 expected %s computed %s (observed size=%s)'%(fn,repr(md5_name),repr(md5_data),osize))
+            error_check(False, 'Corrupted file? %s:  md5 expected %s computed %s (observed size=%s)'%(fn,repr(md5_name),repr(md5_data),nbytes))
             
             ncorrupt += 1
 
+    elapsed = time.time()-t0
+
     logger.info("Found %d files in %s: analysed %d, corrupted %d",nfiles,wdir,nanalysed,ncorrupt)
+    logger.info("Verified %.1f MB in %.2fs: %.1f MB/s",nbytes_total/1e6,elapsed,nbytes_total/1e6/max(elapsed,1e-6))
     
     return (nfiles,nanalysed,ncorrupt)
 
-def md5sum(fn):
-    import hashlib
-    md5 = hashlib.md5()
-        
-    f = file(fn,'rb')
-    
-    while True:
-        chunk = f.read(BLOCK_SIZE)
-        if not chunk: break
-        md5.update(chunk)
-
-    f.close()
-        
-    return md5.hexdigest()
-
 def adler32(fn):
-    import zlib
-    v = 1L
-    f = file(fn,'rb')
-
-    while True:
-        chunk = f.read(BLOCK_SIZE)
-        if not chunk: break
-        v = zlib.adler32(chunk,v)
-            
-    f.close()
-
-    return '%x' % (v & 0xffffffffL)
+    return hashing.digest(fn,'adler32')
 
 # TO BE REVIEWED...
 
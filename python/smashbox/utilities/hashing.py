@@ -0,0 +1,234 @@
+# The _open_SmashBox Project.
+#
+# License: AGPL
+#
+# Checksums of local files (md5sum() and the expect_* and hashfile
+# checks) with a cache: a file which has not changed since it was
+# hashed is not read again.
+#
+# A cached digest is reused only if the file still has the same device,
+# inode, size, mtime and ctime as the open file which was read. Any
+# change of these forces a rehash. A write within the same timestamp
+# tick as the previous one would go unnoticed, so files modified too
+# recently to be told apart are hashed but not cached (the "racy" case
+# of git's index). Python2 has no nanosecond timestamps: the float
+# mtime and ctime are used, which resolve well below a microsecond.
+
+from smashbox.script import config
+from smashbox.utilities import reflection
+
+import hashlib
+import itertools
+import os
+import threading
+import time
+import zlib
+
+BLOCK_SIZE = 1024*1024
+
+# a file modified less than this ago (seconds) is not cached: whole-second timestamps or a few ms of kernel clock tick
+RACY_WINDOW = 1.0
+RACY_WINDOW_SUBSECOND = 0.05
+
+_cache = reflection.WorkerLocal(dict)
+_stats = reflection.WorkerLocal(lambda: {'hits': 0, 'misses': 0, 'bytes': 0})
+
+
+def stats():
+    """ Cache statistics of the current worker: dict with hits, misses and bytes (read to compute the digests).
+    """
+    return dict(_stats.get())
+
+
+def _key(st):
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+
+
+def _racy(st, now):
+    t = max(st.st_mtime, st.st_ctime)
+    if st.st_mtime == int(st.st_mtime):
+        window = RACY_WINDOW
+    else:
+        window = RACY_WINDOW_SUBSECOND
+    return now-t < window
+
+
+def _compute(f, algorithm):
+    if algorithm == 'adler32':
+        v = 1L
+        while True:
+            chunk = f.read(BLOCK_SIZE)
+            if not chunk:
+                break
+            v = zlib.adler32(chunk, v)
+        return '%x' % (v & 0xffffffffL)
+
+    h = hashlib.new(algorithm)
+    while True:
+        chunk = f.read(BLOCK_SIZE)
+        if not chunk:
+            break
+        h.update(chunk)
+    return h.hexdigest()
+
+
+def _digest(fn, algorithm, mode, cache):
+    """ Return (digest, hit, nbytes) where nbytes is the size of the file. Safe to call from several threads with the same cache.
+    """
+    if mode:
+        st = os.stat(fn)
+        key = _key(st)+(algorithm,)
+        d = cache.get(key)
+        if d is None and mode == 'persistent':
+            d = _persistent().get(key)
+        if d is not None:
+            return d, True, st.st_size
+
+    f = open(fn, 'rb')
+    try:
+        st = os.fstat(f.fileno())
+        d = _compute(f, algorithm)
+        st_after = os.fstat(f.fileno())
+    finally:
+        f.close()
+
+    # cache only what is known to be the content of this version of the file
+    if mode and _key(st) == _key(st_after) and not _racy(st_after, time.time()):
+        key = _key(st)+(algorithm,)
+        cache[key] = d
+        if mode == 'persistent':
+            _persistent().put(key, d)
+
+    return d, False, st_after.st_size
+
+
+def _count(hit, nbytes):
+    if hit:
+        _stats['hits'] += 1
+    else:
+        _stats['misses'] += 1
+        _stats['bytes'] += nbytes
+
+
+def digest(fn, algorithm='md5'):
+    """ Hex digest of the content of file fn: md5, adler32 or any hashlib algorithm. Raise IOError/OSError if fn cannot be read.
+    """
+    d, hit, nbytes = _digest(fn, algorithm, config.get('hash_cache', 'worker'), _cache.get())
+    _count(hit, nbytes)
+    return d
+
+
+def digest_many(fns, algorithm='md5', nthreads=4):
+    """ Hash the files fns (any iterable) with nthreads threads and yield (fn, digest, nbytes) as each file completes, in no particular order.
+
+    hashlib releases the GIL while hashing large buffers so the threads use several CPUs. The files share the cache of the current worker.
+    Raise IOError/OSError if a file cannot be read.
+    """
+    mode = config.get('hash_cache', 'worker')
+    cache = _cache.get()
+
+    def work(fn):
+        return (fn,)+_digest(fn, algorithm, mode, cache)
+
+    if nthreads <= 1:
+        results = itertools.imap(work, fns)
+        pool = None
+    else:
+        import multiprocessing.pool
+        pool = multiprocessing.pool.ThreadPool(nthreads)
+        results = pool.imap_unordered(work, fns)
+
+    try:
+        for fn, d, hit, nbytes in results:
+            _count(hit, nbytes)
+            yield fn, d, nbytes
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+
+class _PersistentCache:
+    """ Digests shared by all the workers and test runs in smashdir/hashcache.db.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _db(self):
+        import sqlite3
+
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            # a connection must never be used across fork
+            db = sqlite3.connect(self.path, timeout=600, isolation_level=None, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=OFF')
+            db.execute('CREATE TABLE IF NOT EXISTS digests (dev INTEGER, ino INTEGER, size INTEGER, mtime REAL, ctime REAL, algorithm TEXT, digest TEXT, '
+                       'PRIMARY KEY (dev, ino, size, mtime, ctime, algorithm))')
+            local.db = db
+            local.pid = os.getpid()
+        return local.db
+
+    def get(self, key):
+        row = self._db().execute('SELECT digest FROM digests WHERE dev=? AND ino=? AND size=? AND mtime=? AND ctime=? AND algorithm=?', key).fetchone()
+        if row is None:
+            return None
+        return str(row[0])
+
+    def put(self, key, d):
+        self._db().execute('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)', key+(d,))
+
+
+_persistent_cache = None
+
+def _persistent():
+    global _persistent_cache
+    if _persistent_cache is None:
+        _persistent_cache = _PersistentCache(os.path.join(config.smashdir, 'hashcache.db'))
+    return _persistent_cache
+
+
+if __name__ == "__main__":
+
+    # Benchmark: run "python hashing.py [nfiles] [size_kb]" with python/ in PYTHONPATH.
+    #
+    # Hashes the same files three times: with the md5sum command (fork/exec per file, as md5sum() used to), then
+    # with the cache cold and with the cache warm.
+
+    import shutil
+    import subprocess
+    import sys
+    import tempfile
+
+    nfiles = int(sys.argv[1]) if sys.argv[1:] else 200
+    size = int(sys.argv[2])*1024 if sys.argv[2:] else 1024*1024
+
+    base = tempfile.mkdtemp()
+    try:
+        files = []
+        for i in range(nfiles):
+            fn = os.path.join(base, 'f%d' % i)
+            open(fn, 'wb').write(os.urandom(size))
+            files.append(fn)
+        time.sleep(2*RACY_WINDOW)
+
+        t0 = time.time()
+        for fn in files:
+            subprocess.Popen(['md5sum', fn], stdout=subprocess.PIPE).communicate()
+        t1 = time.time()
+        cold = [digest(fn) for fn in files]
+        t2 = time.time()
+        warm = [digest(fn) for fn in files]
+        t3 = time.time()
+
+        assert cold == warm
+
+        print "%d files of %d KB" % (nfiles, size/1024)
+        print "  md5sum command: %8.1f ms" % ((t1-t0)*1000)
+        print "  cache cold:     %8.1f ms" % ((t2-t1)*1000)
+        print "  cache warm:     %8.1f ms" % ((t3-t2)*1000)
+        print "  %s" % stats()
+    finally:
+        shutil.rmtree(base)
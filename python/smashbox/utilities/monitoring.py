@@ -6,8 +6,6 @@ def push_to_local_monitor(metric, value):
 
 def commit_to_monitoring(metric,value,timestamp=None):
     shared = reflection.getSharedObject()
-    if not 'monitoring_points' in shared.keys():
-        shared['monitoring_points'] = []
 
     # Create monitoring metric point
     monitoring_point = dict()
@@ -15,10 +13,8 @@ def commit_to_monitoring(metric,value,timestamp=None):
     monitoring_point['value'] = value
     monitoring_point['timestamp'] = timestamp
 
-    # Append metric to shared object
-    monitoring_points = shared['monitoring_points']
-    monitoring_points.append(monitoring_point)
-    shared['monitoring_points'] = monitoring_points
+    # Append metric to shared object (atomic, other workers may be committing at the same time)
+    shared.append('monitoring_points', monitoring_point)
 
 def handle_local_push(returncode, total_duration, monitoring_points):
     for monitoring_point in monitoring_points:
@@ -52,10 +48,9 @@ def handle_prometheus_push(returncode, total_duration, monitoring_points):
     # No. queries is default for jenkins if given
     if queries_label is not None:
         no_queries = 0
-        res_diagnostic_logs = smashbox.utilities.get_diagnostic_log()
-        for diagnostic_log in res_diagnostic_logs:
-            if 'diagnostics' in diagnostic_log and 'totalSQLQueries' in diagnostic_log['diagnostics']:
-                no_queries += int(diagnostic_log['diagnostics']['totalSQLQueries'])
+        diagnostics = smashbox.utilities.analyse_diagnostic_log()
+        if diagnostics is not None:
+            no_queries = int(diagnostics.totals['sql_queries'])
 
         points_to_push.append('# TYPE %s gauge' % (queries_label))
         points_to_push.append('%s{owncloud=\\"%s\\",client=\\"%s\\",suite=\\"%s\\",build=\\"%s\\",exit=\\"%s\\"} %s' % (
@@ -89,10 +84,8 @@ def handle_prometheus_push(returncode, total_duration, monitoring_points):
     smashbox.utilities.log_info('Pushing to monitoring: %s' % monitoring_cmd)
 
 def push_to_monitoring(returncode, total_duration):
-    monitoring_points = []
     shared = reflection.getSharedObject()
-    if 'monitoring_points' in shared.keys():
-        monitoring_points = shared['monitoring_points']
+    monitoring_points = shared.get('monitoring_points', [])
 
     monitoring_type = config.get('monitoring_type', None)
     if monitoring_type == 'prometheus':
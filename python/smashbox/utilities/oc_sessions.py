@@ -0,0 +1,104 @@
+# The _open_SmashBox Project.
+#
+# License: AGPL
+#
+# Pool of logged in owncloud API clients (get_oc_api(user=...)).
+#
+# Each login of owncloud.Client opens a new HTTP session (a new TCP/TLS
+# connection) and fetches the capabilities of the server. The helpers
+# which call the OCS API (sharing, groups, provisioning) used to do this
+# for every call: the pool keeps one logged in client per user, dav
+# endpoint version and thread, so its connection is kept alive and
+# reused by the following calls.
+#
+# A Client is not thread-safe (its requests session is not) so the pool
+# is private to the thread, and it is dropped in a forked child: the
+# connections of the parent must not be used by two processes.
+
+from smashbox.utilities import reflection
+
+import os
+
+_pool = reflection.WorkerLocal(dict) # key -> Session, with the pid of the process under key None
+_stats = reflection.WorkerLocal(lambda: {'hits': 0, 'logins': 0, 'relogins': 0})
+
+
+def stats():
+    """ Statistics of the pool of the current thread: dict with hits (calls served by a pooled client), logins and relogins
+    (logins again after 401 Unauthorized).
+    """
+    return dict(_stats.get())
+
+
+def _unauthorized(x):
+    import owncloud
+
+    # 997 is the OCS status code of a failed authentication
+    return isinstance(x, owncloud.ResponseError) and x.status_code in (401, 997)
+
+
+class Session(object):
+    """ A logged in owncloud.Client: attribute access is forwarded to the client. A call which fails as unauthorized (the
+    session expired on the server, the user was recreated...) logs in again and is retried once.
+
+    A call reading an open file (put_file() with a file object) cannot be retried: use a file name.
+    """
+
+    def __init__(self, make_client, user, password):
+        self._make_client = make_client
+        self._user = user
+        self._password = password
+        self._client = None
+        self._login()
+
+    def _login(self):
+        if self._client is not None:
+            _stats['relogins'] += 1
+            self._client.logout()
+        client = self._make_client()
+        client.login(self._user, self._password)
+        _stats['logins'] += 1
+        self._client = client
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            try:
+                return attr(*args, **kwargs)
+            except Exception, x:
+                if not _unauthorized(x):
+                    raise
+            self._login()
+            return getattr(self._client, name)(*args, **kwargs)
+
+        call.__name__ = name
+        return call
+
+
+def get(make_client, url, user, password, dav_endpoint_version):
+    """ The pooled Session of user at url, created by logging in a client made by make_client() on first use.
+    """
+    pool = _pool.get()
+    if pool.get(None) != os.getpid():
+        pool.clear()
+        pool[None] = os.getpid()
+
+    key = (url, user, password, dav_endpoint_version)
+    session = pool.get(key)
+    if session is None:
+        session = pool[key] = Session(make_client, user, password)
+    else:
+        _stats['hits'] += 1
+    return session
+
+
+def discard(user=None):
+    """ Close and forget the sessions of user (all the sessions if None) in the pool of the current thread.
+    """
+    pool = _pool.get()
+    for key in pool.keys():
+        if key is not None and (user is None or key[1] == user):
+            pool.pop(key)._client.logout()
@@ -0,0 +1,210 @@
+# The _open_SmashBox Project.
+#
+# License: AGPL
+#
+# Runs of the sync client for run_ocsync(): owncloudcmd is executed
+# directly (no shell) and its output is appended to the log file of the
+# sync while it is parsed into the metrics of the sync: files propagated
+# in each direction, bytes transferred, sync restarts and error lines.
+#
+# A Sync runs in the background, so one worker may run several syncs at
+# the same time (run_ocsync_async()).
+
+import os
+import re
+import subprocess
+import threading
+import time
+
+# owncloudcmd log lines (client 1.x and 2.x)
+PROPAGATED = re.compile(r'Completed propagation of "?(?P<path>.+?)"? by (?:OCC::)?(?P<job>\w+)')
+RETRY = re.compile(r'Restarting [Ss]ync|\b[Rr]etry(?:ing)?\b')
+ERROR = re.compile(r'\[ ?(?:critical|fatal)\b|\berror\b', re.IGNORECASE)
+
+MAX_ERROR_LINES = 20 # error lines kept per sync (all of them are counted)
+
+
+class SyncOutput:
+    """ Parser of the output of a sync run: feed() it the lines as they come.
+    """
+
+    def __init__(self):
+        self.uploaded = []
+        self.downloaded = []
+        self.propagated = 0
+        self.retries = 0
+        self.nerrors = 0
+        self.errors = []
+        self.nlines = 0
+
+    def feed(self, line):
+        self.nlines += 1
+
+        m = PROPAGATED.search(line)
+        if m:
+            self.propagated += 1
+            if 'Upload' in m.group('job'):
+                self.uploaded.append(m.group('path'))
+            elif 'Download' in m.group('job'):
+                self.downloaded.append(m.group('path'))
+            return
+
+        if RETRY.search(line):
+            self.retries += 1
+
+        if ERROR.search(line):
+            self.nerrors += 1
+            if len(self.errors) < MAX_ERROR_LINES:
+                self.errors.append(line.rstrip())
+
+    def metrics(self, local_folder, duration):
+        """ Metrics of the sync as a dict. The bytes transferred are the sizes of the uploaded and downloaded files found in local_folder
+        after the sync (the client does not log the sizes).
+        """
+        nbytes = 0
+        for path in self.uploaded + self.downloaded:
+            try:
+                nbytes += os.path.getsize(os.path.join(local_folder, path))
+            except OSError:
+                pass # removed or renamed in the meantime
+
+        return {'duration': duration,
+                'files': self.propagated,
+                'uploads': len(self.uploaded),
+                'downloads': len(self.downloaded),
+                'bytes': nbytes,
+                'throughput': nbytes/duration if duration > 0 else 0.0,
+                'retries': self.retries,
+                'errors': self.nerrors}
+
+
+# notified whenever a sync finishes (see wait_any())
+_finished = threading.Condition()
+
+
+class Sync:
+    """ A sync run started in the background: a thread appends the output of the client to log_path and parses it.
+
+      started, finished: start and end time (finished is None while running)
+      returncode: exit code of the client (None while running, 127 if it could not be started)
+      output: the SyncOutput parsed so far
+      cancelled: True if stopped by cancel()
+
+    on_finish(sync) is called once, in the thread which first sees the sync finished in wait(), poll() or cancel().
+    """
+
+    def __init__(self, args, log_path, env=None, on_finish=None):
+        self.args = args
+        self.log_path = log_path
+        self.on_finish = on_finish
+        self._notified = False
+        self.output = SyncOutput()
+        self.returncode = None
+        self.cancelled = False
+        self.started = time.time()
+        self.finished = None
+        self.process = None
+        self._reader = None
+
+        log = open(log_path, 'ab')
+        try:
+            self.process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env, close_fds=True)
+        except OSError, x:
+            line = '%s: %s\n' % (args[0], x.strerror)
+            log.write(line)
+            log.close()
+            self.output.feed(line)
+            self._done(127)
+            return
+
+        self._reader = threading.Thread(target=self._read, args=(log,), name='ocsync')
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _read(self, log):
+        try:
+            for line in iter(self.process.stdout.readline, ''):
+                log.write(line)
+                self.output.feed(line)
+        finally:
+            log.close()
+            self.process.stdout.close()
+            self._done(self.process.wait())
+
+    def _done(self, returncode):
+        _finished.acquire()
+        try:
+            self.finished = time.time()
+            self.returncode = returncode
+            _finished.notify_all()
+        finally:
+            _finished.release()
+
+    @property
+    def duration(self):
+        """ Seconds from start to end of the sync (until now while it is running).
+        """
+        return (self.finished or time.time()) - self.started
+
+    def _notify(self):
+        if self.returncode is not None and not self._notified:
+            self._notified = True
+            if self.on_finish:
+                self.on_finish(self)
+
+    def poll(self):
+        """ Return the exit code of the client or None if it is still running.
+        """
+        self._notify()
+        return self.returncode
+
+    def wait(self, timeout=None):
+        """ Wait until the sync is finished or timeout seconds passed. Return the exit code of the client or None on timeout.
+        """
+        if self._reader is not None:
+            deadline = None if timeout is None else time.time()+timeout
+            while self._reader.is_alive():
+                if deadline is None:
+                    self._reader.join(1.0) # a join without timeout is not interrupted by signals
+                else:
+                    if time.time() >= deadline:
+                        break
+                    self._reader.join(min(1.0, deadline-time.time()))
+        self._notify()
+        return self.returncode
+
+    def cancel(self, grace=5):
+        """ Stop the client: terminate it and kill it if it is still running after grace seconds. Return its exit code.
+        """
+        if self.returncode is None:
+            self.cancelled = True
+            try:
+                self.process.terminate()
+                if self.wait(grace) is None:
+                    self.process.kill()
+            except OSError:
+                pass # finished in the meantime
+        return self.wait()
+
+    def metrics(self, local_folder):
+        return self.output.metrics(local_folder, self.duration)
+
+
+def wait_any(syncs, timeout=None):
+    """ Wait until at least one of the syncs is finished (or timeout seconds passed). Return the list of the finished ones.
+    """
+    deadline = None if timeout is None else time.time()+timeout
+    _finished.acquire()
+    try:
+        while True:
+            done = [s for s in syncs if s.returncode is not None]
+            if done or not syncs:
+                return done
+            if deadline is None:
+                _finished.wait(1.0)
+            else:
+                if time.time() >= deadline:
+                    return done
+                _finished.wait(min(1.0, deadline-time.time()))
+    finally:
+        _finished.release()
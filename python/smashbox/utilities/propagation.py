@@ -0,0 +1,76 @@
+# The _open_SmashBox Project.
+#
+# License: AGPL
+#
+# Measurement of the etag propagation of the server (watch_etags()):
+# after a change (an upload, a share...) the etags of the parent folders
+# of all the users who see the change must change. A watcher takes the
+# etags of a set of paths of several users before the change and then
+# polls them until they change: the time it took is the propagation
+# latency of each path.
+#
+# The paths are polled with PROPFIND (Depth: 0) on the keep-alive
+# sessions of the users, all pending paths at once, first every
+# MIN_INTERVAL and then less and less often (BACKOFF) up to
+# MAX_INTERVAL: a fast propagation is measured precisely and a slow one
+# does not flood the server. The latency is measured when the response
+# showing the new etag arrives, so it is an upper bound, by at most the
+# poll interval and the duration of a request.
+
+import time
+
+MIN_INTERVAL = 0.01 # seconds
+MAX_INTERVAL = 1.0
+BACKOFF = 1.5
+
+
+class EtagWatcher:
+    """ Watch the etags of targets (any hashable values) read by probe(target): the etag of the target (None if it does
+    not exist). map_concurrently(function, items) runs the probes of a poll.
+
+    The etags are taken when the watcher is created: create it before the change, then call wait() after it. Each
+    wait() takes the etags it has seen as the reference of the next one, so a watcher can follow a sequence of changes.
+    """
+
+    def __init__(self, targets, probe, map_concurrently=map, record=None):
+        self.targets = list(targets)
+        self.probe = probe
+        self.map_concurrently = map_concurrently
+        self.record = record
+        self.etags = dict(zip(self.targets, self.map_concurrently(probe, self.targets)))
+
+    def _poll(self, targets):
+        def timed(target):
+            etag = self.probe(target)
+            return etag, time.time()
+        return zip(targets, self.map_concurrently(timed, targets))
+
+    def wait(self, timeout=60, since=None, expect_change=True):
+        """ Poll until the etags of all the targets changed or timeout seconds passed since the change (at time since,
+        by default now). Return {target: latency in seconds, None if it did not change}.
+
+        With expect_change=False the targets are polled for timeout seconds, to check that the etags do not change.
+        """
+        if since is None:
+            since = time.time()
+
+        latencies = dict((t, None) for t in self.targets)
+        pending = list(self.targets)
+        interval = MIN_INTERVAL
+
+        while pending:
+            for target, (etag, t) in self._poll(pending):
+                if etag != self.etags[target]:
+                    latencies[target] = t - since
+                    self.etags[target] = etag
+            pending = [target for target in pending if latencies[target] is None]
+
+            left = since + timeout - time.time()
+            if left <= 0:
+                break
+            time.sleep(min(interval, left))
+            interval = min(interval*BACKOFF, MAX_INTERVAL)
+
+        if self.record and expect_change:
+            self.record(latencies)
+        return latencies
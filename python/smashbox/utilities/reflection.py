@@ -4,12 +4,12 @@
 def getProcessName():
     """ This is the name of the function which defines the execution code for the worker.
     """
-    return _smash_.process_name
+    return _smash_.worker.process_name
 
 def getWorkerNumber():
     """ This is 0 for supervisor process, 0 for the first worker process, etc.
     """
-    return _smash_.process_number
+    return _smash_.worker.process_number
 
 def getCurrentStep():
     """ Get current step. When worker is waiting at step(N) then it's
@@ -18,7 +18,7 @@ def getCurrentStep():
     """
     if getWorkerNumber() is None:
         return None
-    return _smash_.steps[getWorkerNumber()]
+    return _smash_.barrier.get_step(getWorkerNumber())
 
 def getSharedObject():
     """ Get the object which allows to share state between worker processes.
@@ -32,3 +32,50 @@ def getTestcaseFilename():
     """ The absolute path to the file containing current testcase.
     """
     return _smash_.args.test_target
+
+import threading
+
+class WorkerLocal(object):
+    """ A list or dict private to the current worker. Workers running
+    as processes get their own copy anyway but workers running as
+    threads share module globals: a WorkerLocal keeps a separate
+    object for each thread, created by calling factory() on first use.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._local = threading.local()
+
+    def get(self):
+        try:
+            return self._local.obj
+        except AttributeError:
+            self._local.obj = self._factory()
+            return self._local.obj
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def __len__(self):
+        return len(self.get())
+
+    def __nonzero__(self):
+        return bool(self.get())
+
+    def __iter__(self):
+        return iter(self.get())
+
+    def __contains__(self, x):
+        return x in self.get()
+
+    def __getitem__(self, key):
+        return self.get()[key]
+
+    def __setitem__(self, key, val):
+        self.get()[key] = val
+
+    def __delitem__(self, key):
+        del self.get()[key]
+
+    def __repr__(self):
+        return repr(self.get())
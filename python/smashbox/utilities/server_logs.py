@@ -0,0 +1,179 @@
+# The _open_SmashBox Project.
+#
+# License: AGPL
+#
+# Incremental analysis of the owncloud server log (scrape_log_file()).
+#
+# The offset of the end of the log analysed by the previous test is kept
+# in smashdir, so a test downloads only the bytes logged since then (a
+# Range request). The new bytes are scanned once, in large blocks: a
+# single compiled regular expression of all the patterns finds the
+# interesting lines and only these are checked pattern by pattern and
+# parsed as JSON log records.
+
+from smashbox.script import config
+
+import json
+import os
+import re
+
+import requests
+
+OFFSETS_FILE = 'server-log-offsets.json'
+
+CHUNK_SIZE = 1024*1024
+
+_METACHARS = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+
+def _offsets_path():
+    return os.path.join(config.smashdir, OFFSETS_FILE)
+
+
+def _load_offsets():
+    try:
+        return json.load(open(_offsets_path()))
+    except (IOError, ValueError):
+        return {}
+
+
+def _key(url):
+    # the stored offsets must not contain passwords
+    return re.sub('//[^/@]*@', '//', url)
+
+
+def get_offset(url):
+    return _load_offsets().get(_key(url), 0)
+
+
+def set_offset(url, offset):
+    offsets = _load_offsets()
+    offsets[_key(url)] = offset
+    path = _offsets_path()
+    f = open(path+'.tmp', 'w')
+    json.dump(offsets, f)
+    f.close()
+    os.rename(path+'.tmp', path)
+
+
+def fetch(url, offset=0):
+    """ Download the log at url from offset on. Return (status, start, chunks) where chunks is an iterator of the bytes of the log
+    from offset start on.
+
+    The server may ignore the Range request (status 200): the first offset bytes are then skipped on the fly. If the log is
+    shorter than offset (it was reset or rotated) it is read from the beginning.
+    """
+    headers = {}
+    if offset:
+        headers['Range'] = 'bytes=%d-' % offset
+
+    res = requests.get(url, headers=headers, stream=True)
+
+    if res.status_code == 416:
+        # nothing new (or the log shrank: then start over)
+        length = res.headers.get('Content-Range', '').rpartition('/')[2]
+        res.close()
+        if length.isdigit() and int(length) < offset:
+            return fetch(url, 0)
+        return 206, offset, iter([])
+
+    if res.status_code == 206:
+        return res.status_code, offset, res.iter_content(CHUNK_SIZE)
+
+    if res.status_code != 200:
+        return res.status_code, offset, iter([])
+
+    length = res.headers.get('Content-Length')
+    if not offset or (length is not None and int(length) < offset):
+        return res.status_code, 0, res.iter_content(CHUNK_SIZE)
+
+    def skip(chunks, n):
+        for chunk in chunks:
+            if n >= len(chunk):
+                n -= len(chunk)
+                continue
+            yield chunk[n:]
+            n = 0
+
+    return res.status_code, offset, skip(res.iter_content(CHUNK_SIZE), offset)
+
+
+class LogScanner:
+    """ Count the lines of the log matching each pattern (case-insensitive regular expressions) and keep the first
+    max_records of them, parsed as owncloud JSON log records (dicts) when possible.
+
+    An incomplete last line (still being written by the server) is not scanned: it is not part of the consumed bytes.
+    """
+
+    def __init__(self, patterns, max_records=10):
+        self.patterns = [(p, re.compile(p, re.IGNORECASE)) for p in patterns]
+        self.max_records = max_records
+        self.counts = dict((p, 0) for p in patterns)
+        self.records = dict((p, []) for p in patterns)
+        self.nlines = 0
+        self.nbytes = 0
+        self._partial = ''
+
+        # the re module is slow with IGNORECASE: plain strings are matched case-sensitively in the lowercased log
+        literals = [p for p in patterns if not _METACHARS.search(p)]
+        regexps = [p for p in patterns if _METACHARS.search(p)]
+        self._literals = None
+        self._regexps = None
+        if literals:
+            self._literals = re.compile('|'.join([re.escape(p.lower()) for p in literals]))
+        if regexps:
+            self._regexps = re.compile('|'.join(['(?:%s)' % p for p in regexps]), re.IGNORECASE)
+
+    def feed(self, chunk):
+        """ Scan the next chunk of the log (lines may be split across chunks).
+        """
+        self.nbytes += len(chunk)
+
+        data = self._partial + chunk
+        end = data.rfind('\n')+1
+        self._partial = data[end:]
+        block = data[:end]
+
+        self.nlines += block.count('\n')
+
+        matches = []
+        if self._literals:
+            matches += [m.start() for m in self._literals.finditer(block.lower())]
+        if self._regexps:
+            matches += [m.start() for m in self._regexps.finditer(block)]
+
+        line_end = 0
+        for pos in sorted(matches):
+            if pos < line_end:
+                continue # this line is done
+            line_start = block.rfind('\n', 0, pos)+1
+            line_end = block.find('\n', pos)+1
+            self._line(block[line_start:line_end])
+
+    @property
+    def consumed(self):
+        """ The number of bytes of the complete lines scanned.
+        """
+        return self.nbytes - len(self._partial)
+
+    def _line(self, line):
+        record = None
+        for p, regexp in self.patterns:
+            if regexp.search(line):
+                self.counts[p] += 1
+                if len(self.records[p]) < self.max_records:
+                    if record is None:
+                        record = parse_record(line)
+                    self.records[p].append(record)
+
+
+def parse_record(line):
+    """ A JSON log record of owncloud as a dict (the raw line as message if it is not JSON).
+    """
+    try:
+        record = json.loads(line)
+        if isinstance(record, dict):
+            return record
+    except ValueError:
+        pass
+    return {'message': line.strip()}
@@ -0,0 +1,259 @@
+# The _open_SmashBox Project.
+#
+# License: AGPL
+#
+# WebDAV requests of the test helpers (webdav_propfind, webdav_exists,
+# webdav_delete...) on pooled keep-alive HTTP connections, so repeated
+# checks reuse the connections instead of paying a TCP and TLS handshake
+# per request.
+#
+# A requests.Session is not thread-safe, so as the API clients of
+# oc_sessions the sessions are private to the thread. The connections
+# are not: the sessions of an account in a process share one transport
+# adapter, whose connection pool is thread-safe, so all the
+# threads of map_concurrently() share the connections of the account.
+
+from smashbox.script import config
+from smashbox import tracing
+from smashbox.utilities import reflection
+
+import os
+import threading
+import urllib
+import urlparse
+
+import requests
+
+TIMEOUT = 60 # seconds, as for the curl client
+
+CONCURRENCY = 10 # requests in flight per batch (and connections kept per account)
+
+PROPFIND_BODY = """<?xml version="1.0" encoding="utf-8"?>
+<d:propfind xmlns:d="DAV:" xmlns:oc="http://owncloud.org/ns">
+  <d:prop>
+    <d:resourcetype/>
+    <d:getetag/>
+    <d:getcontentlength/>
+    <d:getlastmodified/>
+    <oc:fileid/>
+    <oc:permissions/>
+  </d:prop>
+</d:propfind>
+"""
+
+_sessions = reflection.WorkerLocal(dict) # account -> Session, with the pid of the process under key None
+_pools = reflection.WorkerLocal(dict) # the thread pool of map_concurrently() (pool), its size and the pid of the process
+_helper = threading.local() # active in the threads of the pools
+_adapters = {} # account -> HTTPAdapter shared by the threads of the process
+_adapters_pid = None
+_lock = threading.Lock()
+
+
+def account(user_num=None):
+    """ (username, password) of the test account user_num (or of the main account).
+    """
+    if user_num is None:
+        return config.oc_account_name, config.oc_account_password
+    return "%s%i" % (config.oc_account_name, user_num), config.oc_account_password
+
+
+def _adapter(key):
+    global _adapters_pid
+
+    _lock.acquire()
+    try:
+        if _adapters_pid != os.getpid():
+            _adapters.clear()
+            _adapters_pid = os.getpid()
+
+        adapter = _adapters.get(key)
+        if adapter is None:
+            adapter = _adapters[key] = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=CONCURRENCY)
+        return adapter
+    finally:
+        _lock.release()
+
+
+def session(user_num=None):
+    """ The keep-alive session of the account in this thread (a forked worker never reuses the connections of its parent).
+    """
+    sessions = _sessions.get()
+    if sessions.get(None) != os.getpid():
+        sessions.clear()
+        sessions[None] = os.getpid()
+
+    # by account, not user_num: the account of the test may change (oc_account_reset_procedure = "pool")
+    key = account(user_num)
+    s = sessions.get(key)
+    if s is None:
+        s = requests.Session()
+        s.auth = key
+        s.verify = False # as curl -k
+        adapter = _adapter(key)
+        s.mount('http://', adapter)
+        s.mount('https://', adapter)
+        sessions[key] = s
+    return s
+
+
+def root_path(webdav_endpoint=None):
+    """ The path of the WebDAV root of the accounts on the server (see oc_webdav_url()).
+    """
+    if webdav_endpoint is None:
+        webdav_endpoint = config.oc_webdav_endpoint
+    return '/' + os.path.join(webdav_endpoint, config.oc_server_folder).strip('/')
+
+
+def url(path, webdav_endpoint=None):
+    """ URL of the remote path (without credentials, special characters quoted).
+    """
+    protocol = 'http'
+    if config.oc_ssl_enabled:
+        protocol += 's'
+
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+
+    return protocol + '://' + config.oc_server + urllib.quote(os.path.join(root_path(webdav_endpoint), path.lstrip('/')))
+
+
+def purge_trashbin(user_num=None):
+    """ Delete all the files in the trashbin of the account, with their versions. Return the status of the response: 404
+    or 405 if the server has no trashbin endpoint (before owncloud 10.1 or without the files_trashbin app).
+    """
+    protocol = 'http'
+    if config.oc_ssl_enabled:
+        protocol += 's'
+
+    username = account(user_num)[0]
+    path = '/' + os.path.join(config.oc_root, 'remote.php/dav/trash-bin', username).strip('/') + '/'
+
+    with tracing.span('webdav', cat='http', method='DELETE', path=path) as span:
+        response = session(user_num).request('DELETE', protocol + '://' + config.oc_server + urllib.quote(path), timeout=TIMEOUT, allow_redirects=False)
+        span.args = dict(span.args, status=response.status_code)
+    return response.status_code
+
+
+def request(method, path, user_num=None, headers=None, data=None):
+    """ Send a WebDAV request for the remote path of the account and return the response.
+    """
+    with tracing.span('webdav', cat='http', method=method, path=path) as span:
+        response = session(user_num).request(method, url(path), headers=headers, data=data, timeout=TIMEOUT, allow_redirects=False)
+        span.args = dict(span.args, status=response.status_code)
+    return response
+
+
+def propfind(path, depth=1, user_num=None):
+    """ PROPFIND the remote path: return (status, entries) where entries are parsed from a 207 response (see parse_multistatus()).
+    """
+    response = request('PROPFIND', path, user_num, headers={'Depth': str(depth), 'Content-Type': 'application/xml; charset=utf-8'}, data=PROPFIND_BODY)
+
+    if response.status_code != 207:
+        return response.status_code, None
+
+    return response.status_code, parse_multistatus(response.content)
+
+
+def parse_multistatus(text, root=None):
+    """ Parse a PROPFIND multistatus response into a list of dicts, one per resource:
+
+      path: the path relative to the WebDAV root (unquoted)
+      collection: True for a directory
+      etag, size, modified, fileid, permissions: the property values (None if missing)
+    """
+    from xml.etree import ElementTree
+
+    if root is None:
+        root = root_path()
+    root = root.rstrip('/')
+
+    props = {'etag': '{DAV:}getetag',
+             'size': '{DAV:}getcontentlength',
+             'modified': '{DAV:}getlastmodified',
+             'fileid': '{http://owncloud.org/ns}fileid',
+             'permissions': '{http://owncloud.org/ns}permissions'}
+
+    entries = []
+
+    for r in ElementTree.fromstring(text).findall('{DAV:}response'):
+        href = urllib.unquote(urlparse.urlsplit(r.findtext('{DAV:}href')).path)
+        if href.startswith(root + '/') or href == root:
+            href = href[len(root):]
+
+        entry = {'path': href, 'collection': False}
+        for name in props:
+            entry[name] = None
+
+        for propstat in r.findall('{DAV:}propstat'):
+            if ' 200 ' not in (propstat.findtext('{DAV:}status') or ''):
+                continue # the properties not found
+            prop = propstat.find('{DAV:}prop')
+            if prop is None:
+                continue
+            for name, tag in props.items():
+                e = prop.find(tag)
+                if e is not None:
+                    entry[name] = e.text
+            rt = prop.find('{DAV:}resourcetype')
+            if rt is not None and rt.find('{DAV:}collection') is not None:
+                entry['collection'] = True
+
+        if entry['size'] is not None:
+            entry['size'] = int(entry['size'])
+
+        entries.append(entry)
+
+    return entries
+
+
+def _mark_helper():
+    _helper.active = True
+
+
+def _pool(size):
+    """ The thread pool of the current worker, with at least size threads. It lives as long as the worker, so its threads
+    keep their sessions (the webdav sessions, the API clients of oc_sessions) from one call to the next.
+    """
+    pools = _pools.get()
+    if pools.get('pid') != os.getpid():
+        pools.clear() # the threads of the pool of the parent do not exist in a forked child
+        pools['pid'] = os.getpid()
+
+    pool = pools.get('pool')
+    if pool is None or pools['size'] < size:
+        if pool is not None:
+            pool.close()
+        import multiprocessing.pool
+        pool = pools['pool'] = multiprocessing.pool.ThreadPool(size, _mark_helper)
+        pools['size'] = size
+    return pool
+
+
+def close_pool():
+    """ Stop the threads of the pool of the current worker (a worker running as a thread calls this when it finishes).
+    """
+    pools = _pools.get()
+    pool = pools.pop('pool', None)
+    if pool is not None and pools.get('pid') == os.getpid():
+        pool.close()
+        pool.join()
+
+
+def map_concurrently(function, items, concurrency=CONCURRENCY):
+    """ Return [function(x) for x in items] computed by up to concurrency threads of the pool of the current worker.
+
+    A function called this way which calls map_concurrently() again runs the inner calls sequentially in its thread.
+    """
+    items = list(items)
+
+    if concurrency <= 1 or len(items) <= 1 or getattr(_helper, 'active', False):
+        return [function(x) for x in items]
+
+    concurrency = min(concurrency, len(items))
+    size = (len(items) + concurrency - 1) // concurrency
+    chunks = [items[i:i+size] for i in range(0, len(items), size)]
+
+    def run(chunk):
+        return [function(x) for x in chunk]
+
+    return sum(_pool(concurrency).map(run, chunks, 1), [])